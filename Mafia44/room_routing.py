@@ -0,0 +1,208 @@
+"""
+Room-affinity dispatcher.
+
+Per-room state (room locks, in-process caches) is only valid if every request for a room reaches
+the same worker process. This WSGI app sits in front of the workers and forwards each request to
+the worker chosen by consistent hashing of its ``room_id``, so adding or removing a worker only
+moves the rooms that hashed to it.
+
+Run several workers and the dispatcher locally with e.g.:
+
+    python manage.py runserver 8001 --noreload &
+    python manage.py runserver 8002 --noreload &
+    python -m Mafia44.room_routing --port 8000 --workers 127.0.0.1:8001 127.0.0.1:8002
+"""
+
+import argparse
+import bisect
+import hashlib
+import http.client
+import json
+import threading
+import time
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIServer, make_server
+
+VIRTUAL_NODES = 64
+DEAD_WORKER_RETRY_SECONDS = 5
+WORKER_HEADER = "X-Room-Worker"
+MATCHMAKING_PATH = "/matchmaking/"
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+    "transfer-encoding", "upgrade",
+}
+
+
+class _WorkerDown(Exception):
+    # the worker could not be connected to, so the request was never sent
+    pass
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._lock = threading.Lock()
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return sorted(set(self._nodes))
+
+    def add(self, node: str) -> None:
+        with self._lock:
+            for i in range(self.virtual_nodes):
+                h = _hash(f"{node}#{i}")
+                idx = bisect.bisect(self._hashes, h)
+                self._hashes.insert(idx, h)
+                self._nodes.insert(idx, node)
+
+    def remove(self, node: str) -> None:
+        with self._lock:
+            kept = [(h, n) for h, n in zip(self._hashes, self._nodes) if n != node]
+            self._hashes = [h for h, _ in kept]
+            self._nodes = [n for _, n in kept]
+
+    def get(self, key) -> str | None:
+        with self._lock:
+            if not self._hashes:
+                return None
+            idx = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+            return self._nodes[idx]
+
+
+def room_id_from_environ(environ, body: bytes):
+    room_id = parse_qs(environ.get("QUERY_STRING", "")).get("room_id", [None])[0]
+    if room_id is None and body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            room_id = data.get("room_id")
+    return room_id
+
+
+def _affinity_key(environ, body: bytes) -> str:
+    if environ.get("PATH_INFO", "").startswith(MATCHMAKING_PATH):
+        # the queue lives in one worker's memory, so every user must reach the same one to be grouped
+        return "matchmaking"
+    room_id = room_id_from_environ(environ, body)
+    if room_id is not None:
+        return f"room:{room_id}"
+    # requests without a room (lobby, auth) only need to be spread evenly
+    return f"client:{environ.get('HTTP_COOKIE') or environ.get('REMOTE_ADDR', '')}"
+
+
+def _forward_headers(environ) -> dict:
+    headers = {
+        key[5:].replace("_", "-").title(): value
+        for key, value in environ.items()
+        if key.startswith("HTTP_")
+    }
+    if environ.get("CONTENT_TYPE"):
+        headers["Content-Type"] = environ["CONTENT_TYPE"]
+    if environ.get("REMOTE_ADDR"):
+        forwarded = headers.get("X-Forwarded-For")
+        headers["X-Forwarded-For"] = f"{forwarded}, {environ['REMOTE_ADDR']}" if forwarded else environ["REMOTE_ADDR"]
+    return {key: value for key, value in headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+
+
+class RoomRouter:
+    def __init__(self, workers, timeout=30):
+        self.ring = HashRing(workers)
+        self.timeout = timeout
+        self._dead_lock = threading.Lock()
+        self._dead_workers = {}  # {worker: time it was dropped}
+
+    def _mark_dead(self, worker):
+        with self._dead_lock:
+            if worker not in self._dead_workers:
+                self._dead_workers[worker] = time.monotonic()
+                self.ring.remove(worker)
+
+    def _revive_workers(self):
+        # Dropped workers are put back on the ring after a while; if still down they are dropped again.
+        if not self._dead_workers:
+            return
+        now = time.monotonic()
+        with self._dead_lock:
+            for worker, dropped_at in list(self._dead_workers.items()):
+                if now - dropped_at >= DEAD_WORKER_RETRY_SECONDS:
+                    del self._dead_workers[worker]
+                    self.ring.add(worker)
+
+    def _send(self, worker, environ, body):
+        path = environ.get("PATH_INFO", "/")
+        if environ.get("QUERY_STRING"):
+            path += "?" + environ["QUERY_STRING"]
+        host, _, port = worker.partition(":")
+        connection = http.client.HTTPConnection(host, int(port or 80), timeout=self.timeout)
+        try:
+            try:
+                connection.connect()
+            except OSError as e:
+                raise _WorkerDown(worker) from e
+            connection.request(environ["REQUEST_METHOD"], path, body=body, headers=_forward_headers(environ))
+            response = connection.getresponse()
+            return response.status, response.reason, response.getheaders(), response.read()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _error(start_response, status, detail, worker=None):
+        headers = [("Content-Type", "application/json")]
+        if worker is not None:
+            headers.append((WORKER_HEADER, worker))
+        start_response(status, headers)
+        return [json.dumps({"detail": detail}).encode()]
+
+    def __call__(self, environ, start_response):
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+        key = _affinity_key(environ, body)
+        self._revive_workers()
+
+        while (worker := self.ring.get(key)) is not None:
+            try:
+                status, reason, headers, content = self._send(worker, environ, body)
+            except _WorkerDown:
+                # Drop the dead worker; only its share of rooms moves to the remaining ones.
+                self._mark_dead(worker)
+                continue
+            except TimeoutError:
+                # the request may have run; a slow worker keeps its rooms and the client decides whether to retry
+                return self._error(start_response, "504 Gateway Timeout", "Worker timed out", worker)
+            except (OSError, http.client.HTTPException):
+                return self._error(start_response, "502 Bad Gateway", "Worker failed to respond", worker)
+            headers = [(k, v) for k, v in headers if k.lower() not in HOP_BY_HOP_HEADERS | {"content-length"}]
+            headers += [("Content-Length", str(len(content))), (WORKER_HEADER, worker)]
+            start_response(f"{status} {reason}", headers)
+            return [content]
+
+        return self._error(start_response, "503 Service Unavailable", "No workers available")
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", nargs="+", required=True, help="host:port of each worker")
+    args = parser.parse_args(argv)
+    server = make_server(args.host, args.port, RoomRouter(args.workers), server_class=_ThreadingWSGIServer)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
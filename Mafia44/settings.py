@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "game.tracing.TracingMiddleware",
     "Mafia44.chips_middleware.AddPartitionedCookie",
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
@@ -54,6 +55,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'game.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -89,6 +91,58 @@ DATABASES = {
     }
 }
 
+# Read-only lobby/history views read from this copy when configured,
+# see game/replica.py and `manage.py replicate_sqlite`
+if os.environ.get('MAFIA44_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['MAFIA44_REPLICA_DB'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['game.replica.ReplicaRouter']
+
+REPLICA_PIN_SECONDS = 5
+
+# Stage reads are buffered in memory and bulk-written this often (0 writes them through),
+# see game/write_behind.py
+WRITE_BEHIND_FLUSH_MS = 200
+
+# Per-process admission control, see game/admission.py: polls over these caps are shed with 503,
+# moves wait up to ADMISSION_MOVE_QUEUE_SECONDS for one of the slots polls may not take
+ADMISSION_MAX_IN_FLIGHT = 32
+ADMISSION_MAX_POLLS_IN_FLIGHT = 24
+ADMISSION_MAX_POLLS_IN_FLIGHT_PER_ROOM = 4
+ADMISSION_MOVE_QUEUE_SECONDS = 5
+
+# Responses to requests sent with an Idempotency-Key header are replayed to retries for this long,
+# see game/idempotency.py
+IDEMPOTENCY_TTL_SECONDS = 300
+IDEMPOTENCY_MAX_KEYS = 10000
+
+# Write a Chrome trace-event file for every N-th request (0 disables tracing)
+TRACE_SAMPLE_EVERY = int(os.environ.get('MAFIA44_TRACE_SAMPLE_EVERY', 0))
+TRACE_DIR = BASE_DIR / 'traces'
+
+# Keep a cProfile + SQL dump of every request slower than this (0 disables, staff can still send X-Profile: 1)
+PROFILE_SLOW_MS = int(os.environ.get('MAFIA44_PROFILE_SLOW_MS', 0))
+PROFILE_DIR = BASE_DIR / 'profiles'
+PROFILE_DIR_MAX_BYTES = 64 * 1024 * 1024
+
+# mmap'd file shared by the workers of one host to answer game_stage polls without queries (unset disables)
+SNAPSHOT_CACHE_PATH = os.environ.get('MAFIA44_SNAPSHOT_CACHE')
+SNAPSHOT_CACHE_SLOTS = 4096
+
+# Number of proxies in front of the workers that append to X-Forwarded-For (the room router is one);
+# anonymous clients are rate limited by the address the outermost of them saw, see game/rate_limit.py
+RATE_LIMIT_TRUSTED_PROXY_HOPS = int(os.environ.get('MAFIA44_TRUSTED_PROXY_HOPS', 0))
+
+# Matchmaking drops waiting users who have not polled their status for this long, see game/matchmaking.py
+MATCHMAKING_WAIT_TIMEOUT_SECONDS = 60
+
+# Run game/warmup.py when a server process loads Mafia44.wsgi (MAFIA44_WARMUP=1), see also the warmup command
+WARMUP_ON_BOOT = os.environ.get('MAFIA44_WARMUP', '0') == '1'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -7,10 +7,21 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Mafia44.settings')
 
 application = get_wsgi_application()
+
+if settings.WARMUP_ON_BOOT:
+    from game import warmup
+
+    try:
+        warmup.run()
+    except Exception:
+        # a cold process still serves correctly, just slower at first
+        logging.getLogger(__name__).exception("Warm-up failed")
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from game.models import Room, Player, Game, GameState, GameStageRead, Action, CardShot
+from game.models import Room, Player, Game, GameState, GameStageRead, Action, CardShot, GameResult, RoleStats, \
+    UserStats, RoomEvent, Rating
 
 admin.site.register(Game)
 admin.site.register(Room)
@@ -8,4 +9,9 @@ admin.site.register(Player)
 admin.site.register(GameState)
 admin.site.register(GameStageRead)
 admin.site.register(Action)
-admin.site.register(CardShot)
\ No newline at end of file
+admin.site.register(CardShot)
+admin.site.register(GameResult)
+admin.site.register(RoleStats)
+admin.site.register(UserStats)
+admin.site.register(RoomEvent)
+admin.site.register(Rating)
@@ -0,0 +1,127 @@
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from game.exceptions import GameException, OverloadedException
+from game.view_utils import get_context
+
+POLL = "poll"
+MOVE = "move"
+
+DEFAULT_MAX_IN_FLIGHT = 32
+DEFAULT_MAX_POLLS_IN_FLIGHT = 24  # the rest of MAX_IN_FLIGHT is kept free for moves
+DEFAULT_MAX_POLLS_IN_FLIGHT_PER_ROOM = 4
+DEFAULT_MOVE_QUEUE_SECONDS = 5
+RETRY_AFTER_SECONDS = 1
+
+
+class AdmissionController:
+    # Polls are admitted only while there is spare capacity and no move is waiting, otherwise they are
+    # shed at once. Moves are never shed for polls: when the process is full they queue for a free slot.
+
+    def __init__(self, max_in_flight, max_polls_in_flight, max_polls_in_flight_per_room, move_queue_seconds):
+        self.max_in_flight = max_in_flight
+        self.max_polls_in_flight = max_polls_in_flight
+        self.max_polls_in_flight_per_room = max_polls_in_flight_per_room
+        self.move_queue_seconds = move_queue_seconds
+        self._condition = threading.Condition()
+        self._in_flight = {POLL: 0, MOVE: 0}
+        self._room_polls = {}  # {room_id: polls in flight}
+        self._waiting_moves = 0
+        self._peak_in_flight = 0
+        self._admitted = Counter()  # {endpoint: requests}
+        self._shed = Counter()  # {endpoint: requests}
+
+    def _total(self):
+        return self._in_flight[POLL] + self._in_flight[MOVE]
+
+    def admit(self, endpoint, priority, room_id) -> bool:
+        with self._condition:
+            if priority == POLL:
+                if (self._waiting_moves
+                        or self._total() >= self.max_in_flight
+                        or self._in_flight[POLL] >= self.max_polls_in_flight
+                        or self._room_polls.get(room_id, 0) >= self.max_polls_in_flight_per_room):
+                    self._shed[endpoint] += 1
+                    return False
+                if room_id is not None:
+                    self._room_polls[room_id] = self._room_polls.get(room_id, 0) + 1
+            elif self._total() >= self.max_in_flight:
+                self._waiting_moves += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._total() < self.max_in_flight, self.move_queue_seconds)
+                finally:
+                    self._waiting_moves -= 1
+                if not admitted:
+                    self._shed[endpoint] += 1
+                    return False
+            self._in_flight[priority] += 1
+            self._admitted[endpoint] += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._total())
+            return True
+
+    def release(self, priority, room_id) -> None:
+        with self._condition:
+            self._in_flight[priority] -= 1
+            if priority == POLL and room_id is not None:
+                remaining = self._room_polls[room_id] - 1
+                if remaining:
+                    self._room_polls[room_id] = remaining
+                else:
+                    del self._room_polls[room_id]
+            self._condition.notify()
+
+    def polled_room_count(self) -> int:
+        return len(self._room_polls)
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                "in_flight": dict(self._in_flight),
+                "waiting_moves": self._waiting_moves,
+                "peak_in_flight": self._peak_in_flight,
+                "busiest_rooms": sorted(self._room_polls.items(), key=lambda item: -item[1])[:10],
+                "admitted": dict(self._admitted),
+                "shed": dict(self._shed),
+                "limits": {
+                    "max_in_flight": self.max_in_flight,
+                    "max_polls_in_flight": self.max_polls_in_flight,
+                    "max_polls_in_flight_per_room": self.max_polls_in_flight_per_room,
+                    "move_queue_seconds": self.move_queue_seconds,
+                },
+            }
+
+
+controller = AdmissionController(
+    getattr(settings, "ADMISSION_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT),
+    getattr(settings, "ADMISSION_MAX_POLLS_IN_FLIGHT", DEFAULT_MAX_POLLS_IN_FLIGHT),
+    getattr(settings, "ADMISSION_MAX_POLLS_IN_FLIGHT_PER_ROOM", DEFAULT_MAX_POLLS_IN_FLIGHT_PER_ROOM),
+    getattr(settings, "ADMISSION_MOVE_QUEUE_SECONDS", DEFAULT_MOVE_QUEUE_SECONDS),
+)
+
+
+def admission(endpoint, priority=POLL):
+    # priority is POLL, MOVE, or a function of the request returning one of them
+    def decorator(view):
+        def new_view(request, *args, **kwargs):
+            try:
+                context = get_context(request)
+                room_id = context.room_id
+                request_priority = priority(context) if callable(priority) else priority
+            except GameException:
+                return view(request, *args, **kwargs)  # let the view report the bad request
+            if not controller.admit(endpoint, request_priority, room_id):
+                response = JsonResponse({"detail": OverloadedException.details}, status=OverloadedException.code)
+                response["Retry-After"] = str(RETRY_AFTER_SECONDS)
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                controller.release(request_priority, room_id)
+
+        return new_view
+
+    return decorator
@@ -7,6 +7,8 @@ from django.middleware.csrf import get_token
 from django.views.decorators.csrf import csrf_protect, ensure_csrf_cookie
 from django.views.decorators.http import require_GET, require_POST
 
+from game.replica import read_replica
+
 
 @ensure_csrf_cookie
 def csrf(request):
@@ -47,6 +49,7 @@ def logout_view(request):
 
 
 @require_GET
+@read_replica
 def me_view(request):
     if request.user.is_authenticated:
         u = request.user
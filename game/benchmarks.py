@@ -0,0 +1,134 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from game.game_logic import PLAYERS, CARDS_PER_PLAYER, init_game, is_action_required, \
+    try_create_next_state, advance_stage, get_accessible_stages, check_action, selected_cards_to_action, \
+    legal_selections, _apply_action, try_shoot, state_json, make_brothers_indistinguishable
+from game.models import Room, Player, GameState, GameStage, Action
+
+DEFAULT_SEEDS = (1, 2, 3, 4, 5, 6, 7, 8)
+DEFAULT_REPEAT = 20
+DEFAULT_ROUNDS = 5
+DEFAULT_MIN_SLOWDOWN_US = 2.0
+
+
+def _measure(func, repeat: int, rounds: int) -> tuple[float, int]:
+    # the fastest of several rounds: noise from the machine only ever makes a round slower
+    with CaptureQueriesContext(connection) as ctx:
+        func()
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        best = min(best, (time.perf_counter() - start) / repeat * 1e6)
+    return best, len(ctx.captured_queries)
+
+
+def _setup_game(seed: int):
+    users = [User.objects.create_user(username=f"bench_{seed}_{i}") for i in range(PLAYERS)]
+    room = Room.objects.create(name=f"bench_{seed}", creator=users[0], min_move_time=0)
+    for user in users:
+        Player.objects.create(user=user, room=room)
+    return init_game(room, seed=seed)
+
+
+def _find_action(game) -> tuple[int, list[int], Action] | None:
+    for player_id in range(PLAYERS):
+        if selections := legal_selections(game, player_id):
+            selected_cards, action = selections[0]
+            action.game_state = GameState.objects.get(game=game, stage=game.stage)
+            return player_id, selected_cards, action
+    return None
+
+
+def _bench_stage(game, repeat: int, rounds: int) -> dict:
+    state = GameState.objects.get(game=game, stage=game.stage)
+    results = {
+        "is_action_required": _measure(lambda: is_action_required(state), repeat, rounds),
+        "get_accessible_stages": _measure(lambda: get_accessible_stages(game, 0), repeat, rounds),
+    }
+    state_view = state_json(state, 0)
+    results["state_json"] = _measure(lambda: state_json(state, 0), repeat, rounds)
+    results["make_brothers_indistinguishable"] = _measure(lambda: make_brothers_indistinguishable(state_view),
+                                                          repeat, rounds)
+
+    action = state.get_action() or Action(cards_to_show=[], swap_card_a=0, swap_card_b=1)
+    results["_apply_action"] = _measure(lambda: _apply_action(state.cards, action), repeat, rounds)
+    return results
+
+
+def _bench_pending_action(game, repeat: int, rounds: int) -> dict:
+    state = GameState.objects.get(game=game, stage=game.stage)
+    if state.get_action() is not None or (found := _find_action(game)) is None:
+        return {}
+    player_id, selected_cards, action = found
+    return {
+        "check_action": _measure(lambda: check_action(game, player_id, action), repeat, rounds),
+        "selected_cards_to_action": _measure(lambda: selected_cards_to_action(game, player_id, selected_cards),
+                                             repeat, rounds),
+    }
+
+
+def _play_stage(game) -> None:
+    state = GameState.objects.get(game=game, stage=game.stage)
+    if is_action_required(state) and state.get_action() is None:
+        found = _find_action(game)
+        if found is not None:
+            found[2].save()
+            try_create_next_state(game)
+    if game.stage == GameStage.SHOOTING:
+        for player_id in range(PLAYERS):
+            try_shoot(game, player_id, ((player_id + 1) % PLAYERS) * CARDS_PER_PLAYER)
+
+
+def run(seeds=DEFAULT_SEEDS, repeat: int = DEFAULT_REPEAT, rounds: int = DEFAULT_ROUNDS) -> dict:
+    samples = {}  # {function: {stage: [(time_us, queries), ...]}}
+    for seed in seeds:
+        game = _setup_game(seed)
+        while True:
+            try_create_next_state(game)
+            stage_results = _bench_pending_action(game, repeat, rounds)
+            _play_stage(game)
+            stage_results.update(_bench_stage(game, repeat, rounds))
+            stage_name = GameStage(game.stage).name
+            for function, sample in stage_results.items():
+                samples.setdefault(function, {}).setdefault(stage_name, []).append(sample)
+            if game.stage == GameStage.FINISHED:
+                break
+            advance_stage(game)
+
+    results = {}
+    for function, stages in samples.items():
+        results[function] = {
+            stage: {
+                "time_us": statistics.median(time_us for time_us, _ in stage_samples),
+                "queries": max(queries for _, queries in stage_samples),
+            }
+            for stage, stage_samples in stages.items()
+        }
+    return {"seeds": list(seeds), "repeat": repeat, "rounds": rounds, "results": results}
+
+
+def compare(current: dict, baseline: dict, threshold: float | None = None,
+            min_slowdown_us: float = DEFAULT_MIN_SLOWDOWN_US) -> list[str]:
+    # Query counts are exact and always gate. Timings move between runs on the same machine by more than
+    # any useful threshold, so they only gate when a threshold is given, and a slowdown also has to exceed
+    # min_slowdown_us to count.
+    regressions = []
+    for function, stages in baseline["results"].items():
+        for stage, base in stages.items():
+            cur = current["results"].get(function, {}).get(stage)
+            if cur is None:
+                continue
+            if cur["queries"] > base["queries"]:
+                regressions.append(f"{function} @ {stage}: queries {base['queries']} -> {cur['queries']}")
+            slowdown_us = cur["time_us"] - base["time_us"]
+            if threshold is not None and cur["time_us"] > base["time_us"] * (1 + threshold) \
+                    and slowdown_us > min_slowdown_us:
+                regressions.append(f"{function} @ {stage}: time {base['time_us']:.1f}us -> {cur['time_us']:.1f}us")
+    return regressions
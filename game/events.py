@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.models import F, Q
+
+from game.models import Room, RoomEvent, EventKind
+
+MAX_EVENTS_PER_PAGE = 200
+
+
+def append_event(room_id: int, kind: EventKind, payload: dict | None = None, player_id: int | None = None) -> int:
+    # The counter update locks the room row until commit, so sequence numbers are gap-free per room.
+    with transaction.atomic():
+        Room.objects.filter(id=room_id).update(event_seq=F('event_seq') + 1)
+        seq = Room.objects.filter(id=room_id).values_list('event_seq', flat=True).get()
+        RoomEvent.objects.create(room_id=room_id, seq=seq, kind=kind, payload=payload or {}, player_id=player_id)
+    return seq
+
+
+def events_since(room_id: int, since: int, player_id: int | None,
+                 limit: int = MAX_EVENTS_PER_PAGE) -> tuple[list[dict], int]:
+    # returns the events visible to the seat and the seq to continue from
+    last_seq = Room.objects.filter(id=room_id).values_list('event_seq', flat=True).get()
+    visible = Q(player_id__isnull=True) if player_id is None else Q(player_id__isnull=True) | Q(player_id=player_id)
+    events = list(RoomEvent.objects.filter(
+        visible,
+        room_id=room_id,
+        seq__gt=since,
+        seq__lte=last_seq
+    ).order_by('seq')[:limit])
+    if len(events) == limit:
+        last_seq = events[-1].seq
+    return [
+        {
+            "seq": event.seq,
+            "kind": event.kind,
+            "payload": event.payload,
+            "timestamp": event.timestamp.isoformat(),
+        }
+        for event in events
+    ], max(last_seq, since)
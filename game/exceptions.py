@@ -60,4 +60,34 @@ class GameNotFinishedException(GameException):
 
 class InvalidSelectedCardsException(GameException):
     details = "Invalid selected cards"
-    code = 400
\ No newline at end of file
+    code = 400
+
+
+class RateLimitedException(GameException):
+    details = "Too many requests"
+    code = 429
+
+
+class InvalidRequestException(GameException):
+    details = "Invalid request body"
+    code = 400
+
+
+class InvalidRoomIdException(GameException):
+    details = "Invalid room_id"
+    code = 400
+
+
+class OverloadedException(GameException):
+    details = "Server is overloaded"
+    code = 503
+
+
+class StaffOnlyException(GameException):
+    details = "Staff only"
+    code = 403
+
+
+class IdempotencyKeyReusedException(GameException):
+    details = "Idempotency key was already used with a different request"
+    code = 422
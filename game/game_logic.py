@@ -1,14 +1,23 @@
+import json
 import random
 
 from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
+from django.db.models import F
 from django.utils import timezone
 
+from game import snapshots, write_behind
+from game.events import append_event
 from game.exceptions import InvalidSelectedCardsException
-from game.models import Game, GameState, CardType, GameStageRead, GameStage, Action, Room, CardShot
+from game.models import Game, GameState, CardType, GameStage, Action, Room, CardShot, Team, \
+    GameResult, RoleStats, UserStats, StateView, EventKind
+from game.ratings import update_ratings
+from game.tracing import traced
 
 PLAYERS = 4
 CARDS_IN_DISCARD = 3
 CARDS_PER_PLAYER = 2
+MAX_ADVANCE_ATTEMPTS = 3
 
 ROLE_TO_STAGE = {
     CardType.COPY.value: GameStage.COPY,
@@ -33,26 +42,47 @@ ROLE_COPY_TO_STAGE = {
     CardType.MILKMAN.value: GameStage.MILKMAN_COPY,
 }
 
+STAGE_TO_ROLE = {stage.value: role for role, stage in ROLE_TO_STAGE.items()}
 
-def init_game(room: Room) -> Game:
-    game = Game.objects.create(stage=GameStage.BEGINNING, room=room)
+_CANDIDATE_SELECTIONS = [[i] for i in range(PLAYERS * CARDS_PER_PLAYER + CARDS_IN_DISCARD)] + [
+    [i, j]
+    for i in range(PLAYERS * CARDS_PER_PLAYER + CARDS_IN_DISCARD)
+    for j in range(PLAYERS * CARDS_PER_PLAYER + CARDS_IN_DISCARD)
+    if i != j
+]
 
+
+SEED_BITS = 63
+_seed_source = random.SystemRandom()
+
+
+def deal(rng: random.Random) -> list[CardType]:
     cards = list(CardType)
-    random.shuffle(cards)
+    rng.shuffle(cards)
+    return cards
+
+
+@traced
+def init_game(room: Room, seed: int | None = None) -> Game:
+    if seed is None:
+        seed = _seed_source.getrandbits(SEED_BITS)
+    game = Game.objects.create(stage=GameStage.BEGINNING, room=room, seed=seed)
 
     GameState.objects.create(
         game=game,
-        cards=cards,
+        cards=deal(random.Random(seed)),
         stage=GameStage.BEGINNING
     )
     return game
 
 
+@traced
 def mark_read_by(game: Game, user: User):
     current_state = GameState.objects.get(game=game, stage=game.stage)
-    GameStageRead.objects.get_or_create(user=user, state=current_state)
+    write_behind.mark_read(current_state.id, user.id)
 
 
+@traced
 def is_action_required(game_state: GameState) -> bool:
     stage = game_state.stage
     copied_role = game_state.game.copied_role
@@ -64,13 +94,13 @@ def is_action_required(game_state: GameState) -> bool:
     if stage == GameStage.SHOOTING:
         return False
     if stage in ROLE_TO_STAGE.values():
-        stage_to_role = {v.value: k for k, v in ROLE_TO_STAGE.items()}
-        return stage_to_role[stage] in roles[:PLAYERS * CARDS_PER_PLAYER]
+        return STAGE_TO_ROLE[stage] in roles[:PLAYERS * CARDS_PER_PLAYER]
     if copied_role and copied_role in ROLE_COPY_TO_STAGE and stage == ROLE_COPY_TO_STAGE[copied_role]:
         return True
     return False
 
 
+@traced
 def check_advance_stage(game: Game) -> bool:
     if game.stage == GameStage.FINISHED:
         return False
@@ -85,16 +115,28 @@ def check_advance_stage(game: Game) -> bool:
     if not GameState.objects.filter(game=game, stage=game.stage + 1).exists():
         return False
 
-    current_state_readers = current_state.read_by.order_by('timestamp').all()
-    if current_state_readers.count() < game.room.players.count():
+    read_timestamps = write_behind.pending_reads(current_state.id)
+    read_timestamps.update(current_state.read_by.values_list('user_id', 'timestamp'))
+    if len(read_timestamps) < game.room.players.count():
         return False
-    last_read_timestamp = current_state_readers.last().timestamp
+    last_read_timestamp = max(read_timestamps.values())
     now = timezone.now()
     if (now - last_read_timestamp).total_seconds() < game.room.min_move_time:
         return False
     return True
 
 
+def _create_once(model, **fields) -> bool:
+    # Rows that must exist at most once are backed by unique constraints,
+    # so concurrent requests race on the insert instead of on a lock.
+    try:
+        with transaction.atomic():
+            model.objects.create(**fields)
+        return True
+    except IntegrityError:
+        return False
+
+
 def _apply_action(cards: list[CardType], action: Action):
     cards = cards.copy()
     if action.is_swap():
@@ -102,44 +144,186 @@ def _apply_action(cards: list[CardType], action: Action):
     return cards
 
 
+def state_json(game_state: GameState, player_id: int):
+    if game_state.stage == GameStage.BEGINNING:
+        game = game_state.game
+        return {
+            "cards_to_show": [
+                role if player_id * CARDS_PER_PLAYER <= i < (player_id + 1) * CARDS_PER_PLAYER else None
+                for i, role in enumerate(game.roles)
+            ]
+        }
+    if game_state.stage == GameStage.BROTHERS:
+        game = game_state.game
+        players_to_show = []
+        roles = game_state.game.roles
+        for i in range(PLAYERS):
+            player_roles = roles[i * CARDS_PER_PLAYER: (i + 1) * CARDS_PER_PLAYER]
+            if CardType.BROTHERS_1.value in player_roles or \
+                    CardType.BROTHERS_2.value in player_roles or \
+                    CardType.COPY.value in player_roles and \
+                    (game.copied_role == CardType.BROTHERS_1.value or game.copied_role == CardType.BROTHERS_2):
+                players_to_show.append(i)
+        return {
+            "players_to_show": players_to_show
+        }
+    if game_state.stage == GameStage.SHOOTING:
+        return {
+            "cards_shot": _cards_shot(game_state.game)
+        }
+    action = game_state.get_action()
+    if not action:
+        return None
+    result = {"cards_to_show": [
+        card if i in action.cards_to_show else None for i, card in enumerate(action.game_state.cards)
+    ]}
+    if action.is_swap():
+        result["swap"] = [action.swap_card_a, action.swap_card_b]
+    if action.is_auto:
+        result["auto"] = True
+    return result
+
+
+def make_brothers_indistinguishable(state_view):
+    if state_view and "cards_to_show" in state_view:
+        state_view = state_view.copy()
+        cards_to_show = state_view["cards_to_show"]
+        for i in range(len(cards_to_show)):
+            if cards_to_show[i] == CardType.BROTHERS_1.value or cards_to_show[i] == CardType.BROTHERS_2.value:
+                cards_to_show[i] = CardType.BROTHERS_1.value[:-2]  # brothers_1 -> brothers
+    return state_view
+
+
+def _materialize_views(game_state: GameState) -> None:
+    # Once the next state exists, what each seat can see of this one never changes again.
+    if game_state.stage >= GameStage.SHOOTING:
+        return
+    StateView.objects.bulk_create([
+        StateView(
+            state=game_state,
+            player_id=player_id,
+            json=json.dumps(make_brothers_indistinguishable(state_json(game_state, player_id)))
+        )
+        for player_id in range(PLAYERS)
+    ], ignore_conflicts=True)
+
+
+def finished_histories(game: Game) -> list[dict]:
+    # once the game is over every stage is revealed: its view plus the cards it was played on, per seat
+    histories = [{} for _ in range(PLAYERS)]
+    shooting_view = {"cards_shot": _cards_shot(game)}
+    for state in game.history.filter(stage__lte=GameStage.FINISHED).select_related('action').order_by('stage'):
+        for player_id, history in enumerate(histories):
+            if state.stage == GameStage.FINISHED:
+                view = {"cards_to_show": state.cards}
+            elif state.stage == GameStage.SHOOTING:
+                view = {**shooting_view, "cards_to_show": state.cards}
+            else:
+                view = state_json(state, player_id)
+                if not state.get_action() or state.action.is_swap():
+                    view = {**(view or {}), "cards_to_show": state.cards}
+            history[state.stage] = make_brothers_indistinguishable(view)
+    return histories
+
+
+def _materialize_finished_views(game: Game) -> None:
+    # the whole finished history of each seat is stored on the FINISHED state, get_history sends it as-is
+    finished_state = GameState.objects.get(game=game, stage=GameStage.FINISHED)
+    StateView.objects.bulk_create([
+        StateView(state=finished_state, player_id=player_id, json=json.dumps(history))
+        for player_id, history in enumerate(finished_histories(game))
+    ], ignore_conflicts=True)
+
+
+@traced
 def try_create_next_state(game: Game) -> None:
     current_state = GameState.objects.get(game=game, stage=game.stage)
+    if game.stage == GameStage.SHOOTING and is_deadline_passed(game):
+        _auto_shoot(game)
     if GameState.objects.filter(game=game, stage=game.stage + 1).exists():
         return
+    if is_action_required(current_state) and current_state.get_action() is None and is_deadline_passed(game):
+        if _auto_play(game):
+            current_state = GameState.objects.get(game=game, stage=game.stage)
     if game.stage == GameStage.MILKMAN or (
             game.stage == GameStage.MILKMAN_COPY and game.copied_role == CardType.MILKMAN):
         milkman_index = game.roles.index(CardType.MILKMAN.value) \
             if game.stage == GameStage.MILKMAN else game.roles.index(CardType.COPY.value)
-        if milkman_index < PLAYERS * CARDS_PER_PLAYER:
-            Action.objects.create(
+        if milkman_index < PLAYERS * CARDS_PER_PLAYER and _create_once(
+                Action,
                 cards_to_show=[milkman_index],
                 swap_card_a=None,
                 swap_card_b=None,
                 game_state=current_state
-            )
+        ):
+            _action_recorded(current_state, milkman_index // CARDS_PER_PLAYER)
     if not is_action_required(current_state):
-        GameState.objects.create(
-            game=game,
-            stage=game.stage + 1,
-            cards=current_state.cards
-        )
+        if _create_once(
+                GameState,
+                game=game,
+                stage=game.stage + 1,
+                cards=current_state.cards
+        ):
+            _materialize_views(current_state)
     if is_action_required(current_state) and current_state.get_action() is not None:
         if game.stage == GameStage.COPY:
             game.copied_role = current_state.cards[current_state.action.cards_to_show[0]]
-            game.save()
-        GameState.objects.create(
-            game=game,
-            stage=game.stage + 1,
-            cards=_apply_action(current_state.cards, current_state.action)
-        )
+            game.save(update_fields=['copied_role'])
+        if _create_once(
+                GameState,
+                game=game,
+                stage=game.stage + 1,
+                cards=_apply_action(current_state.cards, current_state.action)
+        ):
+            _materialize_views(current_state)
+
+
+@traced
+def advance_stage(game: Game) -> bool:
+    write_behind.flush(GameState.objects.get(game=game, stage=game.stage).id)
+    # compare-and-swap: only the request that still sees the old stage moves the game on
+    advanced = Game.objects.filter(id=game.id, stage=game.stage).update(
+        stage=F('stage') + 1,
+        stage_timestamp=timezone.now()
+    ) == 1
+    game.refresh_from_db(fields=['stage', 'copied_role', 'stage_timestamp'])
+    if advanced:
+        snapshots.invalidate(game.room_id)
+        append_event(game.room_id, EventKind.STAGE_ADVANCED, {"stage": game.stage})
+    if advanced and game.stage == GameStage.FINISHED:
+        resolve_game(game)
+    try_create_next_state(game)
+    return advanced
 
 
-def advance_stage(game: Game) -> None:
-    game.stage += 1
-    game.save()
-    try_create_next_state(game)
+@traced
+def try_advance_stage(game: Game) -> None:
+    for _ in range(MAX_ADVANCE_ATTEMPTS):
+        try_create_next_state(game)
+        if not check_advance_stage(game) or advance_stage(game):
+            return
+
+
+@traced
+def record_action(action: Action, player_id: int) -> None:
+    try:
+        with transaction.atomic():
+            action.save()
+    except IntegrityError:
+        raise InvalidSelectedCardsException  # the stage already has an action
+    _action_recorded(action.game_state, player_id)
 
 
+def _action_recorded(game_state: GameState, player_id: int) -> None:
+    # only the acting seat sees what its action showed
+    snapshots.invalidate(game_state.game.room_id)
+    append_event(game_state.game.room_id, EventKind.ACTION_RECORDED, {
+        "stage": game_state.stage,
+        "view": make_brothers_indistinguishable(state_json(game_state, player_id)),
+    }, player_id=player_id)
+
+
+@traced
 def get_accessible_stages(game: Game, player_id: int) -> list[GameStage]:
     player_roles = game.roles[player_id * CARDS_PER_PLAYER: (player_id + 1) * CARDS_PER_PLAYER]
     player_stages = [GameStage.BEGINNING] + [ROLE_TO_STAGE[role] for role in player_roles if role in ROLE_TO_STAGE]
@@ -150,6 +334,7 @@ def get_accessible_stages(game: Game, player_id: int) -> list[GameStage]:
     return player_stages
 
 
+@traced
 def check_action(game: Game, player_id: int, action: Action) -> bool:
     if game.stage not in get_accessible_stages(game, player_id):
         return False
@@ -222,7 +407,8 @@ def check_action(game: Game, player_id: int, action: Action) -> bool:
                     not action.is_swap())
 
 
-def selected_cards_to_action(game: Game, player_id: int, selected_cards: list[int]) -> Action:
+def _selection_to_action(game: Game, selected_cards: list[int]) -> Action:
+    # the action the selection stands for at the game's stage, not yet checked against the rules
     roles = game.roles
     match game.stage:
         case GameStage.BEGINNING | GameStage.SHOOTING | GameStage.FINISHED | GameStage.BROTHERS | GameStage.MILKMAN | GameStage.MILKMAN_COPY:
@@ -267,13 +453,97 @@ def selected_cards_to_action(game: Game, player_id: int, selected_cards: list[in
             )
         case _:
             raise ValueError("Unknown game stage")
+    return action
+
 
+@traced
+def selected_cards_to_action(game: Game, player_id: int, selected_cards: list[int]) -> Action:
+    action = _selection_to_action(game, selected_cards)
     action.game_state = GameState.objects.get(game=game, stage=game.stage)
     if not check_action(game, player_id, action):
         raise InvalidSelectedCardsException
     return action
 
 
+@traced
+def is_deadline_passed(game: Game) -> bool:
+    timeout = game.room.action_timeout
+    return timeout is not None and (timezone.now() - game.stage_timestamp).total_seconds() >= timeout
+
+
+def _acting_player(game: Game) -> int | None:
+    if game.stage in ROLE_COPY_TO_STAGE.values() and game.stage not in ROLE_TO_STAGE.values():
+        card = CardType.COPY.value
+    else:
+        card = STAGE_TO_ROLE.get(game.stage)
+    if card is None:
+        return None
+    card_idx = game.roles.index(card)
+    if card_idx >= PLAYERS * CARDS_PER_PLAYER:
+        return None
+    return card_idx // CARDS_PER_PLAYER
+
+
+def legal_selections(game: Game, player_id: int) -> list[tuple[list[int], Action]]:
+    # Every selection the seat could submit now, with the action it stands for. The actions are not
+    # attached to the state yet: the relation is one-to-one, so attaching one replaces the state's action.
+    if game.stage not in get_accessible_stages(game, player_id):
+        return []
+    selections = []
+    for selected_cards in _CANDIDATE_SELECTIONS:
+        try:
+            action = _selection_to_action(game, selected_cards)
+        except (InvalidSelectedCardsException, IndexError):
+            continue
+        if check_action(game, player_id, action):
+            selections.append((selected_cards, action))
+    return selections
+
+
+def legal_actions(game: Game, player_id: int) -> list[Action]:
+    return [action for _, action in legal_selections(game, player_id)]
+
+
+def _auto_play(game: Game) -> bool:
+    player_id = _acting_player(game)
+    if player_id is None:
+        return False
+    actions = legal_actions(game, player_id)
+    if not actions:
+        return False
+    action = random.choice(actions)
+    action.game_state = GameState.objects.get(game=game, stage=game.stage)
+    action.is_auto = True
+    try:
+        record_action(action, player_id)
+    except InvalidSelectedCardsException:
+        pass  # the player (or another request) got there first
+    return True
+
+
+def _auto_shoot(game: Game) -> None:
+    shooters = set(CardShot.objects.filter(game=game).values_list('shooter_id', flat=True))
+    shot = [
+        player_id for player_id in range(game.room.players.count())
+        if player_id not in shooters
+        and _create_once(CardShot, game=game, shooter_id=player_id, card_index=-1, is_auto=True)
+    ]
+    if shot:
+        snapshots.invalidate(game.room_id)
+    for player_id in shot:
+        append_event(game.room_id, EventKind.CARD_SHOT, {"shooter": player_id, "card": -1, "auto": True})
+
+
+def is_input_expected(game: Game, player_id: int) -> bool:
+    if game.stage == GameStage.SHOOTING:
+        return not CardShot.objects.filter(game=game, shooter_id=player_id).exists()
+    if _acting_player(game) != player_id:
+        return False
+    current_state = GameState.objects.get(game=game, stage=game.stage)
+    return is_action_required(current_state) and current_state.get_action() is None \
+        and game.stage not in (GameStage.MILKMAN, GameStage.MILKMAN_COPY)
+
+
 def can_shoot(game: Game, player_id: int, card_id: int) -> bool:
     if game.stage != GameStage.SHOOTING:
         return False
@@ -290,11 +560,98 @@ def can_shoot(game: Game, player_id: int, card_id: int) -> bool:
     return True
 
 
-def _shoot(game: Game, player_id: int, card_id: int) -> None:
-    CardShot.objects.create(game=game, shooter_id=player_id, card_index=card_id)
+def _shoot(game: Game, player_id: int, card_id: int) -> bool:
+    if not _create_once(CardShot, game=game, shooter_id=player_id, card_index=card_id):
+        return False
+    snapshots.invalidate(game.room_id)
+    return True
 
 
+@traced
 def try_shoot(game: Game, player_id: int, card_id: int) -> None:
-    if not can_shoot(game, player_id, card_id):
+    if not can_shoot(game, player_id, card_id) or not _shoot(game, player_id, card_id):
         raise InvalidSelectedCardsException
-    _shoot(game, player_id, card_id)
+    append_event(game.room_id, EventKind.CARD_SHOT, {"shooter": player_id, "card": card_id})
+
+
+def _cards_shot(game: Game) -> list[int | None]:
+    cards_shot = [None] * PLAYERS
+    for shooter_id, card_index in CardShot.objects.filter(game=game).values_list('shooter_id', 'card_index'):
+        cards_shot[shooter_id] = card_index
+    return cards_shot
+
+
+def _team(player_cards: list[CardType]) -> Team:
+    if CardType.MAFIA.value in player_cards:
+        return Team.MAFIA
+    if CardType.SUICIDE.value in player_cards:
+        return Team.SUICIDE
+    return Team.TOWN
+
+
+def compute_result(cards: list[CardType], cards_shot: list[int | None]) -> dict:
+    player_cards = [cards[i * CARDS_PER_PLAYER: (i + 1) * CARDS_PER_PLAYER] for i in range(PLAYERS)]
+    teams = [_team(player_cards[i]) for i in range(PLAYERS)]
+    hit_cards = [idx for idx in cards_shot if idx is not None and idx != -1]
+    players_shot = [False] * PLAYERS
+    for idx in hit_cards:
+        players_shot[idx // CARDS_PER_PLAYER] = True
+    hit_roles = [cards[idx] for idx in hit_cards]
+
+    if CardType.SUICIDE.value in hit_roles:
+        winning_team = Team.SUICIDE
+    elif CardType.MAFIA.value in hit_roles:
+        winning_team = Team.TOWN
+    elif Team.MAFIA in teams:
+        winning_team = Team.MAFIA
+    elif not hit_cards:
+        winning_team = Team.TOWN  # mafia is in the discard and nobody innocent was shot
+    else:
+        winning_team = None
+
+    return {
+        "winning_team": winning_team,
+        "final_roles": cards,
+        "teams": teams,
+        "cards_shot": cards_shot,
+        "players_shot": players_shot,
+        "winners": [team == winning_team for team in teams],
+    }
+
+
+def _update_stats(result: GameResult) -> None:
+    won_roles, lost_roles = [], []
+    for i in range(PLAYERS):
+        player_roles = result.final_roles[i * CARDS_PER_PLAYER: (i + 1) * CARDS_PER_PLAYER]
+        (won_roles if result.winners[i] else lost_roles).extend(player_roles)
+    won_users = [user_id for user_id, won in zip(result.users, result.winners) if won]
+    lost_users = [user_id for user_id, won in zip(result.users, result.winners) if not won]
+
+    RoleStats.objects.bulk_create([RoleStats(role=role) for role in won_roles + lost_roles], ignore_conflicts=True)
+    RoleStats.objects.filter(role__in=won_roles).update(games=F('games') + 1, wins=F('wins') + 1)
+    RoleStats.objects.filter(role__in=lost_roles).update(games=F('games') + 1)
+
+    UserStats.objects.bulk_create([UserStats(user_id=user_id) for user_id in result.users], ignore_conflicts=True)
+    UserStats.objects.filter(user_id__in=won_users).update(games=F('games') + 1, wins=F('wins') + 1)
+    UserStats.objects.filter(user_id__in=lost_users).update(games=F('games') + 1)
+
+    update_ratings(result)
+
+
+@traced
+def resolve_game(game: Game) -> GameResult:
+    if hasattr(game, 'result'):
+        return game.result
+    final_state = GameState.objects.get(game=game, stage=GameStage.FINISHED)
+    cards_shot = _cards_shot(game)
+    users = list(game.room.players.order_by('join_timestamp').values_list('user_id', flat=True))
+
+    with transaction.atomic():
+        result, created = GameResult.objects.get_or_create(
+            game=game,
+            defaults={"users": users, **compute_result(final_state.cards, cards_shot)}
+        )
+        if created:
+            _update_stats(result)
+            _materialize_finished_views(game)
+    return result
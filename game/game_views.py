@@ -1,161 +1,201 @@
+import functools
 import json
 
-from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_POST, require_GET
 
-from game.exceptions import UserNotInRoomException
-from game.game_logic import mark_read_by, check_advance_stage, advance_stage, CARDS_PER_PLAYER, PLAYERS, \
-    get_accessible_stages, selected_cards_to_action, try_create_next_state, try_shoot
-from game.models import Room, GameStage, GameState, CardType, CardShot
-from game.view_utils import smart_view, require_room_exists, require_game_started, require_user_in_room
+from game import snapshots
+from game.admission import admission, MOVE, POLL
+from game.idempotency import idempotent
+from game.exceptions import UserNotInRoomException, InvalidRequestException, GameException
+from game.game_logic import mark_read_by, try_advance_stage, get_accessible_stages, selected_cards_to_action, \
+    try_create_next_state, try_shoot, record_action, state_json, make_brothers_indistinguishable, is_input_expected, \
+    finished_histories
+from game.models import GameStage, GameState, StateView
+from game.rate_limit import rate_limit
+from game.replica import read_replica, pin_to_primary
+from game.single_flight import SingleFlight
+from game.view_utils import smart_view, require_room_exists, require_game_started, require_user_in_room, \
+    get_context
+
+_stage_flights = SingleFlight()
+
+
+def stage_flight_count() -> int:
+    return len(_stage_flights)
+
+
+def answer_from_snapshot(view):
+    # the shared snapshot answers polls that would find nothing to do without touching the database
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        context = get_context(request)
+        stage = None
+        if context.room_id is not None and request.user.is_authenticated:
+            stage = snapshots.poll(context.room_id, request.user.id)
+        if stage is None:
+            return view(request, *args, **kwargs)
+        return JsonResponse({"game_stage": stage}, status=200)
+
+    return wrapper
 
 
 @require_POST
 @csrf_protect
-@smart_view
+@rate_limit("game_stage")
+@admission("game_stage")
+@smart_view(lock_room=False)
+@answer_from_snapshot
 @require_room_exists
 @require_game_started
 @require_user_in_room
 def get_game_stage(request):
-    room_id = json.loads(request.body).get("room_id")
-    room = Room.objects.get(id=room_id)
-    game = room.game
+    context = get_context(request)
+    _poll_stage(context, request.user)
+    return JsonResponse({"game_stage": context.game.stage}, status=200)
+
+
+def _poll_stage(context, user):
+    game = context.game
+
+    def advance():
+        try_advance_stage(game)
+        return game.stage
+
+    # players and spectators of a room poll together; one of them advances the game for everybody
+    game.stage = _stage_flights.do((context.room_id, game.stage, "game_stage"), advance)
+    mark_read_by(game, user)
+    snapshots.refresh(context.room_id, [player.user_id for player in context.players])
+
+
+def _live_history_fragments(game, player_id, since_stage=GameStage.BEGINNING) -> dict:
+    # {stage: serialized view} of the stages this seat can see, from since_stage on
+    stages = [stage for stage in dict.fromkeys(get_accessible_stages(game, player_id)) if stage >= since_stage]
+    fragments = dict(StateView.objects.filter(
+        state__game=game,
+        state__stage__in=[stage for stage in stages if stage <= game.stage],
+        player_id=player_id
+    ).values_list('state__stage', 'json'))
+    for stage in stages:
+        if stage > game.stage:
+            fragments[stage] = "null"
+        elif stage not in fragments:  # still in progress, or stored before views were materialized
+            fragments[stage] = json.dumps(
+                make_brothers_indistinguishable(state_json(game.history.get(stage=stage), player_id)))
+    return {stage: fragments[stage] for stage in stages}
 
-    try_create_next_state(game)
-    if check_advance_stage(game):
-        advance_stage(game)
-    mark_read_by(game, request.user)
-
-    return JsonResponse({"game_stage": game.stage}, status=200)
-
-
-def _state_json(game_state: GameState, user: User):
-    if game_state.stage == GameStage.BEGINNING:
-        game = game_state.game
-        player_id = game.room.players.get(user=user).position
-        return {
-            "cards_to_show": [
-                role if player_id * CARDS_PER_PLAYER <= i < (player_id + 1) * CARDS_PER_PLAYER else None
-                for i, role in enumerate(game.roles)
-            ]
-        }
-    if game_state.stage == GameStage.BROTHERS:
-        game = game_state.game
-        players_to_show = []
-        roles = game_state.game.roles
-        for i in range(PLAYERS):
-            player_roles = roles[i * CARDS_PER_PLAYER: (i + 1) * CARDS_PER_PLAYER]
-            if CardType.BROTHERS_1.value in player_roles or \
-                    CardType.BROTHERS_2.value in player_roles or \
-                    CardType.COPY.value in player_roles and \
-                    (game.copied_role == CardType.BROTHERS_1.value or game.copied_role == CardType.BROTHERS_2):
-                players_to_show.append(i)
-        return {
-            "players_to_show": players_to_show
-        }
-    if game_state.stage == GameStage.SHOOTING:
-        game = game_state.game
-        result = [None] * PLAYERS
-        for player_id in range(PLAYERS):
-            card_shots = CardShot.objects.filter(game=game, shooter_id=player_id)
-            if card_shots.exists():
-                result[player_id] = card_shots.get().card_index
-        return {
-            "cards_shot": result
-        }
-    action = game_state.get_action()
-    if not action:
-        return None
-    result = {"cards_to_show": [
-        card if i in action.cards_to_show else None for i, card in enumerate(action.game_state.cards)
-    ]}
-    if action.is_swap():
-        result["swap"] = [action.swap_card_a, action.swap_card_b]
-    return result
-
-
-def _make_brothers_indistinguishable(state_json):
-    if state_json and "cards_to_show" in state_json:
-        state_json = state_json.copy()
-        cards_to_show = state_json["cards_to_show"]
-        for i in range(len(cards_to_show)):
-            if cards_to_show[i] == CardType.BROTHERS_1.value or cards_to_show[i] == CardType.BROTHERS_2.value:
-                cards_to_show[i] = CardType.BROTHERS_1.value[:-2]  # brothers_1 -> brothers
-    return state_json
+
+def _finished_history_fragment(game, player_id) -> str:
+    fragment = StateView.objects.filter(
+        state__game=game, state__stage=GameStage.FINISHED, player_id=player_id
+    ).values_list('json', flat=True).first()
+    # games resolved before finished views were stored
+    return fragment if fragment is not None else json.dumps(finished_histories(game)[player_id])
+
+
+def _join_fragments(fragments: dict) -> str:
+    return "{" + ", ".join(f'"{stage}": {fragment}' for stage, fragment in fragments.items()) + "}"
 
 
 @require_GET
+@read_replica
 @csrf_protect
-@smart_view
+@rate_limit("game_history")
+@admission("game_history")
+@smart_view(lock_room=False)
 @require_room_exists
 @require_game_started
 def get_history(request):
-    room_id = request.GET.get("room_id")
-    room = Room.objects.get(id=room_id)
-    game = room.game
+    context = get_context(request)
+    game = context.game
+    player_id = context.player_id
+    if player_id is None:
+        raise UserNotInRoomException
 
     if game.stage != GameStage.FINISHED:
-        user = request.user
-        if not room.players.filter(user=user).exists():
-            raise UserNotInRoomException
-        result = {}
-        for stage in get_accessible_stages(game, game.room.players.get(user=user).position):
-            result[stage] = _make_brothers_indistinguishable(_state_json(game.history.get(stage=stage), user)) \
-                if stage <= game.stage else None
-        return JsonResponse({
-            "history": result
-        }, status=200)
+        history = _join_fragments(_live_history_fragments(game, player_id))
     else:
-        result = {}
-        for stage, state_id in game.history.all().order_by('stage').values_list('stage', 'id'):
-            if stage >= GameStage.FINISHED:
-                break
-            state = GameState.objects.get(id=state_id)
-            result[stage] = _state_json(state, room.players.get(user=request.user).user)
-            if not state.get_action() or state.action.is_swap():
-                if result[stage] is None:
-                    result[stage] = {}
-                result[stage]["cards_to_show"] = state.cards
-            result[stage] = _make_brothers_indistinguishable(result[stage])
-        result[GameStage.FINISHED] = _make_brothers_indistinguishable({
-            "cards_to_show": game.history.get(stage=GameStage.FINISHED).cards
-        })
-        return JsonResponse({
-            "history": result
-        }, status=200)
+        history = _finished_history_fragment(game, player_id)
+    return HttpResponse(f'{{"history": {history}}}', content_type="application/json", status=200)
 
 
 @require_POST
 @csrf_protect
-@smart_view
+@pin_to_primary
+@idempotent("submit_action")
+@admission("submit_action", priority=MOVE)
+@smart_view(lock_room=False)
 @require_room_exists
 @require_game_started
 @require_user_in_room
 def submit_action(request):
-    room_id = json.loads(request.body).get("room_id")
-    selected_cards = json.loads(request.body).get("selected_cards")
-    room = Room.objects.get(id=room_id)
-    game = room.game
-    player_id = room.players.get(user=request.user).position
-    action = selected_cards_to_action(game, player_id, selected_cards)
-    action.save()
+    context = get_context(request)
+    selected_cards = context.data.get("selected_cards")
+    game = context.game
+    action = selected_cards_to_action(game, context.player_id, selected_cards)
+    record_action(action, context.player_id)
     try_create_next_state(game)
     return JsonResponse({"detail": "Action recorded"}, status=200)
 
 
 @require_POST
 @csrf_protect
-@smart_view
+@pin_to_primary
+@idempotent("shoot_card")
+@admission("shoot_card", priority=MOVE)
+@smart_view(lock_room=False)
 @require_room_exists
 @require_game_started
 @require_user_in_room
 def shoot_card(request):
-    room_id = json.loads(request.body).get("room_id")
-    card_position = json.loads(request.body).get("card_position")
-    room = Room.objects.get(id=room_id)
-    game = room.game
-    player_id = room.players.get(user=request.user).position
-    try_shoot(game, player_id, card_position)
-    return JsonResponse({"detail": "Shot recorded"}, status=200)
\ No newline at end of file
+    context = get_context(request)
+    card_position = context.data.get("card_position")
+    try_shoot(context.game, context.player_id, card_position)
+    return JsonResponse({"detail": "Shot recorded"}, status=200)
+
+
+def _sync_has_move(data):
+    return "selected_cards" in data or "card_position" in data
+
+
+@require_POST
+@csrf_protect
+@pin_to_primary(when=lambda request: _sync_has_move(get_context(request).data))
+@rate_limit("sync")
+@admission("sync", priority=lambda context: MOVE if _sync_has_move(context.data) else POLL)
+@smart_view(lock_room=False)
+@require_room_exists
+@require_game_started
+@require_user_in_room
+def sync(request):
+    # One round-trip per client tick: optionally act or shoot, poll the stage, and get back the
+    # history entries from last_stage on plus whether this seat is expected to act.
+    context = get_context(request)
+    game = context.game
+    player_id = context.player_id
+    last_stage = context.data.get("last_stage", int(GameStage.BEGINNING))
+    if type(last_stage) is not int:
+        raise InvalidRequestException
+
+    result = {}
+    try:
+        if "selected_cards" in context.data:
+            record_action(selected_cards_to_action(game, player_id, context.data["selected_cards"]), player_id)
+            try_create_next_state(game)
+        elif "card_position" in context.data:
+            try_shoot(game, player_id, context.data["card_position"])
+    except GameException as e:
+        result["action_error"] = e.details
+
+    _poll_stage(context, request.user)
+    result["game_stage"] = game.stage
+    result["input_expected"] = is_input_expected(game, player_id)
+    response = json.dumps(result)[:-1]  # history fragments are already serialized and get spliced in below
+
+    if game.stage == GameStage.FINISHED:
+        history = _finished_history_fragment(game, player_id) if last_stage < GameStage.FINISHED else "{}"
+    else:
+        # the entry for last_stage itself is included again, its action may have been recorded since
+        history = _join_fragments(_live_history_fragments(game, player_id, since_stage=last_stage))
+    return HttpResponse(f'{response}, "history": {history}}}', content_type="application/json", status=200)
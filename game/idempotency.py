@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from game.exceptions import IdempotencyKeyReusedException, InvalidRequestException
+from game.single_flight import SingleFlight
+
+IDEMPOTENCY_HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_MAX_KEYS = 10000
+
+
+class _Stored:
+    __slots__ = ("expires_at", "body_hash", "status", "content", "content_type")
+
+    def __init__(self, expires_at, body_hash, response):
+        self.expires_at = expires_at
+        self.body_hash = body_hash
+        self.status = response.status_code
+        self.content = response.content
+        self.content_type = response["Content-Type"]
+
+    def response(self) -> HttpResponse:
+        response = HttpResponse(self.content, status=self.status, content_type=self.content_type)
+        response[REPLAYED_HEADER] = "true"
+        return response
+
+
+class IdempotencyStore:
+    # {(user_id, endpoint, key): _Stored}. Every entry lives for the same ttl, so insertion order is
+    # expiry order and both expired and surplus entries are dropped from the front.
+
+    def __init__(self, ttl_seconds, max_keys):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _evict(self, now):
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires_at > now and len(self._entries) <= self.max_keys:
+                break
+            self._entries.popitem(last=False)
+
+    def get(self, key) -> _Stored | None:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            return self._entries.get(key)
+
+    def put(self, key, body_hash, response) -> _Stored:
+        now = time.monotonic()
+        stored = _Stored(now + self.ttl_seconds, body_hash, response)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = stored
+            self._evict(now)
+        return stored
+
+    def __len__(self):
+        return len(self._entries)
+
+
+store = IdempotencyStore(
+    getattr(settings, "IDEMPOTENCY_TTL_SECONDS", DEFAULT_TTL_SECONDS),
+    getattr(settings, "IDEMPOTENCY_MAX_KEYS", DEFAULT_MAX_KEYS),
+)
+_flights = SingleFlight()
+
+
+def flight_count() -> int:
+    return len(_flights)
+
+
+def _is_final(response) -> bool:
+    # shed and rate limited requests did not run, a retry has to run them
+    return response.status_code < 500 and response.status_code != 429
+
+
+def idempotent(endpoint):
+    # Requests with an Idempotency-Key header run once per (user, endpoint, key). A retry gets the stored
+    # response back without touching the game, a retry sent while the first request is still running
+    # waits for it, and reusing a key with another body is refused. Keys are kept per process.
+    def decorator(view):
+        def new_view(request, *args, **kwargs):
+            key = request.META.get(IDEMPOTENCY_HEADER)
+            if not key or not request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return JsonResponse({"detail": InvalidRequestException.details}, status=InvalidRequestException.code)
+            store_key = (request.user.id, endpoint, key)
+            body_hash = hashlib.sha256(request.body).digest()
+            ran = []  # the response, if this request is the one that runs the view
+
+            def run():
+                stored = store.get(store_key)
+                if stored is not None:
+                    return stored
+                response = view(request, *args, **kwargs)
+                ran.append(response)
+                return store.put(store_key, body_hash, response) if _is_final(response) else None
+
+            stored = _flights.do(store_key, run)
+            if ran:
+                return ran[0]
+            if stored is None:
+                return view(request, *args, **kwargs)  # the request this one waited for did not get to run
+            if stored.body_hash != body_hash:
+                return JsonResponse({"detail": IdempotencyKeyReusedException.details},
+                                    status=IdempotencyKeyReusedException.code)
+            return stored.response()
+
+        return new_view
+
+    return decorator
@@ -0,0 +1,49 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from game import benchmarks
+
+
+class Command(BaseCommand):
+    help = "Benchmark game_logic hot functions over every stage of seeded deals"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="bench_output.json")
+        parser.add_argument("--baseline", help="previous output to compare against")
+        parser.add_argument("--threshold", type=float, default=None,
+                            help="allowed relative slowdown before a timing counts as a regression, e.g. 0.2; "
+                                 "without it only query counts are compared")
+        parser.add_argument("--min-slowdown-us", type=float, default=benchmarks.DEFAULT_MIN_SLOWDOWN_US,
+                            help="slowdowns smaller than this never count as a regression, whatever the threshold")
+        parser.add_argument("--repeat", type=int, default=benchmarks.DEFAULT_REPEAT)
+        parser.add_argument("--rounds", type=int, default=benchmarks.DEFAULT_ROUNDS,
+                            help="timed rounds of --repeat calls, the fastest is kept")
+        parser.add_argument("--seeds", type=int, nargs="+", default=list(benchmarks.DEFAULT_SEEDS))
+
+    def handle(self, *args, **options):
+        # Run against a throwaway test database so the real one is never touched.
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Query logging would otherwise be included in every timing.
+            with override_settings(DEBUG=False):
+                report = benchmarks.run(seeds=options["seeds"], repeat=options["repeat"],
+                                        rounds=options["rounds"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+            regressions = benchmarks.compare(report, baseline, options["threshold"], options["min_slowdown_us"])
+            for line in regressions:
+                self.stderr.write(line)
+            if regressions:
+                raise CommandError(f"{len(regressions)} regression(s) against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions"))
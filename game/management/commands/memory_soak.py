@@ -0,0 +1,95 @@
+import json
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from game import memory, playthrough, rate_limit
+from game.game_logic import PLAYERS
+from game.models import Room
+
+
+class _Player:
+    # Sends requests straight through the handler's middleware and views. The test Client would
+    # reconnect a signal receiver on every request, which tracemalloc reports as a leak of its own.
+
+    def __init__(self, handler, user):
+        self.handler = handler
+        self.factory = RequestFactory()
+        client = Client()
+        client.force_login(user)
+        self.cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+    def _send(self, request):
+        request._dont_enforce_csrf_checks = True
+        return json.loads(self.handler.get_response(request).content or "{}")
+
+    def get(self, path, data):
+        return self._send(self.factory.get(path, data, HTTP_COOKIE=self.cookie))
+
+    def post(self, path, data):
+        return self._send(self.factory.post(path, json.dumps(data), content_type="application/json",
+                                            HTTP_COOKIE=self.cookie))
+
+
+def _play(players, number):
+    room_id = players[0].post("/create_room/", {"room_name": f"soak-{number}", "action_timeout": None})["id"]
+    Room.objects.filter(id=room_id).update(min_move_time=0)
+    for player in players[1:]:
+        player.post("/join_room/", {"room_id": room_id})
+    players[0].post("/start_game/", {"room_id": room_id})
+    playthrough.play(lambda player_id, method, path, data: getattr(players[player_id], method)(f"/{path}", data),
+                     room_id)
+    players[0].get("/game_result/", {"room_id": room_id})
+
+
+class Command(BaseCommand):
+    help = "Play games through the HTTP views in-process and report memory growth and registry sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=1000)
+        parser.add_argument("--report-every", type=int, default=100)
+        parser.add_argument("--top", type=int, default=5, help="allocation sites per report")
+        parser.add_argument("--output", help="also append every full report to this file as JSON lines")
+
+    def handle(self, *args, **options):
+        # Run against a throwaway test database so the real one is never touched.
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        limits = {endpoint: (10 ** 9, 10 ** 9) for endpoint in rate_limit.limiter.limits}
+        try:
+            # the in-memory test database cannot take the write-behind flusher's concurrent writes
+            with override_settings(DEBUG=False, WRITE_BEHIND_FLUSH_MS=0), \
+                    mock.patch.object(rate_limit.limiter, "limits", limits):
+                self._soak(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _soak(self, options):
+        handler = WSGIHandler()
+        players = [_Player(handler, User.objects.create_user(f"soak_{i}")) for i in range(PLAYERS)]
+        _play(players, 0)  # warm up imports and caches before the baseline
+        baseline = memory.report(options["top"])
+        self._write(0, baseline, baseline, options)
+        for number in range(1, options["games"] + 1):
+            _play(players, number)
+            if number % options["report_every"] == 0 or number == options["games"]:
+                self._write(number, memory.report(options["top"]), baseline, options)
+
+    def _write(self, games, report, baseline, options):
+        registries = " ".join(f"{name}={size}" for name, size in report["registries"].items())
+        self.stdout.write(
+            f"games={games} traced_kb={report['traced_kb']} "
+            f"growth_kb={report['traced_kb'] - baseline['traced_kb']} max_rss_kb={report['max_rss_kb']} {registries}")
+        if games:
+            for site in report["top"]:
+                self.stdout.write(f"    {site['diff_kb']:+9.1f} kb {site['count_diff']:+7d}  {site['site']}")
+        if options["output"]:
+            with open(options["output"], "a") as f:
+                f.write(json.dumps({"games": games, **report}) + "\n")
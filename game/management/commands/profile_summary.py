@@ -0,0 +1,74 @@
+import glob
+import io
+import json
+import os
+import pstats
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+SORT_KEYS = ["cumulative", "tottime", "ncalls"]
+
+
+def _normalize_sql(sql):
+    # "... WHERE id = 5" and "... WHERE id = 7" are the same query for the summary
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+\b", "?", sql)
+    return re.sub(r"\(\?(?:, \?)+\)", "(...)", sql)
+
+
+class Command(BaseCommand):
+    help = "Summarise the hottest functions and queries across the dumps written by ProfilingMiddleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", default=None, help="dump directory (default PROFILE_DIR)")
+        parser.add_argument("--path", default=None, help="only dumps of requests to paths starting with this")
+        parser.add_argument("--sort", choices=SORT_KEYS, default="cumulative")
+        parser.add_argument("--limit", type=int, default=25)
+
+    def handle(self, *args, **options):
+        profile_dir = options["dir"] or getattr(settings, "PROFILE_DIR", settings.BASE_DIR / "profiles")
+        dumps = []
+        for meta_path in sorted(glob.glob(os.path.join(profile_dir, "profile-*.json"))):
+            stats_path = meta_path[:-len(".json")] + ".prof"
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue  # rotated away or half written
+            if os.path.exists(stats_path) and meta["path"].startswith(options["path"] or ""):
+                dumps.append((stats_path, meta))
+        if not dumps:
+            raise CommandError(f"No profile dumps in {profile_dir}")
+
+        self._requests(dumps)
+        self._functions([stats_path for stats_path, _ in dumps], options["sort"], options["limit"])
+        self._queries([meta for _, meta in dumps], options["limit"])
+
+    def _requests(self, dumps):
+        by_path = defaultdict(list)
+        for _, meta in dumps:
+            by_path[f"{meta['method']} {meta['path']}"].append(meta["ms"])
+        self.stdout.write(f"{len(dumps)} dumps\n")
+        for path, times in sorted(by_path.items(), key=lambda item: -max(item[1])):
+            self.stdout.write(f"  {len(times):5d}  max {max(times):9.1f} ms  avg {sum(times) / len(times):9.1f} ms  {path}")
+
+    def _functions(self, stats_paths, sort, limit):
+        output = io.StringIO()
+        stats = pstats.Stats(*stats_paths, stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        self.stdout.write("\nHottest functions")
+        self.stdout.write(output.getvalue().split("\n\n", 1)[-1].rstrip())
+
+    def _queries(self, metas, limit):
+        totals = defaultdict(lambda: [0, 0.0])  # {normalized sql: [count, ms]}
+        for meta in metas:
+            for query in meta["queries"]:
+                total = totals[_normalize_sql(query["sql"])]
+                total[0] += 1
+                total[1] += query["ms"]
+        self.stdout.write("\nHottest queries")
+        for sql, (count, ms) in sorted(totals.items(), key=lambda item: -item[1][1])[:limit]:
+            self.stdout.write(f"  {count:6d}  {ms:9.1f} ms  {sql}")
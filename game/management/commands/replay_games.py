@@ -0,0 +1,75 @@
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from game import replay
+from game.models import Game
+
+
+def _init_worker():
+    django.setup()  # a no-op after fork, needed where workers are spawned
+
+
+def _replay_chunk(game_ids, repeat):
+    mismatches, timings_us = {}, []
+    for recording in replay.load(game_ids):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            found = replay.verify(recording)
+            timings_us.append((time.perf_counter() - start) * 1e6)
+        if found:
+            mismatches[recording.game_id] = found
+    return mismatches, timings_us
+
+
+class Command(BaseCommand):
+    help = "Replay finished games from their seed and action log and check them against the stored states"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="0 to replay in this process")
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--limit", type=int, default=None, help="only the latest N games")
+        parser.add_argument("--repeat", type=int, default=1, help="replays per game, for benchmarking")
+        parser.add_argument("--show", type=int, default=20, help="mismatching games to print")
+
+    def handle(self, *args, **options):
+        game_ids = Game.objects.filter(seed__isnull=False, result__isnull=False).order_by('-id') \
+            .values_list('id', flat=True)
+        game_ids = list(game_ids[:options["limit"]] if options["limit"] else game_ids)
+        chunks = [game_ids[i:i + options["chunk_size"]] for i in range(0, len(game_ids), options["chunk_size"])]
+
+        start = time.perf_counter()
+        mismatches, timings_us = {}, []
+        if options["workers"]:
+            connections.close_all()  # forked workers must open their own connections
+            with ProcessPoolExecutor(options["workers"], initializer=_init_worker) as pool:
+                futures = [pool.submit(_replay_chunk, chunk, options["repeat"]) for chunk in chunks]
+                for future in as_completed(futures):
+                    chunk_mismatches, chunk_timings = future.result()
+                    mismatches.update(chunk_mismatches)
+                    timings_us.extend(chunk_timings)
+        else:
+            for chunk in chunks:
+                chunk_mismatches, chunk_timings = _replay_chunk(chunk, options["repeat"])
+                mismatches.update(chunk_mismatches)
+                timings_us.extend(chunk_timings)
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"{len(game_ids)} games, {len(timings_us)} replays in {elapsed:.2f} s "
+                          f"({len(timings_us) / elapsed if elapsed else 0:.0f} replays/s)")
+        if timings_us:
+            timings_us.sort()
+            self.stdout.write(
+                f"per replay: mean {statistics.mean(timings_us):.1f} us, p50 {timings_us[len(timings_us) // 2]:.1f} us, "
+                f"p95 {timings_us[int(len(timings_us) * 0.95)]:.1f} us, max {timings_us[-1]:.1f} us")
+        for game_id in sorted(mismatches)[:options["show"]]:
+            self.stdout.write(f"game {game_id}:")
+            for mismatch in mismatches[game_id]:
+                self.stdout.write(f"    {mismatch}")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} of {len(game_ids)} games do not replay")
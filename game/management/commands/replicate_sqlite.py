@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from game.replica import REPLICA_DB_ALIAS
+
+
+class Command(BaseCommand):
+    help = "Periodically copy the default SQLite database to the read replica (local testing shim)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=1.0, help="seconds between copies")
+        parser.add_argument("--once", action="store_true")
+
+    def handle(self, *args, **options):
+        if REPLICA_DB_ALIAS not in settings.DATABASES:
+            raise CommandError(f"No '{REPLICA_DB_ALIAS}' database configured (set MAFIA44_REPLICA_DB)")
+        source = str(settings.DATABASES["default"]["NAME"])
+        target = str(settings.DATABASES[REPLICA_DB_ALIAS]["NAME"])
+        while True:
+            self._copy(source, target)
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
+
+    @staticmethod
+    def _copy(source, target):
+        # Copy into a temporary file and swap it in, so readers never see a half-written replica.
+        tmp = f"{target}.tmp"
+        src = sqlite3.connect(source)
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        os.replace(tmp, target)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from game import warmup
+
+
+class Command(BaseCommand):
+    help = ("Load the URLconf and views, fill the host's snapshot cache with every unfinished game and "
+            "cache the first leaderboard page. Run before a host takes traffic; setting WARMUP_ON_BOOT does the "
+            "same in every server process.")
+
+    def handle(self, *args, **options):
+        for name, result in warmup.run().items():
+            self.stdout.write(f"{name}: {result['result']} in {result['ms']} ms")
@@ -0,0 +1,163 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from game.events import append_event
+from game.exceptions import UserAlreadyInRoomException
+from game.game_logic import PLAYERS, init_game
+from game.models import GameStage, Room, Player, EventKind
+
+MAX_REMEMBERED_MATCHES = 65536
+WAIT_TIMEOUT_SECONDS = 60
+
+
+class Matchmaker:
+    # Waiting users are kept in one insertion-ordered dict per min_move_time pool, so joining,
+    # leaving and taking the next group are all O(1) regardless of how many users are waiting.
+    # Users who stopped polling their status are dropped when they reach the head of their pool
+    # rather than being seated in a room nobody will play in.
+
+    def __init__(self, seats=PLAYERS, max_remembered_matches=MAX_REMEMBERED_MATCHES,
+                 wait_timeout=WAIT_TIMEOUT_SECONDS):
+        self.seats = seats
+        self.max_remembered_matches = max_remembered_matches
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._pools = defaultdict(OrderedDict)  # {min_move_time: {user_id: time last seen}}
+        self._queued = {}  # {user_id: min_move_time}
+        self._matches = OrderedDict()  # {user_id: room_id}
+
+    def enqueue(self, user_id, pool) -> list[int] | None:
+        # returns the user ids of a full group if this user completed one
+        now = time.monotonic()
+        with self._lock:
+            self._remove(user_id)
+            self._matches.pop(user_id, None)
+            waiting = self._pools[pool]
+            waiting[user_id] = now
+            self._queued[user_id] = pool
+            group = []
+            while len(group) < self.seats <= len(group) + len(waiting):
+                member, seen = waiting.popitem(last=False)
+                if now - seen > self.wait_timeout:
+                    del self._queued[member]
+                else:
+                    group.append((member, seen))
+            if len(group) < self.seats:
+                for member, seen in reversed(group):
+                    waiting[member] = seen
+                    waiting.move_to_end(member, last=False)
+                return None
+            for member, _ in group:
+                del self._queued[member]
+            if not waiting:
+                del self._pools[pool]
+            return [member for member, _ in group]
+
+    def requeue(self, group, pool):
+        # puts a group whose room could not be created back at the head of its pool
+        now = time.monotonic()
+        with self._lock:
+            waiting = self._pools[pool]
+            for user_id in reversed(group):
+                if user_id in self._queued:
+                    continue
+                waiting[user_id] = now
+                waiting.move_to_end(user_id, last=False)
+                self._queued[user_id] = pool
+
+    def matched(self, group, room_id):
+        with self._lock:
+            for user_id in group:
+                self._matches[user_id] = room_id
+                self._matches.move_to_end(user_id)
+            while len(self._matches) > self.max_remembered_matches:
+                self._matches.popitem(last=False)
+
+    def leave(self, user_id) -> bool:
+        with self._lock:
+            self._matches.pop(user_id, None)
+            return self._remove(user_id)
+
+    def status(self, user_id) -> dict:
+        with self._lock:
+            room_id = self._matches.get(user_id)
+            if room_id is not None:
+                return {"status": "matched", "room_id": room_id}
+            pool = self._queued.get(user_id)
+            if pool is None:
+                return {"status": "idle"}
+            now = time.monotonic()
+            waiting = self._pools[pool]
+            if now - waiting[user_id] > self.wait_timeout:
+                self._remove(user_id)
+                return {"status": "idle"}
+            waiting[user_id] = now
+            return {"status": "waiting", "min_move_time": pool, "waiting": len(waiting)}
+
+    def _remove(self, user_id) -> bool:
+        pool = self._queued.pop(user_id, None)
+        if pool is None:
+            return False
+        waiting = self._pools[pool]
+        del waiting[user_id]
+        if not waiting:
+            del self._pools[pool]
+        return True
+
+    def __len__(self):
+        return len(self._queued)
+
+    def match_count(self) -> int:
+        return len(self._matches)
+
+
+matchmaker = Matchmaker(wait_timeout=getattr(settings, "MATCHMAKING_WAIT_TIMEOUT_SECONDS", WAIT_TIMEOUT_SECONDS))
+
+
+def _create_match_room(users: list[User], min_move_time: int) -> Room:
+    creator = users[0]
+    now = timezone.now()
+    with transaction.atomic():
+        room = Room.objects.create(name=f"match-{secrets.token_hex(4)}", creator=creator, min_move_time=min_move_time)
+        # seats follow queue order, and Player.position is derived from join_timestamp
+        Player.objects.bulk_create([
+            Player(user=user, room=room, join_timestamp=now + timedelta(microseconds=index))
+            for index, user in enumerate(users)
+        ])
+        init_game(room)
+        append_event(room.id, EventKind.ROOM_CREATED, {
+            "name": room.name,
+            "creator": {"id": creator.id, "username": creator.username}
+        })
+        for user in users[1:]:
+            append_event(room.id, EventKind.PLAYER_JOINED, {"user": {"id": user.id, "username": user.username}})
+        append_event(room.id, EventKind.GAME_STARTED)
+    return room
+
+
+def enqueue(user: User, min_move_time: int) -> dict:
+    if Player.objects.filter(user=user).exclude(room__game__stage=GameStage.FINISHED).exists():
+        raise UserAlreadyInRoomException
+    group = matchmaker.enqueue(user.id, min_move_time)
+    if group is not None:
+        users = User.objects.in_bulk(group)
+        present = [user_id for user_id in group if user_id in users]
+        if len(present) < len(group):
+            # someone was deleted while waiting, the rest keep their place
+            matchmaker.requeue(present, min_move_time)
+        else:
+            try:
+                room = _create_match_room([users[user_id] for user_id in group], min_move_time)
+            except Exception:
+                matchmaker.requeue(group, min_move_time)
+                raise
+            matchmaker.matched(group, room.id)
+    return matchmaker.status(user.id)
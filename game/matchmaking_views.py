@@ -0,0 +1,47 @@
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import require_GET, require_POST
+
+from game import matchmaking
+from game.exceptions import InvalidRequestException, UserNotFoundException
+from game.matchmaking import matchmaker
+from game.models import DEFAULT_MIN_MOVE_TIME
+from game.rate_limit import rate_limit
+from game.replica import pin_to_primary
+from game.view_utils import smart_view, get_context
+
+
+def _require_user(request):
+    if not request.user.is_authenticated:
+        raise UserNotFoundException
+    return request.user
+
+
+@require_POST
+@csrf_protect
+@pin_to_primary
+@smart_view(lock_room=False)
+def enqueue(request):
+    user = _require_user(request)
+    min_move_time = get_context(request).data.get('min_move_time', DEFAULT_MIN_MOVE_TIME)
+    if type(min_move_time) is not int or min_move_time < 0:
+        raise InvalidRequestException
+    return JsonResponse(matchmaking.enqueue(user, min_move_time), status=200)
+
+
+@require_GET
+@csrf_protect
+@rate_limit("matchmaking_status")
+@smart_view(lock_room=False)
+def get_status(request):
+    user = _require_user(request)
+    return JsonResponse(matchmaker.status(user.id), status=200)
+
+
+@require_POST
+@csrf_protect
+@smart_view(lock_room=False)
+def leave(request):
+    user = _require_user(request)
+    matchmaker.leave(user.id)
+    return JsonResponse(matchmaker.status(user.id), status=200)
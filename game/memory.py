@@ -0,0 +1,76 @@
+import gc
+import os
+import resource
+import threading
+import tracemalloc
+
+from django.conf import settings
+
+from game import admission, game_views, idempotency, matchmaking, rate_limit, replica, view_utils, write_behind
+
+DEFAULT_TRACE_FRAMES = 1
+DEFAULT_TOP_SITES = 15
+
+_lock = threading.Lock()
+_previous = None  # snapshot the next report is compared against
+# allocations made by tracemalloc itself or while importing would only be noise
+_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def registry_sizes() -> dict:
+    # process-wide structures that grow with traffic; each should stay flat once the load is steady
+    return {
+        "room_locks": view_utils.room_lock_count(),
+        "rate_limit_buckets": len(rate_limit.limiter),
+        "stage_flights": game_views.stage_flight_count(),
+        "write_behind_pending": write_behind.pending_read_count(),
+        "write_behind_known": write_behind.known_read_count(),
+        "replica_pins": replica.pinned_user_count(),
+        "matchmaking_queued": len(matchmaking.matchmaker),
+        "matchmaking_matches": matchmaking.matchmaker.match_count(),
+        "admission_rooms": admission.controller.polled_room_count(),
+        "idempotency_keys": len(idempotency.store),
+        "idempotency_flights": idempotency.flight_count(),
+    }
+
+
+def _site_data(stat, compared) -> dict:
+    frame = stat.traceback[0]
+    data = {"site": f"{frame.filename}:{frame.lineno}", "kb": round(stat.size / 1024, 1), "count": stat.count}
+    if compared:
+        data["diff_kb"] = round(stat.size_diff / 1024, 1)
+        data["count_diff"] = stat.count_diff
+    return data
+
+
+def report(top: int = DEFAULT_TOP_SITES, reset: bool = True) -> dict:
+    # The first report only starts tracing (unless PYTHONTRACEMALLOC did at startup) and sets the
+    # baseline; later ones list the allocation sites that grew the most since the previous report.
+    global _previous
+    with _lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(getattr(settings, "MEMORY_TRACE_FRAMES", DEFAULT_TRACE_FRAMES))
+            _previous = None
+        gc.collect()  # garbage waiting for the cycle collector is not a leak
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        compared = _previous is not None
+        if compared:
+            stats = snapshot.compare_to(_previous, "lineno")
+        else:
+            stats = snapshot.statistics("lineno")
+        if reset or not compared:
+            _previous = snapshot
+    traced, peak = tracemalloc.get_traced_memory()
+    return {
+        "pid": os.getpid(),
+        "traced_kb": traced // 1024,
+        "traced_peak_kb": peak // 1024,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "registries": registry_sizes(),
+        "top": [_site_data(stat, compared) for stat in stats[:top]],
+    }
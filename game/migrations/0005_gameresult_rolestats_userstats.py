@@ -0,0 +1,50 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0004_remove_cardshot_shot_by_cardshot_shooter_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoleStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('copy', 'Copy'), ('thief', 'Thief'), ('brothers_1', 'Brothers 1'), ('brothers_2', 'Brothers 2'), ('seer', 'Seer'), ('brawler', 'Brawler'), ('drunkard', 'Drunkard'), ('witch', 'Witch'), ('milkman', 'Milkman'), ('mafia', 'Mafia'), ('suicide', 'Suicide')], unique=True)),
+                ('games', models.IntegerField(default=0)),
+                ('wins', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('winning_team', models.CharField(choices=[('town', 'Town'), ('mafia', 'Mafia'), ('suicide', 'Suicide')], null=True)),
+                ('users', models.JSONField()),
+                ('final_roles', models.JSONField()),
+                ('teams', models.JSONField()),
+                ('cards_shot', models.JSONField()),
+                ('players_shot', models.JSONField()),
+                ('winners', models.JSONField()),
+                ('game', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='result', to='game.game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('games', models.IntegerField(default=0)),
+                ('wins', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
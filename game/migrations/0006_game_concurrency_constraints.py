@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:53
+
+from django.db import migrations, models
+
+
+def remove_duplicates(apps, schema_editor):
+    # rows the constraints below would reject, left by requests that raced before they existed; the first one stays
+    GameState = apps.get_model('game', 'GameState')
+    CardShot = apps.get_model('game', 'CardShot')
+    for rows, key_fields in (
+            (GameState.objects.all(), ('game_id', 'stage')),
+            (CardShot.objects.all(), ('game_id', 'shooter_id')),
+            (CardShot.objects.filter(card_index__gte=0), ('game_id', 'card_index')),
+    ):
+        seen, duplicates = set(), []
+        for row_id, *key in rows.order_by('id').values_list('id', *key_fields):
+            if tuple(key) in seen:
+                duplicates.append(row_id)
+            seen.add(tuple(key))
+        rows.model.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0005_gameresult_rolestats_userstats'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cardshot',
+            constraint=models.UniqueConstraint(fields=('game', 'shooter_id'), name='unique_game_shooter'),
+        ),
+        migrations.AddConstraint(
+            model_name='cardshot',
+            constraint=models.UniqueConstraint(condition=models.Q(('card_index__gte', 0)), fields=('game', 'card_index'), name='unique_game_card_shot'),
+        ),
+        migrations.AddConstraint(
+            model_name='gamestate',
+            constraint=models.UniqueConstraint(fields=('game', 'stage'), name='unique_game_stage'),
+        ),
+    ]
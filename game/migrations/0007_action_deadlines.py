@@ -0,0 +1,40 @@
+# Generated by Django 5.2.5 on 2026-10-19 12:55
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0006_game_concurrency_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='is_auto',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='cardshot',
+            name='is_auto',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='stage_timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        # rooms that already exist keep playing without deadlines, only new rooms get the 60 s default
+        migrations.AddField(
+            model_name='room',
+            name='action_timeout',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='action_timeout',
+            field=models.IntegerField(default=60, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 13:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0007_action_deadlines'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateView',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('player_id', models.IntegerField()),
+                ('json', models.TextField()),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='views', to='game.gamestate')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('state', 'player_id'), name='unique_state_player_view')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2026-10-19 13:03
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0008_stateview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='event_seq',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='RoomEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.IntegerField()),
+                ('kind', models.CharField(choices=[('room_created', 'Room Created'), ('player_joined', 'Player Joined'), ('player_left', 'Player Left'), ('game_started', 'Game Started'), ('stage_advanced', 'Stage Advanced'), ('action_recorded', 'Action Recorded'), ('card_shot', 'Card Shot')])),
+                ('payload', models.JSONField(default=dict)),
+                ('player_id', models.IntegerField(null=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='game.room')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'seq'), name='unique_room_event_seq')],
+            },
+        ),
+    ]
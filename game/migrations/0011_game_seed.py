@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0010_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='seed',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
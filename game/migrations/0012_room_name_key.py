@@ -0,0 +1,45 @@
+# Generated by Django 5.2.5 on 2026-10-19 15:02
+
+from django.db import migrations, models
+
+MAX_NAME_LENGTH = 100
+
+
+def _name_key(name):
+    return " ".join(name.split()).casefold()  # models.room_name_key as of this migration
+
+
+def backfill_name_keys(apps, schema_editor):
+    # the oldest room keeps a name, later rooms whose name only differs in case or spacing get their id appended
+    Room = apps.get_model('game', 'Room')
+    taken = set()
+    for room in Room.objects.order_by('id'):
+        key = _name_key(room.name)
+        while key in taken:
+            suffix = f" ({room.id})"
+            room.name = room.name[:MAX_NAME_LENGTH - len(suffix)] + suffix
+            key = _name_key(room.name)
+        taken.add(key)
+        room.name_key = key
+        room.save(update_fields=['name', 'name_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0011_game_seed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='name_key',
+            field=models.CharField(max_length=300, null=True),
+        ),
+        migrations.RunPython(backfill_name_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='room',
+            name='name_key',
+            field=models.CharField(editable=False, max_length=300, unique=True),
+        ),
+    ]
@@ -1,8 +1,11 @@
 from django.contrib.auth.models import User
 from django.db import models
 from django.utils import timezone
+from django.utils.functional import cached_property
 
 DEFAULT_MIN_MOVE_TIME = 5
+DEFAULT_ACTION_TIMEOUT = 60
+INITIAL_RATING = 1500
 
 
 class GameStage(models.IntegerChoices):
@@ -39,10 +42,40 @@ class CardType(models.TextChoices):
     SUICIDE = 'suicide'
 
 
+class EventKind(models.TextChoices):
+    ROOM_CREATED = 'room_created'
+    PLAYER_JOINED = 'player_joined'
+    PLAYER_LEFT = 'player_left'
+    GAME_STARTED = 'game_started'
+    STAGE_ADVANCED = 'stage_advanced'
+    ACTION_RECORDED = 'action_recorded'
+    CARD_SHOT = 'card_shot'
+
+
+class Team(models.TextChoices):
+    TOWN = 'town'
+    MAFIA = 'mafia'
+    SUICIDE = 'suicide'
+
+
+def room_name_key(name: str) -> str:
+    # what room names are unique by and searched on: case and repeated whitespace do not count
+    return " ".join(name.split()).casefold()
+
+
 class Room(models.Model):
     name = models.CharField(max_length=100)
+    name_key = models.CharField(max_length=300, unique=True, editable=False)  # room_name_key(name), casefold() can lengthen it
     creator = models.ForeignKey(User, related_name='created_rooms', on_delete=models.CASCADE)
     min_move_time = models.IntegerField(default=DEFAULT_MIN_MOVE_TIME)
+    action_timeout = models.IntegerField(null=True, default=DEFAULT_ACTION_TIMEOUT)  # seconds, None disables
+    event_seq = models.IntegerField(default=0)  # seq of the last RoomEvent
+
+    def save(self, *args, **kwargs):
+        self.name_key = room_name_key(self.name)
+        if kwargs.get('update_fields') is not None and 'name' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'name_key'}
+        super().save(*args, **kwargs)
 
     def get_game(self):
         try:
@@ -55,9 +88,11 @@ class Game(models.Model):
     stage = models.IntegerField(choices=GameStage)
     copied_role = models.CharField(choices=CardType, null=True)
     room = models.OneToOneField(Room, related_name='game', on_delete=models.CASCADE)
+    stage_timestamp = models.DateTimeField(default=timezone.now)
+    seed = models.BigIntegerField(null=True)  # the deal is game_logic.deal(random.Random(seed)), None for older games
 
-    @property
-    def roles(self):
+    @cached_property
+    def roles(self):  # the deal never changes, so it is safe to keep for the lifetime of the instance
         return self.history.get(stage=GameStage.BEGINNING).cards
 
 
@@ -73,6 +108,30 @@ class GameState(models.Model):
         except Action.DoesNotExist:
             return None
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['game', 'stage'],
+                name='unique_game_stage'
+            )
+        ]
+
+
+class StateView(models.Model):
+    # what a seat sees of a finished stage, serialized once and sent as-is by get_history;
+    # on the FINISHED state it is the seat's whole history of the game
+    state = models.ForeignKey(GameState, related_name='views', on_delete=models.CASCADE)
+    player_id = models.IntegerField()
+    json = models.TextField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['state', 'player_id'],
+                name='unique_state_player_view'
+            )
+        ]
+
 
 class GameStageRead(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -93,6 +152,7 @@ class Action(models.Model):
     cards_to_show = models.JSONField(blank=True)
     swap_card_a = models.IntegerField(null=True)
     swap_card_b = models.IntegerField(null=True)
+    is_auto = models.BooleanField(default=False)  # played by the server after the action deadline
 
     @property
     def swapped_cards(self):
@@ -121,6 +181,20 @@ class CardShot(models.Model):
     game = models.ForeignKey(Game, related_name='shots', on_delete=models.CASCADE)
     card_index = models.IntegerField()
     shooter_id = models.IntegerField()
+    is_auto = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['game', 'shooter_id'],
+                name='unique_game_shooter'
+            ),
+            models.UniqueConstraint(
+                fields=['game', 'card_index'],
+                condition=models.Q(card_index__gte=0),
+                name='unique_game_card_shot'
+            )
+        ]
 
 
 class Player(models.Model):
@@ -131,3 +205,56 @@ class Player(models.Model):
     @property
     def position(self):
         return self.room.players.filter(join_timestamp__lt=self.join_timestamp).count()
+
+
+class GameResult(models.Model):
+    game = models.OneToOneField(Game, related_name='result', on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(default=timezone.now)
+    winning_team = models.CharField(choices=Team, null=True)
+    users = models.JSONField()  # [player 1 user id, ..., player 4 user id]
+    final_roles = models.JSONField()  # [player 1 cards, player 2 cards, ..., discard]
+    teams = models.JSONField()  # [player 1 team, ..., player 4 team]
+    cards_shot = models.JSONField()  # [card shot by player 1 or None, ...]
+    players_shot = models.JSONField()  # [is player 1 shot, ...]
+    winners = models.JSONField()  # [is player 1 winner, ...]
+
+
+class RoleStats(models.Model):
+    role = models.CharField(choices=CardType, unique=True)
+    games = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+
+
+class UserStats(models.Model):
+    user = models.OneToOneField(User, related_name='stats', on_delete=models.CASCADE)
+    games = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+
+
+class Rating(models.Model):
+    user = models.OneToOneField(User, related_name='rating', on_delete=models.CASCADE)
+    rating = models.FloatField(default=INITIAL_RATING)
+    games = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # serves both the leaderboard order and "how many are rated above x" for ranks
+            models.Index(fields=['-rating', 'user'], name='rating_leaderboard_idx')
+        ]
+
+
+class RoomEvent(models.Model):
+    room = models.ForeignKey(Room, related_name='events', on_delete=models.CASCADE)
+    seq = models.IntegerField()
+    kind = models.CharField(choices=EventKind)
+    payload = models.JSONField(default=dict)
+    player_id = models.IntegerField(null=True)  # only this seat may see the event, None for everyone
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['room', 'seq'],
+                name='unique_room_event_seq'
+            )
+        ]
@@ -0,0 +1,23 @@
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+from game import admission, memory
+from game.exceptions import InvalidRequestException
+from game.view_utils import smart_view, require_staff
+
+
+@require_GET
+@smart_view(lock_room=False)
+@require_staff
+def get_admission_metrics(request):
+    return JsonResponse(admission.controller.metrics(), status=200)
+
+
+@require_GET
+@smart_view(lock_room=False)
+@require_staff
+def get_memory_report(request):
+    top = request.GET.get("top", str(memory.DEFAULT_TOP_SITES))
+    if not top.isdecimal():
+        raise InvalidRequestException
+    return JsonResponse(memory.report(int(top), reset=request.GET.get("reset", "1") == "1"), status=200)
@@ -0,0 +1,28 @@
+from game.game_logic import PLAYERS, CARDS_PER_PLAYER, is_input_expected, legal_selections
+from game.models import Game, GameStage
+
+MAX_POLL_ROUNDS = 200
+
+
+def play(send, room_id: int) -> None:
+    # Plays a started game to the end through the views: every seat polls and reads its history each
+    # round, and a seat that is expected to act makes its first legal move or shoots the next seat.
+    # send(player_id, method, path, data) sends one request as that seat.
+    for _ in range(MAX_POLL_ROUNDS):
+        for player_id in range(PLAYERS):
+            send(player_id, "post", "game_stage/", {"room_id": room_id})
+            send(player_id, "get", "game_history/", {"room_id": room_id})
+        game = Game.objects.get(room_id=room_id)
+        if game.stage == GameStage.FINISHED:
+            return
+        send(0, "post", "sync/", {"room_id": room_id, "last_stage": game.stage})
+        for player_id in range(PLAYERS):
+            if not is_input_expected(game, player_id):
+                continue
+            if game.stage == GameStage.SHOOTING:
+                card = ((player_id + 1) % PLAYERS) * CARDS_PER_PLAYER
+                send(player_id, "post", "shoot_card/", {"room_id": room_id, "card_position": card})
+            else:
+                selected_cards, _ = legal_selections(game, player_id)[0]
+                send(player_id, "post", "submit_action/", {"room_id": room_id, "selected_cards": selected_cards})
+    raise RuntimeError(f"game in room {room_id} did not finish")
@@ -0,0 +1,103 @@
+import contextlib
+import cProfile
+import itertools
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+_request_counter = itertools.count(1)
+# Only one request is profiled at a time: profilers in concurrent threads would slow every worker
+# down, and newer Pythons allow a single active profiler per interpreter anyway.
+_profiler_lock = threading.Lock()
+
+
+class _QueryLog:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                "sql": sql,
+                "db": context["connection"].alias,
+                "ms": round((time.perf_counter() - start) * 1000, 3),
+            })
+
+
+# Profiles requests from staff that send "X-Profile: 1", and, when PROFILE_SLOW_MS is set, every
+# request, keeping the dump only if it took longer than that. Dumps go to PROFILE_DIR as a pstats
+# file plus a JSON file with the request and its SQL; the oldest are removed past PROFILE_DIR_MAX_BYTES.
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, "PROFILE_SLOW_MS", 0)
+        self.profile_dir = getattr(settings, "PROFILE_DIR", settings.BASE_DIR / "profiles")
+        self.max_bytes = getattr(settings, "PROFILE_DIR_MAX_BYTES", 64 * 1024 * 1024)
+
+    def _requested(self, request):
+        return request.META.get(PROFILE_HEADER) == "1" and request.user.is_authenticated and request.user.is_staff
+
+    def __call__(self, request):
+        requested = self._requested(request)
+        if not (requested or self.slow_ms) or not _profiler_lock.acquire(blocking=False):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        query_log = _QueryLog()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(query_log))
+                start = time.perf_counter()
+                profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profiler.disable()
+                elapsed_ms = (time.perf_counter() - start) * 1000
+            if requested or elapsed_ms >= self.slow_ms:
+                self._write(request, response, profiler, query_log, elapsed_ms)
+        finally:
+            _profiler_lock.release()
+        return response
+
+    def _write(self, request, response, profiler, query_log, elapsed_ms):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"profile-{int(time.time())}-{os.getpid()}-{next(_request_counter)}"
+        profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+        with open(os.path.join(self.profile_dir, f"{name}.json"), "w") as f:
+            json.dump({
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "ms": round(elapsed_ms, 3),
+                "queries": query_log.queries,
+            }, f)
+        self._rotate()
+
+    def _rotate(self):
+        dumps = {}  # {name: [mtime, size, paths]}, a dump's .prof and .json files go together
+        for entry in os.scandir(self.profile_dir):
+            if entry.is_file() and entry.name.startswith("profile-"):
+                stat = entry.stat()
+                dump = dumps.setdefault(os.path.splitext(entry.name)[0], [0, 0, []])
+                dump[0] = max(dump[0], stat.st_mtime)
+                dump[1] += stat.st_size
+                dump[2].append(entry.path)
+        total = sum(size for _, size, _ in dumps.values())
+        for _, size, paths in sorted(dumps.values()):
+            if total <= self.max_bytes:
+                break
+            for path in paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            total -= size
@@ -0,0 +1,88 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from game.exceptions import RateLimitedException
+
+DEFAULT_RATE_LIMITS = {
+    # endpoint: (tokens refilled per second, bucket size)
+    "game_stage": (5, 10),
+    "game_history": (5, 10),
+    "sync": (5, 10),
+    "rooms_list": (2, 5),
+    "rooms_search": (5, 10),
+    "matchmaking_status": (2, 5),
+}
+SHARDS = 16
+MAX_KEYS_PER_SHARD = 4096
+# Every request made while the bucket is empty costs this much extra, so clients that ignore
+# Retry-After keep getting pushed back while well-behaved ones are unaffected.
+DENIED_REQUEST_PENALTY = 1
+
+
+class TokenBucketLimiter:
+    def __init__(self, limits, shards=SHARDS, max_keys_per_shard=MAX_KEYS_PER_SHARD):
+        self.limits = limits
+        self.max_keys_per_shard = max_keys_per_shard
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._buckets = [OrderedDict() for _ in range(shards)]  # {(endpoint, client): [tokens, timestamp]}
+
+    def acquire(self, endpoint, client) -> float:
+        # returns 0 if the request may proceed, otherwise the number of seconds to wait
+        rate, burst = self.limits[endpoint]
+        key = (endpoint, client)
+        shard = hash(key) % len(self._locks)
+        buckets = self._buckets[shard]
+        now = time.monotonic()
+        with self._locks[shard]:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = [burst, now]
+                buckets[key] = bucket
+                if len(buckets) > self.max_keys_per_shard:
+                    buckets.popitem(last=False)
+            else:
+                buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            bucket[0] = max(-burst, bucket[0] - DENIED_REQUEST_PENALTY)
+            return (1 - bucket[0]) / rate
+
+    def __len__(self):
+        return sum(len(buckets) for buckets in self._buckets)
+
+
+limiter = TokenBucketLimiter({**DEFAULT_RATE_LIMITS, **getattr(settings, "RATE_LIMITS", {})})
+
+
+def _client_address(request):
+    # Behind N trusted proxies (the room router counts as one) the client is the address the
+    # outermost of them appended; anything further left in X-Forwarded-For was sent by the client.
+    hops = getattr(settings, "RATE_LIMIT_TRUSTED_PROXY_HOPS", 0)
+    forwarded = [address.strip() for address in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",")]
+    if hops and len(forwarded) >= hops and forwarded[-hops]:
+        return forwarded[-hops]
+    return request.META.get("REMOTE_ADDR")
+
+
+def rate_limit(endpoint):
+    def decorator(view):
+        def new_view(request, *args, **kwargs):
+            client = request.user.id if request.user.is_authenticated else _client_address(request)
+            retry_after = limiter.acquire(endpoint, client)
+            if retry_after:
+                response = JsonResponse({"detail": RateLimitedException.details}, status=RateLimitedException.code)
+                response["Retry-After"] = str(math.ceil(retry_after))
+                return response
+            return view(request, *args, **kwargs)
+
+        return new_view
+
+    return decorator
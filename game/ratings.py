@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from game.models import GameResult, Rating, INITIAL_RATING
+
+K_FACTOR = 32
+LEADERBOARD_VERSION_KEY = "leaderboard:version"
+# Pages are dropped on every rating change through the version key; the timeout only bounds how
+# stale a page can get when the cache backend is not shared between processes.
+LEADERBOARD_CACHE_SECONDS = getattr(settings, "LEADERBOARD_CACHE_SECONDS", 30)
+
+
+def _expected_score(rating, opponent_rating) -> float:
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def update_ratings(result: GameResult) -> None:
+    # Winners and losers are treated as two sides rated by their average (Elo). Deltas are applied
+    # with F() so concurrently finishing games that share a user never overwrite each other.
+    Rating.objects.bulk_create([Rating(user_id=user_id) for user_id in result.users], ignore_conflicts=True)
+    ratings = dict(Rating.objects.filter(user_id__in=result.users).values_list('user_id', 'rating'))
+    won = [user_id for user_id, is_winner in zip(result.users, result.winners) if is_winner]
+    lost = [user_id for user_id, is_winner in zip(result.users, result.winners) if not is_winner]
+
+    deltas = {user_id: 0.0 for user_id in result.users}
+    if won and lost:
+        won_rating = sum(ratings[user_id] for user_id in won) / len(won)
+        lost_rating = sum(ratings[user_id] for user_id in lost) / len(lost)
+        delta = K_FACTOR * (1 - _expected_score(won_rating, lost_rating))
+        for user_id in won:
+            deltas[user_id] = delta
+        for user_id in lost:
+            deltas[user_id] = -delta
+
+    for user_id, delta in deltas.items():
+        Rating.objects.filter(user_id=user_id).update(rating=F('rating') + delta, games=F('games') + 1)
+    transaction.on_commit(_invalidate_leaderboard)
+
+
+def _invalidate_leaderboard():
+    try:
+        cache.incr(LEADERBOARD_VERSION_KEY)
+    except ValueError:
+        cache.set(LEADERBOARD_VERSION_KEY, 1, None)
+
+
+def _rating_data(rating: Rating, rank: int) -> dict:
+    return {
+        "rank": rank,
+        "user": {"id": rating.user_id, "username": rating.user.username},
+        "rating": round(rating.rating),
+        "games": rating.games,
+    }
+
+
+def rank_of(rating) -> int:
+    # competition ranking: users with the same rating share a rank
+    return Rating.objects.filter(rating__gt=rating).count() + 1
+
+
+def leaderboard_page(page: int, page_size: int) -> list[dict]:
+    version = cache.get_or_set(LEADERBOARD_VERSION_KEY, 1, None)
+    key = f"leaderboard:{version}:{page}:{page_size}"
+    entries = cache.get(key)
+    if entries is not None:
+        return entries
+
+    start = page * page_size
+    ratings = list(Rating.objects.select_related('user').order_by('-rating', 'user_id')[start:start + page_size])
+    entries = []
+    for position, rating in enumerate(ratings):
+        if position and rating.rating == ratings[position - 1].rating:
+            rank = entries[-1]["rank"]
+        elif position == 0 and start:
+            rank = rank_of(rating.rating)
+        else:
+            rank = start + position + 1
+        entries.append(_rating_data(rating, rank))
+    cache.set(key, entries, LEADERBOARD_CACHE_SECONDS)
+    return entries
+
+
+def user_rating(user: User) -> dict:
+    rating = Rating.objects.filter(user=user).first()
+    if rating is None:
+        return {"rank": None, "user": {"id": user.id, "username": user.username}, "rating": INITIAL_RATING, "games": 0}
+    rating.user = user
+    return _rating_data(rating, rank_of(rating.rating))
@@ -0,0 +1,113 @@
+"""
+Re-executes recorded games in memory from their seed and their action and shot log.
+
+The deal of a game with a seed is game_logic.deal(random.Random(seed)). From there the replay steps
+through the stages with the same helpers the live game uses (is_action_required, _acting_player,
+check_action, _apply_action, compute_result), feeding them the recorded actions instead of the
+database, and compares what it gets with the stored GameState rows, Game.copied_role and GameResult.
+Nothing is written, so it can run against a live database, and since it does not touch the
+database after loading it is also a benchmark of the game rules over real games.
+"""
+
+import random
+
+from game.game_logic import PLAYERS, deal, is_action_required, check_action, _acting_player, _apply_action, \
+    compute_result
+from game.models import Game, GameState, GameStage, CardShot, GameResult, CardType
+
+RESULT_FIELDS = ("winning_team", "final_roles", "teams", "cards_shot", "players_shot", "winners")
+
+
+class ReplayError(Exception):
+    def __init__(self, stage, message):
+        super().__init__(f"{GameStage(stage).name}: {message}")
+
+
+class _ReplayGame:
+    # stands in for both the Game and its current GameState in game_logic's helpers
+    def __init__(self, roles: list[CardType]):
+        self.roles = roles
+        self.copied_role = None
+        self.stage = GameStage.BEGINNING
+
+    @property
+    def game(self):
+        return self
+
+
+class Recording:
+    __slots__ = ("game_id", "seed", "copied_role", "states", "actions", "cards_shot", "result")
+
+    def __init__(self, game_id, seed, copied_role):
+        self.game_id = game_id
+        self.seed = seed
+        self.copied_role = copied_role
+        self.states = {}  # {stage: cards}
+        self.actions = {}  # {stage: Action}
+        self.cards_shot = [None] * PLAYERS
+        self.result = None
+
+
+def load(game_ids: list[int]) -> list[Recording]:
+    recordings = {
+        game_id: Recording(game_id, seed, copied_role)
+        for game_id, seed, copied_role in Game.objects.filter(id__in=game_ids).values_list('id', 'seed', 'copied_role')
+    }
+    for state in GameState.objects.filter(game_id__in=game_ids).select_related('action'):
+        recording = recordings[state.game_id]
+        recording.states[state.stage] = state.cards
+        if (action := state.get_action()) is not None:
+            recording.actions[state.stage] = action
+    shots = CardShot.objects.filter(game_id__in=game_ids).values_list('game_id', 'shooter_id', 'card_index')
+    for game_id, shooter_id, card_index in shots:
+        recordings[game_id].cards_shot[shooter_id] = card_index
+    for result in GameResult.objects.filter(game_id__in=game_ids):
+        recordings[result.game_id].result = result
+    return list(recordings.values())
+
+
+def replay(seed: int, actions: dict, cards_shot: list[int | None]) -> tuple[dict, str | None, dict]:
+    # the cards of every stage, the copied role and the result of the game the log describes
+    game = _ReplayGame(deal(random.Random(seed)))
+    cards = game.roles
+    states = {}
+    for stage in range(GameStage.BEGINNING, GameStage.SHOOTING):
+        game.stage = stage
+        states[stage] = cards
+        action = actions.get(stage)
+        if not is_action_required(game):
+            if action is not None:
+                raise ReplayError(stage, "action recorded where none is required")
+            continue
+        if action is None:
+            raise ReplayError(stage, "no action recorded")
+        player_id = _acting_player(game)
+        if player_id is None or not check_action(game, player_id, action):
+            raise ReplayError(stage, f"illegal action {action.cards_to_show} swap {action.swapped_cards}")
+        if stage == GameStage.COPY:
+            game.copied_role = cards[action.cards_to_show[0]]
+        cards = _apply_action(cards, action)
+    states[GameStage.SHOOTING] = states[GameStage.FINISHED] = cards
+    return states, game.copied_role, compute_result(cards, cards_shot)
+
+
+def verify(recording: Recording) -> list[str]:
+    if recording.seed is None:
+        return ["no seed"]
+    try:
+        states, copied_role, result = replay(recording.seed, recording.actions, recording.cards_shot)
+    except ReplayError as e:
+        return [str(e)]
+    mismatches = []
+    for stage, cards in states.items():
+        if cards != recording.states.get(stage):
+            mismatches.append(f"{GameStage(stage).name}: stored {recording.states.get(stage)}, replayed {cards}")
+    if copied_role != recording.copied_role:
+        mismatches.append(f"copied role: stored {recording.copied_role}, replayed {copied_role}")
+    if recording.result is None:
+        mismatches.append("no result")
+    else:
+        for field in RESULT_FIELDS:
+            if getattr(recording.result, field) != result[field]:
+                mismatches.append(f"result {field}: stored {getattr(recording.result, field)}, replayed {result[field]}")
+    return mismatches
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+REPLICA_DB_ALIAS = "replica"
+DEFAULT_PIN_SECONDS = 5
+MAX_PINNED_USERS = 10000
+
+_local = threading.local()
+_pins_lock = threading.Lock()
+_pinned_until = {}  # {user_id: monotonic time until which the user reads from the primary}
+
+
+def replica_enabled() -> bool:
+    return REPLICA_DB_ALIAS in settings.DATABASES
+
+
+def pin_user(user_id) -> None:
+    until = time.monotonic() + getattr(settings, "REPLICA_PIN_SECONDS", DEFAULT_PIN_SECONDS)
+    with _pins_lock:
+        _pinned_until[user_id] = until
+        if len(_pinned_until) > MAX_PINNED_USERS:
+            now = time.monotonic()
+            for pinned_user_id, pinned_until in list(_pinned_until.items()):
+                if pinned_until < now:
+                    del _pinned_until[pinned_user_id]
+
+
+def pinned_user_count() -> int:
+    return len(_pinned_until)
+
+
+def is_pinned(user_id) -> bool:
+    until = _pinned_until.get(user_id)
+    return until is not None and until > time.monotonic()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if getattr(_local, "use_replica", False) and not connections["default"].in_atomic_block:
+            return REPLICA_DB_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA_DB_ALIAS
+
+
+def read_replica(view):
+    def new_view(request, *args, **kwargs):
+        # users who have just written read from the primary so they always see their own changes
+        if not replica_enabled() or (request.user.is_authenticated and is_pinned(request.user.id)):
+            return view(request, *args, **kwargs)
+        _local.use_replica = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _local.use_replica = False
+
+    return new_view
+
+
+def pin_to_primary(view=None, *, when=None):
+    # For views that change what the user reads next (rooms, moves): after a successful request the
+    # user reads from the primary for REPLICA_PIN_SECONDS. Polls that only move the game along do
+    # not pin, or every active player would always be pinned. when(request) narrows it further.
+    if view is None:
+        return lambda view: pin_to_primary(view, when=when)
+
+    def new_view(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if replica_enabled() and request.user.is_authenticated and response.status_code < 400 \
+                and (when is None or when(request)):
+            pin_user(request.user.id)
+        return response
+
+    return new_view
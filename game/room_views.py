@@ -1,10 +1,11 @@
-import json
+import sys
 
+from django.db import transaction, IntegrityError
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_GET, require_POST
 
-from game import game_logic
+from game import game_logic, snapshots
 from game.exceptions import (
     RoomAlreadyExistsException,
     RoomNotFoundException,
@@ -13,11 +14,17 @@ from game.exceptions import (
     UserNotFoundException,
     CreatorCannotLeaveRoomException,
     RoomFullException,
-    GameAlreadyStartedException
+    GameAlreadyStartedException,
+    InvalidRequestException
 )
 from game.game_logic import init_game
-from game.models import Room, Player, User
-from game.view_utils import smart_view, require_user_in_room, require_room_exists
+from game.admission import admission, MOVE
+from game.events import append_event, events_since
+from game.idempotency import idempotent
+from game.models import Room, Player, User, DEFAULT_ACTION_TIMEOUT, EventKind, room_name_key
+from game.rate_limit import rate_limit
+from game.replica import read_replica, pin_to_primary
+from game.view_utils import smart_view, require_user_in_room, require_room_exists, get_context
 
 
 def _user_data(user: User):
@@ -29,93 +36,161 @@ def _room_data(room: Room):
         "id": room.id,
         "name": room.name,
         "creator": _user_data(room.creator),
+        "action_timeout": room.action_timeout,
+        "event_seq": room.event_seq,
         "is_game_started": room.get_game() is not None,
         "players": [_user_data(player.user) for player in room.players.all()]
     }
 
 
 @require_GET
+@read_replica
+@rate_limit("rooms_list")
 def get_rooms_list(request):
     rooms = Room.objects.all()
     rooms_data = [_room_data(room) for room in rooms]
     return JsonResponse({"rooms": rooms_data}, status=200)
 
 
+ROOM_SEARCH_LIMIT = 20
+MAX_ROOM_SEARCH_LIMIT = 100
+
+
+def _prefix_upper_bound(prefix: str) -> str | None:
+    # the smallest string above every string starting with prefix, None if there is none
+    stripped = prefix.rstrip(chr(sys.maxunicode))
+    if not stripped:
+        return None
+    code_point = ord(stripped[-1]) + 1
+    if 0xD800 <= code_point <= 0xDFFF:
+        code_point = 0xE000  # surrogates cannot be encoded for the database
+    return stripped[:-1] + chr(code_point)
+
+
+@require_GET
+@read_replica
+@rate_limit("rooms_search")
+@smart_view(lock_room=False)
+def search_rooms(request):
+    prefix = room_name_key(request.GET.get("prefix", ""))
+    limit = request.GET.get("limit", str(ROOM_SEARCH_LIMIT))
+    if not limit.isdecimal() or not 0 < int(limit) <= MAX_ROOM_SEARCH_LIMIT:
+        raise InvalidRequestException
+    rooms = Room.objects.select_related("creator", "game").prefetch_related("players__user").order_by("name_key")
+    if prefix:
+        # a range over the unique name_key index; SQLite compares text by code point, so this is exactly the prefix
+        rooms = rooms.filter(name_key__gte=prefix)
+        if (upper_bound := _prefix_upper_bound(prefix)) is not None:
+            rooms = rooms.filter(name_key__lt=upper_bound)
+    return JsonResponse({"rooms": [_room_data(room) for room in rooms[:int(limit)]]}, status=200)
+
+
 @require_POST
 @csrf_protect
+@pin_to_primary
 @smart_view
 def create_room(request):
-    data = json.loads(request.body or "{}")
+    data = get_context(request).data
     room_name = data.get('room_name')
-    if Room.objects.filter(name=room_name).exists():
-        raise RoomAlreadyExistsException
-    room = Room.objects.create(name=room_name, creator=request.user)
+    action_timeout = data.get('action_timeout', DEFAULT_ACTION_TIMEOUT)
+    if action_timeout is not None and (type(action_timeout) is not int or action_timeout <= 0):
+        raise InvalidRequestException
+    if type(room_name) is not str or not room_name_key(room_name) or len(room_name) > Room.name.field.max_length:
+        raise InvalidRequestException
+    try:
+        with transaction.atomic():
+            room = Room.objects.create(name=room_name, creator=request.user, action_timeout=action_timeout)
+    except IntegrityError:
+        raise RoomAlreadyExistsException  # another room's name_key is the same
     Player.objects.create(user=request.user, room=room)
-    room.save()
+    room.event_seq = append_event(room.id, EventKind.ROOM_CREATED, {
+        "name": room.name,
+        "creator": _user_data(request.user)
+    })
     return JsonResponse(_room_data(room), status=201)
 
 
 @require_POST
 @csrf_protect
+@pin_to_primary
 @smart_view
 @require_room_exists
 def delete_room(request):
-    data = json.loads(request.body or "{}")
-    room_id = data.get('room_id')
-    room = Room.objects.get(id=room_id)
-    if room.creator != request.user:
+    room = get_context(request).room
+    if room.creator_id != request.user.id:
         raise UserNotCreatorException
     room.delete()
+    snapshots.invalidate(get_context(request).room_id)
     return HttpResponse(status=200)
 
 
 @require_POST
 @csrf_protect
+@pin_to_primary
+@idempotent("join_room")
 @smart_view
 def join_room(request):
-    data = json.loads(request.body or "{}")
-    room_id = data.get('room_id')
-    if not Room.objects.filter(id=room_id).exists():
+    context = get_context(request)
+    room = context.room
+    if room is None:
         raise RoomNotFoundException
-    room = Room.objects.get(id=room_id)
-    if room.players.filter(user=request.user).exists():
+    if context.player is not None:
         raise UserAlreadyInRoomException
-    if room.players.count() >= game_logic.PLAYERS:
+    if len(context.players) >= game_logic.PLAYERS:
         raise RoomFullException
     Player.objects.create(user=request.user, room=room)
+    append_event(room.id, EventKind.PLAYER_JOINED, {"user": _user_data(request.user)})
     return HttpResponse(status=201)
 
 
 @require_POST
 @csrf_protect
+@pin_to_primary
 @smart_view
 def leave_room(request):
-    data = json.loads(request.body or "{}")
-    room_id = data.get('room_id')
-    if not Room.objects.filter(id=room_id).exists():
+    context = get_context(request)
+    room = context.room
+    if room is None:
         raise RoomNotFoundException
-    room = Room.objects.get(id=room_id)
-    if not room.players.filter(user=request.user).exists():
+    if context.player is None:
         raise UserNotFoundException
-    if room.creator == request.user:
+    if room.creator_id == request.user.id:
         raise CreatorCannotLeaveRoomException
-    player = Player.objects.get(user=request.user, room=room)
-    player.delete()
+    context.player.delete()
+    snapshots.invalidate(room.id)
+    append_event(room.id, EventKind.PLAYER_LEFT, {"user": _user_data(request.user)})
     return HttpResponse(status=200)
 
 
 @require_POST
 @csrf_protect
+@pin_to_primary
+@idempotent("start_game")
+@admission("start_game", priority=MOVE)
 @smart_view
 @require_room_exists
 @require_user_in_room
 def start_game(request):
-    data = json.loads(request.body or "{}")
-    room_id = data.get('room_id')
-    room = Room.objects.get(id=room_id)
-    if room.creator != request.user:
+    context = get_context(request)
+    room = context.room
+    if room.creator_id != request.user.id:
         raise UserNotCreatorException
-    if room.get_game() is not None:
+    if context.game is not None:
         raise GameAlreadyStartedException
     init_game(room)
+    append_event(room.id, EventKind.GAME_STARTED)
     return HttpResponse(status=200)
+
+
+@require_GET
+@csrf_protect
+@admission("room_events")
+@smart_view(lock_room=False)
+@require_room_exists
+def get_room_events(request):
+    context = get_context(request)
+    since = request.GET.get("since", "0")
+    if not since.isdecimal():
+        raise InvalidRequestException
+    events, last_seq = events_since(context.room_id, int(since), context.player_id)
+    return JsonResponse({"events": events, "last_seq": last_seq}, status=200)
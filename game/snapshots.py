@@ -0,0 +1,290 @@
+"""
+Host-local cache of live game snapshots shared by all worker processes.
+
+Every game_stage poll would otherwise load the room, its players and the current GameState, and
+then check reads, actions and the next state, just to learn that nothing happened. Workers on one
+host share an mmap'd file (SNAPSHOT_CACHE_PATH) with one fixed-size slot per room (room_id modulo
+SNAPSHOT_CACHE_SLOTS; a colliding room just evicts the other one). A slot holds the stage, the
+current deal and swap, the seats, which seats have read the stage and which have shot.
+
+A poll answered from a snapshot costs no queries. It falls back to the database when the slot
+misses, or when the snapshot says something is due: everybody has read the stage and
+min_move_time has passed, or the action deadline has passed. The database path is authoritative.
+It refreshes the slot, so a snapshot that is wrong only costs one slow poll.
+
+Slots are guarded by a seqlock. Writers take an fcntl lock on the slot's byte range and make the
+sequence number odd while they write. Readers copy the slot without locking and retry if the
+sequence number was odd or changed. Every write to the game (actions, shots, stage changes)
+invalidates the slot. A refresh is only stored if the slot's sequence number is unchanged since
+the refresh started reading the database, so a refresh that raced with a write never overwrites
+the invalidation.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import F, Q
+
+from game import write_behind
+from game.models import CardType, GameStage, GameState, Game, CardShot, Player, GameStageRead
+
+_SEQ = struct.Struct("<Q")
+# room_id, game_id, state_id, stage, flags, stage_ts, min_move_time, action_timeout,
+# 4 seats, reads bitmask, last_read_ts, shots bitmask, 11 cards, swap
+_PAYLOAD = struct.Struct("<qqqbBdii4qBdB11b2b")
+SLOT_SIZE = _SEQ.size + _PAYLOAD.size
+
+NEXT_STATE_READY = 1
+ACTION_REQUIRED = 2
+ACTION_RECORDED = 4
+
+MAX_READ_ATTEMPTS = 100
+
+_CARDS = list(CardType)
+_CARD_CODES = {card.value: code for code, card in enumerate(_CARDS)}
+
+
+class Snapshot:
+    __slots__ = ("room_id", "game_id", "state_id", "stage", "flags", "stage_ts", "min_move_time",
+                 "action_timeout", "users", "reads", "last_read_ts", "shots", "cards", "swap")
+
+    def __init__(self, fields):
+        (self.room_id, self.game_id, self.state_id, self.stage, self.flags, self.stage_ts, self.min_move_time,
+         self.action_timeout, *users, self.reads, self.last_read_ts, self.shots) = fields[:-13]
+        self.users = users
+        self.cards = [_CARDS[code].value for code in fields[-13:-2]]
+        self.swap = [card for card in fields[-2:] if card >= 0]
+
+    def pack(self) -> bytes:
+        swap = (self.swap + [-1, -1])[:2]
+        return _PAYLOAD.pack(
+            self.room_id, self.game_id, self.state_id, self.stage, self.flags, self.stage_ts, self.min_move_time,
+            self.action_timeout, *self.users, self.reads, self.last_read_ts, self.shots,
+            *[_CARD_CODES[card] for card in self.cards], *swap
+        )
+
+    def seat(self, user_id) -> int | None:
+        return self.users.index(user_id) if user_id in self.users else None
+
+    def _all_seats(self) -> int:
+        return (1 << sum(1 for user_id in self.users if user_id)) - 1
+
+    def is_due(self, now) -> bool:
+        # whether the database path could move the game on right now
+        if self.stage == GameStage.FINISHED:
+            return False
+        deadline_passed = self.action_timeout >= 0 and now - self.stage_ts >= self.action_timeout
+        if self.stage == GameStage.SHOOTING:
+            return deadline_passed or self.shots == self._all_seats()
+        if not self.flags & NEXT_STATE_READY:
+            return not (self.flags & ACTION_REQUIRED and not self.flags & ACTION_RECORDED and not deadline_passed)
+        return self.reads == self._all_seats() and now - self.last_read_ts >= self.min_move_time
+
+
+class SnapshotCache:
+    def __init__(self, path, slots):
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < slots * SLOT_SIZE:
+            os.ftruncate(self._fd, slots * SLOT_SIZE)
+        self._mm = mmap.mmap(self._fd, slots * SLOT_SIZE)
+        # fcntl locks belong to the process, so they do not keep this process's threads apart
+        self._write_lock = threading.Lock()
+
+    def _offset(self, room_id):
+        return (room_id % self.slots) * SLOT_SIZE
+
+    def version(self, room_id) -> int:
+        return _SEQ.unpack_from(self._mm, self._offset(room_id))[0]
+
+    def get(self, room_id) -> Snapshot | None:
+        offset = self._offset(room_id)
+        for _ in range(MAX_READ_ATTEMPTS):
+            seq = _SEQ.unpack_from(self._mm, offset)[0]
+            if seq & 1:
+                continue  # a writer is in the slot
+            data = self._mm[offset + _SEQ.size:offset + SLOT_SIZE]
+            if _SEQ.unpack_from(self._mm, offset)[0] == seq:
+                break
+        else:
+            return None  # busy, or a writer died mid-write; the next write repairs the slot
+        fields = _PAYLOAD.unpack(data)
+        if fields[0] != room_id:
+            return None
+        return Snapshot(fields)
+
+    def _write(self, room_id, update):
+        # update(seq, current payload) returns the new payload, or None to leave the slot alone
+        offset = self._offset(room_id)
+        with self._write_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT_SIZE, offset)
+            try:
+                seq = _SEQ.unpack_from(self._mm, offset)[0]
+                payload = update(seq, self._mm[offset + _SEQ.size:offset + SLOT_SIZE])
+                if payload is None:
+                    return False
+                seq |= 1  # stays odd if a writer died half way
+                _SEQ.pack_into(self._mm, offset, seq)
+                self._mm[offset + _SEQ.size:offset + SLOT_SIZE] = payload
+                _SEQ.pack_into(self._mm, offset, seq + 1)
+                return True
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT_SIZE, offset)
+
+    def store(self, snapshot: Snapshot, version: int) -> bool:
+        return self._write(snapshot.room_id, lambda seq, _: snapshot.pack() if seq == version else None)
+
+    def invalidate(self, room_id) -> None:
+        # Always bumps the sequence number, even when the slot is empty or holds another room, so that
+        # a refresh of this room that started before the write can never be stored afterwards.
+        def clear(seq, payload):
+            if _PAYLOAD.unpack(payload)[0] not in (0, room_id):
+                return payload  # the slot holds another room, leave it as it is
+            return bytes(_PAYLOAD.size)
+
+        self._write(room_id, clear)
+
+    def mark_read(self, room_id, seat, now) -> None:
+        def set_read(seq, payload):
+            snapshot = Snapshot(_PAYLOAD.unpack(payload))
+            if snapshot.room_id != room_id or snapshot.reads & (1 << seat):
+                return None
+            snapshot.reads |= 1 << seat
+            snapshot.last_read_ts = max(snapshot.last_read_ts, now)
+            return snapshot.pack()
+
+        self._write(room_id, set_read)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> SnapshotCache | None:
+    global _cache
+    path = getattr(settings, "SNAPSHOT_CACHE_PATH", None)
+    if not path:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SnapshotCache(path, getattr(settings, "SNAPSHOT_CACHE_SLOTS", 4096))
+    return _cache
+
+
+def invalidate(room_id: int) -> None:
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(room_id)
+
+
+def _snapshot(game, state, user_ids, read_timestamps, next_state_ready, shooter_ids) -> Snapshot:
+    from game.game_logic import PLAYERS, is_action_required  # game_logic imports this module
+
+    action = state.get_action()
+    flags = 0
+    if next_state_ready:
+        flags |= NEXT_STATE_READY
+    if game.stage < GameStage.SHOOTING and is_action_required(state):
+        flags |= ACTION_REQUIRED
+    if action is not None:
+        flags |= ACTION_RECORDED
+    shots = 0
+    for shooter_id in shooter_ids:
+        shots |= 1 << shooter_id
+
+    snapshot = Snapshot((
+        game.room_id, game.id, state.id, game.stage, flags, game.stage_timestamp.timestamp(),
+        game.room.min_move_time, -1 if game.room.action_timeout is None else game.room.action_timeout,
+        *(user_ids + [0] * PLAYERS)[:PLAYERS], 0, 0.0, shots, *[_CARD_CODES[card] for card in state.cards], -1, -1
+    ))
+    for seat, user_id in enumerate(user_ids):
+        if user_id in read_timestamps:
+            snapshot.reads |= 1 << seat
+    if read_timestamps:
+        snapshot.last_read_ts = max(read_timestamps.values()).timestamp()
+    if action is not None and action.is_swap():
+        snapshot.swap = [action.swap_card_a, action.swap_card_b]
+    return snapshot
+
+
+def refresh(room_id: int, user_ids: list[int]) -> None:
+    cache = get_cache()
+    if cache is None:
+        return
+    version = cache.version(room_id)  # taken before anything is loaded, see store()
+    game = Game.objects.select_related('room').filter(room_id=room_id).first()
+    if game is None:
+        return
+    state = GameState.objects.select_related('action').get(game=game, stage=game.stage)
+    state.game = game
+    read_timestamps = write_behind.pending_reads(state.id)
+    read_timestamps.update(state.read_by.values_list('user_id', 'timestamp'))
+    next_state_ready = GameState.objects.filter(game=game, stage=game.stage + 1).exists()
+    shooter_ids = []
+    if game.stage == GameStage.SHOOTING:
+        shooter_ids = CardShot.objects.filter(game=game).values_list('shooter_id', flat=True)
+    cache.store(_snapshot(game, state, user_ids, read_timestamps, next_state_ready, shooter_ids), version)
+
+
+def warm() -> int:
+    # Fills the slots of every unfinished game with a few set-based queries, so a host whose cache
+    # file is new does not pay a database poll per room first. Returns the number of slots stored.
+    cache = get_cache()
+    if cache is None:
+        return 0
+    versions = [cache.version(slot) for slot in range(cache.slots)]  # before anything is loaded, see store()
+    games = {game.id: game for game in Game.objects.select_related('room').exclude(stage=GameStage.FINISHED)}
+    states, next_ready = {}, set()
+    state_filter = Q(stage=GameStage.BEGINNING) | Q(stage=F('game__stage')) | Q(stage=F('game__stage') + 1)
+    for state in GameState.objects.filter(state_filter, game_id__in=list(games)).select_related('action'):
+        game = state.game = games[state.game_id]
+        if state.stage == GameStage.BEGINNING:
+            game.__dict__['roles'] = state.cards  # Game.roles is a cached_property
+        if state.stage == game.stage:
+            states[game.id] = state
+        elif state.stage == game.stage + 1:
+            next_ready.add(game.id)
+    user_ids = {}
+    for room_id, user_id in Player.objects.filter(room__game__in=list(states)).order_by('join_timestamp') \
+            .values_list('room_id', 'user_id'):
+        user_ids.setdefault(room_id, []).append(user_id)
+    read_timestamps = {state.id: write_behind.pending_reads(state.id) for state in states.values()}
+    reads = GameStageRead.objects.filter(state__in=list(states.values())).values_list('state_id', 'user_id', 'timestamp')
+    for state_id, user_id, timestamp in reads:
+        read_timestamps[state_id][user_id] = timestamp
+    shooter_ids = {}
+    shots = CardShot.objects.filter(game__in=list(states), game__stage=GameStage.SHOOTING)
+    for game_id, shooter_id in shots.values_list('game_id', 'shooter_id'):
+        shooter_ids.setdefault(game_id, []).append(shooter_id)
+
+    stored = 0
+    for game_id, state in states.items():
+        game = games[game_id]
+        snapshot = _snapshot(game, state, user_ids.get(game.room_id, []), read_timestamps[state.id],
+                             game_id in next_ready, shooter_ids.get(game_id, []))
+        stored += cache.store(snapshot, versions[game.room_id % cache.slots])
+    return stored
+
+
+def poll(room_id: int, user_id: int) -> int | None:
+    # the current stage if the poll could be answered from the snapshot, None to take the database path
+    cache = get_cache()
+    if cache is None:
+        return None
+    snapshot = cache.get(room_id)
+    if snapshot is None:
+        return None
+    seat = snapshot.seat(user_id) if user_id else None
+    now = time.time()
+    if seat is None or snapshot.is_due(now):
+        return None
+    if not snapshot.reads & (1 << seat):
+        write_behind.mark_read(snapshot.state_id, user_id)
+        cache.mark_read(room_id, seat, now)
+    return snapshot.stage
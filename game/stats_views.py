@@ -0,0 +1,84 @@
+from django.contrib.auth.models import User
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import require_GET
+
+from game.exceptions import GameNotFinishedException, UserNotFoundException, InvalidRequestException
+from game.game_logic import resolve_game
+from game.models import GameStage, RoleStats, UserStats
+from game.ratings import leaderboard_page, user_rating
+from game.view_utils import smart_view, require_room_exists, require_game_started, get_context
+
+
+@require_GET
+@csrf_protect
+@smart_view(lock_room=False)
+@require_room_exists
+@require_game_started
+def get_game_result(request):
+    game = get_context(request).game
+    if game.stage != GameStage.FINISHED:
+        raise GameNotFinishedException
+    result = resolve_game(game)
+    return JsonResponse({
+        "winning_team": result.winning_team,
+        "users": result.users,
+        "final_roles": result.final_roles,
+        "teams": result.teams,
+        "cards_shot": result.cards_shot,
+        "players_shot": result.players_shot,
+        "winners": result.winners,
+    }, status=200)
+
+
+@require_GET
+def get_role_stats(request):
+    return JsonResponse({
+        "roles": {stats.role: {"games": stats.games, "wins": stats.wins} for stats in RoleStats.objects.all()}
+    }, status=200)
+
+
+@require_GET
+@smart_view
+def get_user_stats(request):
+    user_id = request.GET.get("user_id") or request.user.id
+    if user_id is not None and not str(user_id).isdecimal():
+        raise InvalidRequestException
+    if not User.objects.filter(id=user_id).exists():
+        raise UserNotFoundException
+    stats = UserStats.objects.filter(user_id=user_id).first()
+    return JsonResponse({
+        "user_id": int(user_id),
+        "games": stats.games if stats else 0,
+        "wins": stats.wins if stats else 0,
+    }, status=200)
+
+
+LEADERBOARD_PAGE_SIZE = 50
+MAX_LEADERBOARD_PAGE_SIZE = 200
+
+
+@require_GET
+@smart_view(lock_room=False)
+def get_leaderboard(request):
+    page = request.GET.get("page", "0")
+    page_size = request.GET.get("page_size", str(LEADERBOARD_PAGE_SIZE))
+    if not page.isdecimal() or not page_size.isdecimal() or not 0 < int(page_size) <= MAX_LEADERBOARD_PAGE_SIZE:
+        raise InvalidRequestException
+    return JsonResponse({
+        "page": int(page),
+        "page_size": int(page_size),
+        "entries": leaderboard_page(int(page), int(page_size)),
+    }, status=200)
+
+
+@require_GET
+@smart_view(lock_room=False)
+def get_user_rating(request):
+    user_id = request.GET.get("user_id") or request.user.id
+    if user_id is not None and not str(user_id).isdecimal():
+        raise InvalidRequestException
+    user = User.objects.filter(id=user_id).first()
+    if user is None:
+        raise UserNotFoundException
+    return JsonResponse(user_rating(user), status=200)
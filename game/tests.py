@@ -1,3 +1,1337 @@
-from django.test import TestCase
+import difflib
+import http.server
+import importlib
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.db.migrations.executor import MigrationExecutor
+from django.http import JsonResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import get_resolver
+from django.utils import timezone
+
+from Mafia44 import room_routing, wsgi
+from game import admission, events, game_logic, idempotency, matchmaking, playthrough, profiling, rate_limit, ratings, \
+    replay, replica, single_flight, snapshots, warmup
+from game.exceptions import InvalidRequestException, InvalidRoomIdException, RateLimitedException, \
+    UserAlreadyInRoomException
+from game.models import Action, CardShot, CardType, EventKind, Game, GameResult, GameStage, GameState, Player, \
+    Rating, RoleStats, Room, RoomEvent, StateView, Team, UserStats
+from game.stats_views import LEADERBOARD_PAGE_SIZE
+
+
+def _write_behind_child(phase, db_path):
+    # runs in a separate process against its own SQLite file, see WriteBehindCrashTests
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.db import connections
+
+    from game import write_behind
+    from game.game_logic import init_game, mark_read_by, try_advance_stage
+    from game.models import Room, Player, Game, GameStageRead
+
+    settings.DATABASES["default"]["NAME"] = db_path
+    settings.WRITE_BEHIND_FLUSH_MS = 60000  # only explicit flushes
+    connections.close_all()
+
+    if phase == "setup":
+        call_command("migrate", verbosity=0)
+        users = [User.objects.create_user(f"player{i}") for i in range(4)]
+        room = Room.objects.create(name="crash", creator=users[0], min_move_time=0)
+        for user in users:
+            Player.objects.create(user=user, room=room)
+        init_game(room)
+        return
+
+    game = Game.objects.get()
+    users = list(User.objects.order_by("id"))
+    if phase == "crash":
+        mark_read_by(game, users[0])
+        write_behind.flush()
+        for user in users[1:]:
+            mark_read_by(game, user)
+        os.kill(os.getpid(), signal.SIGKILL)
+    elif phase == "recover":
+        print(sorted(GameStageRead.objects.values_list("user_id", flat=True)))
+        try_advance_stage(game)
+        print(game.stage)
+        for user in users:
+            mark_read_by(game, user)
+        try_advance_stage(game)
+        print(game.stage)
+
+
+class WriteBehindCrashTests(SimpleTestCase):
+    def _run(self, phase, db_path):
+        code = (
+            "import django, os; os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Mafia44.settings'); "
+            f"django.setup(); from game.tests import _write_behind_child; _write_behind_child({phase!r}, {db_path!r})"
+        )
+        return subprocess.run([sys.executable, "-c", code], cwd=settings.BASE_DIR, capture_output=True, text=True)
+
+    def test_killed_process_only_loses_unflushed_reads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "db.sqlite3")
+            self.assertEqual(self._run("setup", db_path).returncode, 0)
+            self.assertEqual(self._run("crash", db_path).returncode, -signal.SIGKILL)
+            recovered = self._run("recover", db_path)
+            self.assertEqual(recovered.returncode, 0, recovered.stderr)
+            flushed_reads, stage_after_crash, stage_after_repoll = recovered.stdout.split("\n")[:3]
+            self.assertEqual(flushed_reads, "[1]")  # the flushed read survived, the buffered ones did not
+            self.assertEqual(stage_after_crash, "0")  # the game waits instead of advancing on lost reads
+            self.assertEqual(stage_after_repoll, "1")  # players polling again lets it continue
+
+
+def _start_game(name="game", seed=None, **room_fields):
+    # a started four-player game; returns the room's users in seat order and the game
+    users = [User.objects.create_user(f"{name}{i}") for i in range(4)]
+    room = Room.objects.create(name=name, creator=users[0], min_move_time=0, **room_fields)
+    for user in users:
+        Player.objects.create(user=user, room=room)
+    return users, game_logic.init_game(room, seed=seed)
+
+
+# {path: (max queries, max rows read)} per request, including the session and user lookups.
+# A (path, kind) entry overrides the path's budget while the game is in a stage of that kind, see _stage_kind.
+QUERY_BUDGETS = {
+    "csrf/": (0, 0),
+    "register/": (10, 0),
+    "login/": (9, 1),
+    "logout/": (4, 3),
+    "me/": (2, 2),
+    "rooms/": (10, 12),
+    "rooms/search/": (5, 11),
+    "create_room/": (14, 5),
+    "delete_room/": (7, 3),
+    "join_room/": (10, 7),
+    "leave_room/": (10, 6),
+    "start_game/": (11, 8),
+    "room_events/": (6, 34),
+    "game_stage/": (16, 16),
+    ("game_stage/", "deal"): (21, 16),  # the first poll creates the state after the deal
+    ("game_stage/", "action"): (32, 23),  # polls that advance past an action also store its views
+    ("game_stage/", "shooting"): (53, 54),  # resolves the game, updates stats and stores the finished views
+    "game_history/": (8, 12),
+    ("game_history/", "shooting"): (11, 13),
+    "submit_action/": (25, 15),
+    "shoot_card/": (14, 8),
+    "sync/": (41, 29),
+    "game_result/": (2, 2),
+    "role_stats/": (1, 8),
+    "user_stats/": (4, 4),
+    "leaderboard/": (1, 4),
+    "user_rating/": (5, 5),
+    "matchmaking/enqueue/": (35, 11),
+    "matchmaking/status/": (2, 2),
+    "matchmaking/leave/": (2, 2),
+    "ops/admission/": (2, 2),
+    "ops/memory/": (2, 2),
+}
+
+
+_STAGE_KINDS = {GameStage.BEGINNING: "deal", GameStage.SHOOTING: "shooting", GameStage.FINISHED: "finished"}
+
+
+def _stage_kind(room_id) -> str | None:
+    # "deal", "action" (a stage someone has to act in), "shooting", "finished" or None for the other stages
+    game = Game.objects.filter(room_id=room_id).first() if room_id else None
+    if game is None:
+        return None
+    if game.stage in _STAGE_KINDS:
+        return _STAGE_KINDS[game.stage]
+    if game_logic.is_action_required(GameState.objects.get(game=game, stage=game.stage)):
+        return "action"
+    return None
+
+
+class _QueryRecorder:
+    # execute_wrapper that also counts the rows every SELECT returns, with the same parameters
+    # and in the same transaction, by running it once more wrapped in COUNT(*)
+
+    def __init__(self):
+        self.queries = []  # [(sql, rows)]
+
+    def __call__(self, execute, sql, params, many, context):
+        rows = 0
+        if not many and sql.lstrip().upper().startswith("SELECT"):
+            cursor = context["cursor"].cursor  # the backend cursor, so this does not come back here
+            cursor.execute(f"SELECT COUNT(*) FROM ({sql}) AS budget_rows", params)
+            rows = cursor.fetchone()[0]
+        self.queries.append((sql, rows))
+        return execute(sql, params, many, context)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None, PROFILE_SLOW_MS=0, TRACE_SAMPLE_EVERY=0)
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        random.seed(0)  # the choices of auto-play
+        seeds = mock.patch.object(game_logic, "_seed_source", random.Random(0))  # the deals
+        seeds.start()
+        self.addCleanup(seeds.stop)
+        limits = {endpoint: (10 ** 9, 10 ** 9) for endpoint in rate_limit.limiter.limits}
+        patcher = mock.patch.object(rate_limit.limiter, "limits", limits)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.violations = []
+        self.last_within_budget = {}  # {path: SQL lines of the last request that kept to its budget}
+
+    def request(self, client, method, path, data=None, room_id=None):
+        stage = Game.objects.filter(room_id=room_id).values_list("stage", flat=True).first() if room_id else None
+        kind = _stage_kind(room_id)
+        recorder = _QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            if method == "get":
+                response = client.get(f"/{path}", data or {})
+            else:
+                response = client.post(f"/{path}", json.dumps(data or {}), content_type="application/json")
+        self.assertLess(response.status_code, 500, response.content)
+
+        max_queries, max_rows = QUERY_BUDGETS.get((path, kind)) or QUERY_BUDGETS[path]
+        rows = sum(query_rows for _, query_rows in recorder.queries)
+        lines = [f"{sql}  -- {query_rows} rows" for sql, query_rows in recorder.queries]
+        if len(recorder.queries) > max_queries or rows > max_rows:
+            diff = difflib.unified_diff(self.last_within_budget.get(path, []), lines,
+                                        "last request within budget", "this request", lineterm="")
+            self.violations.append(
+                f"{method.upper()} /{path} at stage {stage} ({kind}): {len(recorder.queries)} queries, {rows} rows "
+                f"(budget {max_queries} queries, {max_rows} rows)\n" + "\n".join(diff))
+        else:
+            self.last_within_budget[path] = lines
+        return response
+
+    def assertWithinBudgets(self):
+        if self.violations:
+            self.fail("query budgets exceeded\n\n" + "\n\n".join(self.violations))
+
+    def login(self, user):
+        client = self.client_class()
+        client.force_login(user)
+        return client
+
+    def play(self, clients, room_id):
+        playthrough.play(
+            lambda player_id, method, path, data: self.request(clients[player_id], method, path, data, room_id), room_id)
+
+    def test_every_route_has_a_budget(self):
+        paths = {str(pattern.pattern) for pattern in get_resolver("game.urls").url_patterns}
+        self.assertEqual(paths - set(QUERY_BUDGETS), set())
+
+    def test_scripted_game(self):
+        anonymous = self.client_class()
+        self.request(anonymous, "get", "csrf/")
+        for i in range(4):
+            self.request(self.client_class(), "post", "register/", {"username": f"player{i}", "password": "secret"})
+        self.request(anonymous, "post", "login/", {"username": "player0", "password": "secret"})
+        self.request(anonymous, "get", "me/")
+        self.request(anonymous, "post", "logout/")
+
+        users = list(User.objects.order_by("id"))
+        clients = [self.login(user) for user in users]
+        room_id = self.request(clients[0], "post", "create_room/", {"room_name": "budget", "action_timeout": None}).json()["id"]
+        Room.objects.filter(id=room_id).update(min_move_time=0)
+        for client in clients[1:]:
+            self.request(client, "post", "join_room/", {"room_id": room_id})
+        self.request(clients[0], "get", "rooms/")
+        self.request(clients[0], "get", "rooms/search/", {"prefix": "BUD"})
+        self.request(clients[0], "post", "start_game/", {"room_id": room_id}, room_id)
+        self.play(clients, room_id)
+
+        self.request(clients[1], "get", "room_events/", {"room_id": room_id, "since": 0}, room_id)
+        self.request(clients[0], "get", "game_result/", {"room_id": room_id}, room_id)
+        self.request(clients[0], "get", "role_stats/")
+        self.request(clients[0], "get", "user_stats/")
+        self.request(clients[0], "get", "leaderboard/")
+        self.request(clients[0], "get", "user_rating/")
+        self.assertWithinBudgets()
+
+    def test_room_management_and_matchmaking(self):
+        users = [User.objects.create_user(f"player{i}", is_staff=i == 0) for i in range(4)]
+        clients = [self.login(user) for user in users]
+        room_id = self.request(clients[0], "post", "create_room/", {"room_name": "lobby"}).json()["id"]
+        self.request(clients[1], "post", "join_room/", {"room_id": room_id})
+        self.request(clients[1], "post", "leave_room/", {"room_id": room_id})
+        self.request(clients[0], "post", "delete_room/", {"room_id": room_id})
+
+        for client in clients:
+            self.request(client, "post", "matchmaking/enqueue/", {"min_move_time": 0})
+            self.request(client, "get", "matchmaking/status/")
+        self.request(clients[0], "post", "matchmaking/leave/")
+        self.request(clients[0], "get", "ops/admission/")
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)  # the first memory report starts tracing
+        self.request(clients[0], "get", "ops/memory/", {"top": 1})
+        self.assertWithinBudgets()
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class AutoPlayTests(TestCase):
+    def setUp(self):
+        random.seed(0)
+        limits = {endpoint: (10 ** 9, 10 ** 9) for endpoint in rate_limit.limiter.limits}
+        patcher = mock.patch.object(rate_limit.limiter, "limits", limits)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_legal_actions_do_not_query(self):
+        seated = game_logic.PLAYERS * game_logic.CARDS_PER_PLAYER
+        seed = next(seed for seed in range(100) if CardType.COPY in game_logic.deal(random.Random(seed))[:seated])
+        users, game = _start_game(seed=seed)
+        game.stage = GameStage.COPY
+        player_id = game_logic._acting_player(game)
+        GameState.objects.create(game=game, stage=GameStage.COPY, cards=game.roles)
+        with self.assertNumQueries(0):
+            actions = game_logic.legal_actions(game, player_id)
+        self.assertEqual(len(actions), len(game.roles) - 1)  # any card but the copy itself
+        self.assertEqual(game_logic.legal_actions(game, (player_id + 1) % game_logic.PLAYERS), [])
+
+    def test_players_past_the_deadline_are_played_for(self):
+        users, game = _start_game(action_timeout=30)
+        clients = [self.client_class() for _ in users]
+        for user, client in zip(users, clients):
+            client.force_login(user)
+        room = {"room_id": game.room_id}
+        for _ in range(100):
+            Game.objects.filter(id=game.id).update(stage_timestamp=timezone.now() - timedelta(seconds=60))
+            for client in clients:
+                self.assertEqual(client.post("/game_stage/", room, content_type="application/json").status_code, 200)
+            game.refresh_from_db()
+            if game.stage == GameStage.FINISHED:
+                break
+        self.assertEqual(game.stage, GameStage.FINISHED)
+
+        played = Action.objects.filter(game_state__game=game) \
+            .exclude(game_state__stage__in=[GameStage.MILKMAN, GameStage.MILKMAN_COPY])
+        self.assertTrue(played.exists())
+        self.assertTrue(all(action.is_auto for action in played))
+        self.assertEqual(sorted(CardShot.objects.filter(game=game).values_list("shooter_id", "card_index", "is_auto")),
+                         [(player_id, -1, True) for player_id in range(game_logic.PLAYERS)])
+        for action in played:
+            game.stage = action.game_state.stage
+            player_id = game_logic._acting_player(game)
+            history = clients[player_id].get("/game_history/", room).json()["history"]
+            self.assertTrue(history[str(action.game_state.stage)]["auto"])
+            event = RoomEvent.objects.get(room_id=game.room_id, kind=EventKind.ACTION_RECORDED,
+                                          payload__stage=action.game_state.stage)
+            self.assertEqual(event.player_id, player_id)
+            stored_view = game_logic.state_json(GameState.objects.get(id=action.game_state_id), player_id)
+            self.assertEqual(event.payload["view"], game_logic.make_brothers_indistinguishable(stored_view))
+            self.assertEqual(event.payload["view"].get("swap"),
+                             [action.swap_card_a, action.swap_card_b] if action.is_swap() else None)
+
+        stored = clients[0].get("/game_history/", room).json()
+        StateView.objects.filter(state__game=game, state__stage=GameStage.FINISHED).delete()  # as for older games
+        self.assertEqual(clients[0].get("/game_history/", room).json(), stored)
+
+
+C = CardType
+SUICIDE_SEATED = [C.MAFIA, C.THIEF, C.SUICIDE, C.SEER, C.COPY, C.BROTHERS_1, C.BROTHERS_2, C.BRAWLER,
+                  C.DRUNKARD, C.WITCH, C.MILKMAN]
+MAFIA_DISCARDED = [C.COPY, C.THIEF, C.BROTHERS_1, C.BROTHERS_2, C.SEER, C.BRAWLER, C.DRUNKARD, C.WITCH,
+                   C.MILKMAN, C.MAFIA, C.SUICIDE]
+
+
+class ResultTests(TestCase):
+    def _result(self, cards, cards_shot):
+        return game_logic.compute_result([card.value for card in cards], cards_shot)
+
+    def test_shooting_the_suicide_wins_it_the_game(self):
+        result = self._result(SUICIDE_SEATED, [2, -1, 0, None])
+        self.assertEqual(result["winning_team"], Team.SUICIDE)
+        self.assertEqual(result["teams"], [Team.MAFIA, Team.SUICIDE, Team.TOWN, Team.TOWN])
+        self.assertEqual(result["players_shot"], [True, True, False, False])
+        self.assertEqual(result["winners"], [False, True, False, False])
+
+    def test_shooting_the_mafia_wins_the_town_the_game(self):
+        result = self._result(SUICIDE_SEATED, [-1, -1, 0, -1])
+        self.assertEqual(result["winning_team"], Team.TOWN)
+        self.assertEqual(result["winners"], [False, False, True, True])
+
+    def test_mafia_wins_when_nobody_shoots_it(self):
+        result = self._result(SUICIDE_SEATED, [4, -1, -1, -1])
+        self.assertEqual(result["winning_team"], Team.MAFIA)
+        self.assertEqual(result["winners"], [True, False, False, False])
+
+    def test_mafia_in_the_discard(self):
+        result = self._result(MAFIA_DISCARDED, [-1, -1, -1, -1])
+        self.assertEqual(result["winning_team"], Team.TOWN)  # nobody innocent was shot
+        self.assertEqual(result["winners"], [True] * 4)
+        result = self._result(MAFIA_DISCARDED, [2, -1, -1, -1])
+        self.assertIsNone(result["winning_team"])
+        self.assertEqual(result["winners"], [False] * 4)
+
+    def _update_stats(self, cards, cards_shot):
+        users = [User.objects.create_user(f"player{i}") for i in range(4)]
+        result = GameResult(users=[user.id for user in users], **self._result(cards, cards_shot))
+        game_logic._update_stats(result)
+        user_stats = dict(UserStats.objects.values_list("user_id", "wins"))
+        role_stats = {role: (games, wins)
+                      for role, games, wins in RoleStats.objects.values_list("role", "games", "wins")}
+        return [user_stats[user.id] for user in users], role_stats
+
+    def test_stats_count_seated_roles_of_winners_and_losers(self):
+        user_wins, role_stats = self._update_stats(SUICIDE_SEATED, [-1, -1, 0, -1])
+        self.assertEqual(user_wins, [0, 0, 1, 1])
+        self.assertEqual(role_stats[C.MAFIA], (1, 0))
+        self.assertEqual(role_stats[C.BRAWLER], (1, 1))
+        self.assertNotIn(C.DRUNKARD, role_stats)  # in the discard
+
+    def test_stats_without_a_winner(self):
+        user_wins, role_stats = self._update_stats(MAFIA_DISCARDED, [2, -1, -1, -1])
+        self.assertEqual(user_wins, [0] * 4)
+        self.assertEqual(set(role_stats.values()), {(1, 0)})
+        self.assertEqual(set(Rating.objects.values_list("rating", "games")), {(Rating().rating, 1)})
+
+    def test_user_stats_rejects_a_malformed_user_id(self):
+        users, _ = _start_game()
+        self.client.force_login(users[0])
+        for user_id in ("abc", "\u00b2"):
+            self.assertEqual(self.client.get("/user_stats/", {"user_id": user_id}).status_code,
+                             InvalidRequestException.code)
+        self.assertEqual(self.client.get("/user_stats/", {"user_id": users[1].id}).json()["games"], 0)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class RatingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create_user(f"player{i}") for i in range(5)]
+
+    def _rate(self, *ratings):
+        for user, rating in zip(self.users, ratings):
+            Rating.objects.create(user=user, rating=rating)
+
+    def _ratings(self):
+        return [Rating.objects.get(user=user).rating for user in self.users[:4]]
+
+    def test_elo_deltas_between_the_average_ratings_of_both_sides(self):
+        self._rate(1300, 1500, 1400, 1400)
+        result = GameResult(users=[user.id for user in self.users[:4]], winners=[True, True, False, False])
+        with self.captureOnCommitCallbacks(execute=True):
+            ratings.update_ratings(result)
+        self.assertEqual(self._ratings(), [1316.0, 1516.0, 1384.0, 1384.0])
+
+        ratings.update_ratings(GameResult(users=result.users, winners=[False, False, True, True]))
+        delta = ratings.K_FACTOR * (1 - 1 / (1 + 10 ** ((1416 - 1384) / 400)))
+        for rating, expected in zip(self._ratings(), [1316 - delta, 1516 - delta, 1384 + delta, 1384 + delta]):
+            self.assertAlmostEqual(rating, expected)
+        self.assertEqual(set(Rating.objects.values_list("games", flat=True)), {2})
+
+    def test_tied_ratings_share_a_rank_across_pages(self):
+        self._rate(1600, 1500, 1500, 1500, 1400)
+        self.assertEqual([ratings.rank_of(rating) for rating in (1700, 1600, 1500, 1400)], [1, 1, 2, 5])
+        pages = [ratings.leaderboard_page(page, 2) for page in range(4)]
+        self.assertEqual([[entry["rank"] for entry in page] for page in pages], [[1, 2], [2, 2], [5], []])
+        self.assertEqual([entry["user"]["id"] for page in pages for entry in page], [user.id for user in self.users])
+        self.assertEqual(ratings.user_rating(self.users[3])["rank"], 2)
+
+    def test_a_resolved_game_drops_the_cached_leaderboard(self):
+        self._rate(1600)
+        self.assertEqual(len(ratings.leaderboard_page(0, 10)), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            users, game = _play_copying_the_milkman()
+        self.assertEqual(game.stage, GameStage.FINISHED)
+        entries = ratings.leaderboard_page(0, 10)
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(sum(entry["games"] for entry in entries), 4)
+
+    def test_malformed_pages_and_user_ids_are_rejected(self):
+        self.client.force_login(self.users[0])
+        for params in ({"page": "\u00b2"}, {"page_size": "\u00b2"}, {"page_size": "0"}):
+            self.assertEqual(self.client.get("/leaderboard/", params).status_code, InvalidRequestException.code)
+        for user_id in ("abc", "\u00b2"):
+            self.assertEqual(self.client.get("/user_rating/", {"user_id": user_id}).status_code,
+                             InvalidRequestException.code)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class RequestContextTests(TestCase):
+    def test_non_ascii_digits_are_not_a_room_id(self):
+        users, game = _start_game()
+        self.client.force_login(users[0])
+        response = self.client.post("/game_stage/", {"room_id": "\u00b2"}, content_type="application/json")
+        self.assertEqual(response.status_code, InvalidRoomIdException.code)
+        response = self.client.post("/game_stage/", {"room_id": str(game.room_id)}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+
+class RoomSearchTests(TestCase):
+    def test_prefixes_ending_in_the_last_code_point(self):
+        user = User.objects.create_user("creator")
+        top, below_surrogates = chr(sys.maxunicode), chr(0xD7FF)
+        for name in ("a", f"a{top}", f"a{top}b", "b", top, below_surrogates, f"{below_surrogates}x", "\ue000"):
+            Room.objects.create(name=name, creator=user)
+        self.client.force_login(user)
+
+        def search(prefix):
+            response = self.client.get("/rooms/search/", {"prefix": prefix})
+            self.assertEqual(response.status_code, 200, response.content)
+            return [room["name"] for room in response.json()["rooms"]]
+
+        self.assertEqual(search(f"a{top}"), [f"a{top}", f"a{top}b"])
+        self.assertEqual(search(top), [top])
+        self.assertEqual(search(below_surrogates), [below_surrogates, f"{below_surrogates}x"])
+        self.assertEqual(search("A"), ["a", f"a{top}", f"a{top}b"])
+        for limit in ("0", "\u00b2"):
+            self.assertEqual(self.client.get("/rooms/search/", {"limit": limit}).status_code,
+                             InvalidRequestException.code)
+
+
+def _play_copying_the_milkman():
+    # a game where the copy takes the milkman and every other action and every shot is auto-played
+    random.seed(0)
+    seated = game_logic.PLAYERS * game_logic.CARDS_PER_PLAYER
+    seed = next(seed for seed in range(100) if CardType.COPY in game_logic.deal(random.Random(seed))[:seated])
+    users, game = _start_game(seed=seed, action_timeout=30)
+    for _ in range(100):
+        if game.stage == GameStage.COPY:
+            copy_player = game_logic._acting_player(game)
+            milkman = game.roles.index(CardType.MILKMAN.value)
+            game_logic.record_action(game_logic.selected_cards_to_action(game, copy_player, [milkman]), copy_player)
+        Game.objects.filter(id=game.id).update(stage_timestamp=timezone.now() - timedelta(seconds=60))
+        game.refresh_from_db()
+        for user in users:
+            game_logic.mark_read_by(game, user)
+        game_logic.try_advance_stage(game)
+        if game.stage == GameStage.FINISHED:
+            break
+    return users, game
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class ReplayTests(TestCase):
+    def test_a_game_with_auto_played_and_copied_milkman_actions_replays(self):
+        users, game = _play_copying_the_milkman()
+        self.assertEqual(game.stage, GameStage.FINISHED)
+        self.assertEqual(game.copied_role, CardType.MILKMAN)
+        self.assertTrue(Action.objects.filter(game_state__game=game, game_state__stage=GameStage.MILKMAN_COPY).exists())
+        self.assertTrue(Action.objects.filter(game_state__game=game, is_auto=True).exists())
+
+        recording, = replay.load([game.id])
+        self.assertEqual(replay.verify(recording), [])
+        recording.states[GameStage.FINISHED] = recording.states[GameStage.FINISHED][::-1]
+        self.assertEqual(len(replay.verify(recording)), 1)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class RoomEventTests(TestCase):
+    def test_timeouts_and_the_milkman_reveal_reach_the_feed(self):
+        users, game = _play_copying_the_milkman()
+        copy_player = game.roles.index(CardType.COPY.value) // game_logic.CARDS_PER_PLAYER
+        events = RoomEvent.objects.filter(room_id=game.room_id)
+        self.assertEqual(sorted(events.filter(kind=EventKind.CARD_SHOT).values_list("payload", flat=True),
+                                key=lambda payload: payload["shooter"]),
+                         [{"shooter": seat, "card": -1, "auto": True} for seat in range(game_logic.PLAYERS)])
+        reveal = events.get(kind=EventKind.ACTION_RECORDED, payload__stage=GameStage.MILKMAN_COPY)
+        self.assertEqual(reveal.player_id, copy_player)
+        self.assertEqual(reveal.payload["view"], game_logic.make_brothers_indistinguishable(
+            game_logic.state_json(GameState.objects.get(game=game, stage=GameStage.MILKMAN_COPY), copy_player)))
+
+        for seat, user in enumerate(users):
+            self.client.force_login(user)
+            seen = self.client.get("/room_events/", {"room_id": game.room_id, "since": 0}).json()["events"]
+            self.assertEqual([event["seq"] for event in seen],
+                             list(events.filter(Q(player_id=None) | Q(player_id=seat)).order_by("seq")
+                                  .values_list("seq", flat=True)))
+
+    def test_pages_only_count_the_events_a_seat_can_see(self):
+        users, game = _start_game()
+        room_id = game.room_id
+        for i in range(2 * events.MAX_EVENTS_PER_PAGE + 50):
+            events.append_event(room_id, EventKind.ACTION_RECORDED, {"i": i}, player_id=i % 2)
+        last = events.append_event(room_id, EventKind.STAGE_ADVANCED, {"stage": 1})
+
+        page, since = events.events_since(room_id, 0, 1)
+        self.assertEqual(len(page), events.MAX_EVENTS_PER_PAGE)
+        self.assertTrue(all(event["payload"].get("i", 1) % 2 == 1 for event in page))
+        self.assertEqual(since, page[-1]["seq"])
+        page, since = events.events_since(room_id, since, 1)
+        self.assertEqual([event["kind"] for event in page], [EventKind.ACTION_RECORDED] * 25 + [EventKind.STAGE_ADVANCED])
+        self.assertEqual(since, last)
+        self.assertEqual(events.events_since(room_id, since, 1), ([], last))
+
+        page, since = events.events_since(room_id, 0, None)  # spectators only see public events
+        self.assertEqual(([event["seq"] for event in page], since), ([last], last))
+        self.client.force_login(users[0])
+        for since in ("-1", "\u00b2"):
+            self.assertEqual(self.client.get("/room_events/", {"room_id": room_id, "since": since}).status_code,
+                             InvalidRequestException.code)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class AdvanceRaceTests(TestCase):
+    # requests polling the same game each hold their own Game instance; these replay how they interleave
+    def setUp(self):
+        seated = game_logic.PLAYERS * game_logic.CARDS_PER_PLAYER
+        seed = next(seed for seed in range(100) if CardType.COPY not in game_logic.deal(random.Random(seed))[:seated])
+        self.users, game = _start_game(seed=seed)
+        self.first, self.second = Game.objects.get(id=game.id), Game.objects.get(id=game.id)
+
+    def read_all(self, game):
+        for user in self.users:
+            game_logic.mark_read_by(game, user)
+
+    def advanced_to(self):
+        return list(RoomEvent.objects.filter(room_id=self.first.room_id, kind=EventKind.STAGE_ADVANCED)
+                    .values_list("payload__stage", flat=True))
+
+    def test_only_one_request_moves_the_game_on(self):
+        game_logic.try_create_next_state(self.first)
+        game_logic.try_create_next_state(self.second)  # loses the insert of the next state
+        self.read_all(self.first)
+        self.assertTrue(game_logic.advance_stage(self.first))
+        self.assertFalse(game_logic.advance_stage(self.second))  # still saw BEGINNING
+        self.assertEqual(self.second.stage, GameStage.COPY)
+        self.assertEqual(Game.objects.get(id=self.first.id).stage, GameStage.COPY)
+        self.assertEqual(self.advanced_to(), [GameStage.COPY])
+        self.assertEqual(GameState.objects.filter(game=self.first, stage=GameStage.COPY).count(), 1)
+
+    def test_a_request_that_lost_the_race_retries_from_the_new_stage(self):
+        self.read_all(self.first)
+        game_logic.try_advance_stage(self.first)
+        self.read_all(self.first)  # COPY needs no action, so everybody having read it is enough
+        game_logic.try_advance_stage(self.second)
+        self.assertEqual(self.second.stage, GameStage.COPY + 1)
+        self.assertEqual(self.advanced_to(), [GameStage.COPY, GameStage.COPY + 1])
+
+
+class MigrationTests(TransactionTestCase):
+    def migrate(self, name):
+        target = ("game", name) if name else None
+        executor = MigrationExecutor(connection)
+        executor.migrate([target] if target else executor.loader.graph.leaf_nodes())
+        return executor.loader.project_state([target] if target else None).apps
+
+    def setUp(self):
+        self.addCleanup(self.migrate, None)
+
+    def test_duplicates_left_by_races_are_removed(self):
+        apps = self.migrate("0005_gameresult_rolestats_userstats")
+        GameState, CardShot = apps.get_model("game", "GameState"), apps.get_model("game", "CardShot")
+        user = apps.get_model("auth", "User").objects.create(username="old")
+        room = apps.get_model("game", "Room").objects.create(name="old", creator=user, min_move_time=0)
+        game = apps.get_model("game", "Game").objects.create(stage=GameStage.COPY, room=room)
+        states = [GameState.objects.create(game=game, stage=stage, cards=[]) for stage in (0, 0, 1)]
+        shots = [CardShot.objects.create(game=game, shooter_id=shooter_id, card_index=card_index)
+                 for shooter_id, card_index in ((0, 2), (0, 4), (1, 2), (2, -1), (3, -1))]
+
+        apps = self.migrate("0006_game_concurrency_constraints")
+        self.assertEqual(list(apps.get_model("game", "GameState").objects.order_by("id").values_list("id", flat=True)),
+                         [states[0].id, states[2].id])
+        self.assertEqual(list(apps.get_model("game", "CardShot").objects.order_by("id").values_list("id", flat=True)),
+                         [shots[0].id, shots[3].id, shots[4].id])
+
+    def test_existing_rooms_get_no_action_deadline(self):
+        apps = self.migrate("0006_game_concurrency_constraints")
+        user = apps.get_model("auth", "User").objects.create(username="old")
+        apps.get_model("game", "Room").objects.create(name="old", creator=user, min_move_time=0)
+
+        Room = self.migrate("0007_action_deadlines").get_model("game", "Room")
+        self.assertIsNone(Room.objects.get(name="old").action_timeout)
+        self.assertEqual(Room.objects.create(name="new", creator_id=user.id, min_move_time=0).action_timeout, 60)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class MemoryReportTests(TestCase):
+    def test_malformed_top_is_rejected_before_tracing_starts(self):
+        self.client.force_login(User.objects.create_user("ops", is_staff=True))
+        for top in ("abc", "-1", "\u00b2"):
+            self.assertEqual(self.client.get("/ops/memory/", {"top": top}).status_code,
+                             InvalidRequestException.code)
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class SingleFlightTests(SimpleTestCase):
+    FOLLOWERS = 7
+
+    def setUp(self):
+        # followers signal once they are blocked on the leader's call, so it only finishes after all joined
+        self.waiting = threading.Semaphore(0)
+        waiting = self.waiting
+
+        class Event(threading.Event):
+            def wait(self, timeout=None):
+                waiting.release()
+                return super().wait(timeout)
+
+        class Call(single_flight._Call):
+            def __init__(self):
+                super().__init__()
+                self.done = Event()
+
+        patcher = mock.patch.object(single_flight, "_Call", Call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.flight = single_flight.SingleFlight()
+
+    def _run_concurrently(self, func):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def leader_func():
+            calls.append(None)
+            started.set()
+            release.wait(5)
+            return func()
+
+        outcomes = [None] * (self.FOLLOWERS + 1)
+
+        def call(index):
+            try:
+                outcomes[index] = ("result", self.flight.do("key", leader_func))
+            except Exception as e:
+                outcomes[index] = ("error", e)
+
+        threads = [threading.Thread(target=call, args=(0,))]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads += [threading.Thread(target=call, args=(index,)) for index in range(1, self.FOLLOWERS + 1)]
+        for thread in threads[1:]:
+            thread.start()
+        for _ in range(self.FOLLOWERS):
+            self.assertTrue(self.waiting.acquire(timeout=5))
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(self.flight), 0)
+        return outcomes
+
+    def test_concurrent_callers_share_one_result(self):
+        result = object()
+        self.assertEqual(self._run_concurrently(lambda: result), [("result", result)] * (self.FOLLOWERS + 1))
+        self.assertEqual(self.flight.do("key", lambda: 1), 1)  # the key was released, the next call runs again
+
+    def test_the_leaders_exception_reaches_every_waiter(self):
+        error = ValueError("load failed")
+
+        def fail():
+            raise error
+
+        self.assertEqual(self._run_concurrently(fail), [("error", error)] * (self.FOLLOWERS + 1))
+        self.assertEqual(self.flight.do("key", lambda: 2), 2)
+
+    def test_different_keys_do_not_wait_for_each_other(self):
+        self.assertEqual(self.flight.do("a", lambda: self.flight.do("b", lambda: "b")), "b")
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class TracingTests(TestCase):
+    def setUp(self):
+        self.trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.trace_dir)
+        self.users, self.game = _start_game()
+
+    def _poll(self, times):
+        client = Client()
+        client.force_login(self.users[0])
+        for _ in range(times):
+            response = client.post("/game_stage/", {"room_id": self.game.room_id}, content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+
+    def test_a_sampled_request_is_written_as_a_chrome_trace(self):
+        with self.settings(TRACE_SAMPLE_EVERY=1, TRACE_DIR=self.trace_dir):
+            self._poll(1)
+        [name] = os.listdir(self.trace_dir)
+        with open(os.path.join(self.trace_dir, name)) as f:
+            events = json.load(f)["traceEvents"]
+        for event in events:
+            self.assertEqual(event["ph"], "X")
+            self.assertGreaterEqual(event["dur"], 0)
+        spans = {event["name"]: event for event in events if event["cat"] == "span"}
+        self.assertLessEqual({"POST /game_stage/", "smart_view.new_view", "require_room_exists.wrapper",
+                              "require_user_in_room.wrapper", "try_advance_stage"}, set(spans))
+
+        request = spans["POST /game_stage/"]
+        queries = [event for event in events if event["cat"] == "sql"]
+        self.assertEqual(request["args"]["queries"], len(queries))
+        self.assertTrue(queries)
+        for event in events:  # every span and query happened inside the request
+            self.assertLessEqual(request["ts"], event["ts"])
+            self.assertLessEqual(event["ts"] + event["dur"], request["ts"] + request["dur"])
+        self.assertEqual({event["args"]["db"] for event in queries}, {"default"})
+
+    def test_only_every_nth_request_is_traced(self):
+        with self.settings(TRACE_SAMPLE_EVERY=0, TRACE_DIR=self.trace_dir):
+            self._poll(2)
+        self.assertEqual(os.listdir(self.trace_dir), [])
+        with self.settings(TRACE_SAMPLE_EVERY=3, TRACE_DIR=self.trace_dir):
+            self._poll(6)
+        self.assertEqual(len(os.listdir(self.trace_dir)), 2)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.staff = User.objects.create_user("staff", is_staff=True)
+        self.player = User.objects.create_user("player")
+
+    def _get(self, user, slow_ms=0, max_bytes=64 * 1024 * 1024, **headers):
+        client = Client()
+        client.force_login(user)
+        with self.settings(PROFILE_SLOW_MS=slow_ms, PROFILE_DIR=self.profile_dir, PROFILE_DIR_MAX_BYTES=max_bytes):
+            self.assertEqual(client.get("/rooms/", headers=headers).status_code, 200)
+
+    def _dumps(self):
+        return sorted(os.path.splitext(name) for name in os.listdir(self.profile_dir))
+
+    def test_only_staff_can_ask_for_a_profile(self):
+        self._get(self.player, **{"X-Profile": "1"})
+        self._get(self.staff)
+        self.assertEqual(self._dumps(), [])
+        self._get(self.staff, **{"X-Profile": "1"})
+        dumps = self._dumps()
+        self.assertEqual([extension for _, extension in dumps], [".json", ".prof"])
+        name = dumps[0][0]
+        self.assertEqual(dumps[1][0], name)
+        pstats.Stats(os.path.join(self.profile_dir, f"{name}.prof"))
+        with open(os.path.join(self.profile_dir, f"{name}.json")) as f:
+            dump = json.load(f)
+        self.assertEqual((dump["method"], dump["path"], dump["status"]), ("GET", "/rooms/", 200))
+        self.assertTrue(dump["queries"])
+
+    def test_slow_requests_are_kept(self):
+        ticks = itertools.count()
+        clock = mock.Mock(perf_counter=lambda: next(ticks), time=time.time)  # every reading is a second later
+        with mock.patch.object(profiling, "time", clock):
+            self._get(self.player, slow_ms=10 ** 9)
+            self.assertEqual(self._dumps(), [])
+            self._get(self.player, slow_ms=500)
+        self.assertEqual([extension for _, extension in self._dumps()], [".json", ".prof"])
+
+    def test_the_oldest_dumps_are_removed_past_the_size_limit(self):
+        for extension in (".prof", ".json"):
+            with open(os.path.join(self.profile_dir, f"profile-0-0-0{extension}"), "wb") as f:
+                f.write(bytes(512 * 1024))
+            os.utime(f.name, (0, 0))
+        with open(os.path.join(self.profile_dir, "notes.txt"), "w") as f:
+            f.write("not a dump")
+        self._get(self.staff, max_bytes=1024 * 1024, **{"X-Profile": "1"})
+        names = os.listdir(self.profile_dir)
+        self.assertNotIn("profile-0-0-0.prof", names)
+        self.assertNotIn("profile-0-0-0.json", names)
+        self.assertIn("notes.txt", names)
+        self.assertEqual(len(names), 3)
+
+
+class MatchmakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch.object(matchmaking, "time", mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.matchmaker = matchmaking.Matchmaker(seats=4, wait_timeout=60)
+
+    def test_groups_are_formed_in_queue_order_per_pool(self):
+        self.assertEqual([self.matchmaker.enqueue(user_id, 0) for user_id in (1, 2, 3)], [None] * 3)
+        self.assertIsNone(self.matchmaker.enqueue(4, 10))
+        self.assertIsNone(self.matchmaker.enqueue(2, 0))  # enqueueing again goes to the back
+        self.assertEqual(self.matchmaker.enqueue(5, 0), [1, 3, 2, 5])
+        self.assertEqual(self.matchmaker.status(1), {"status": "idle"})
+        self.assertEqual(self.matchmaker.status(4), {"status": "waiting", "min_move_time": 10, "waiting": 1})
+        self.matchmaker.matched([1, 3, 2, 5], 7)
+        self.assertEqual(self.matchmaker.status(5), {"status": "matched", "room_id": 7})
+        self.assertEqual((len(self.matchmaker), self.matchmaker.match_count()), (1, 4))
+
+    def test_leaving_and_requeueing(self):
+        for user_id in (1, 2, 3):
+            self.matchmaker.enqueue(user_id, 0)
+        self.assertTrue(self.matchmaker.leave(2))
+        self.assertFalse(self.matchmaker.leave(2))
+        self.assertEqual(self.matchmaker.status(2), {"status": "idle"})
+        self.assertIsNone(self.matchmaker.enqueue(4, 0))
+        group = self.matchmaker.enqueue(5, 0)
+        self.assertEqual(group, [1, 3, 4, 5])
+
+        self.matchmaker.enqueue(6, 0)
+        self.matchmaker.requeue(group, 0)  # the room could not be created, the group keeps its place
+        self.assertEqual(self.matchmaker.enqueue(7, 0), [1, 3, 4, 5])
+        self.assertEqual(self.matchmaker.enqueue(8, 0), None)
+        for user_id in (6, 7, 8):
+            self.matchmaker.leave(user_id)
+        self.assertEqual((len(self.matchmaker), dict(self.matchmaker._pools)), (0, {}))
+
+    def test_users_who_stop_polling_are_dropped(self):
+        self.matchmaker.enqueue(1, 0)
+        self.matchmaker.enqueue(2, 0)
+        self.now = 50
+        self.assertEqual(self.matchmaker.status(2)["status"], "waiting")
+        self.now = 70
+        self.assertIsNone(self.matchmaker.enqueue(3, 0))
+        self.assertIsNone(self.matchmaker.enqueue(4, 0))
+        self.assertEqual(self.matchmaker.enqueue(5, 0), [2, 3, 4, 5])
+        self.assertEqual(self.matchmaker.status(1), {"status": "idle"})
+
+        self.matchmaker.enqueue(6, 0)
+        self.now = 200
+        self.assertEqual(self.matchmaker.status(6), {"status": "idle"})
+        self.assertEqual(len(self.matchmaker), 0)
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class MatchmakingViewTests(TestCase):
+    def test_users_seated_in_an_unfinished_room_cannot_queue(self):
+        users, game = _start_game()
+        self.client.force_login(users[0])
+        self.addCleanup(matchmaking.matchmaker.leave, users[0].id)
+        response = self.client.post("/matchmaking/enqueue/", {}, content_type="application/json")
+        self.assertEqual(response.status_code, UserAlreadyInRoomException.code)
+        Game.objects.filter(id=game.id).update(stage=GameStage.FINISHED)
+        response = self.client.post("/matchmaking/enqueue/", {}, content_type="application/json")
+        self.assertEqual(response.json()["status"], "waiting")
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def controller(self, max_in_flight=4, max_polls=3, max_polls_per_room=2, move_queue_seconds=5):
+        return admission.AdmissionController(max_in_flight, max_polls, max_polls_per_room, move_queue_seconds)
+
+    def test_polls_are_capped_per_room_and_in_total(self):
+        controller = self.controller()
+        self.assertTrue(controller.admit("game_stage", admission.POLL, 1))
+        self.assertTrue(controller.admit("game_stage", admission.POLL, 1))
+        self.assertFalse(controller.admit("game_stage", admission.POLL, 1))  # the room's cap
+        self.assertTrue(controller.admit("game_stage", admission.POLL, 2))
+        self.assertFalse(controller.admit("game_stage", admission.POLL, 3))  # the global poll cap
+        self.assertTrue(controller.admit("submit_action", admission.MOVE, 3))  # moves keep the rest
+        controller.release(admission.POLL, 1)
+        self.assertTrue(controller.admit("game_stage", admission.POLL, 1))
+        self.assertEqual(controller.polled_room_count(), 2)
+        metrics = controller.metrics()
+        self.assertEqual(metrics["shed"], {"game_stage": 2})
+        self.assertEqual(metrics["in_flight"], {admission.POLL: 3, admission.MOVE: 1})
+
+    def _wait_for_move(self, controller, room_id):
+        admitted = []
+
+        def move():
+            admitted.append(controller.admit("submit_action", admission.MOVE, room_id))
+
+        thread = threading.Thread(target=move)
+        thread.start()
+        for _ in range(1000):
+            if controller.metrics()["waiting_moves"]:
+                break
+            time.sleep(0.001)
+        return thread, admitted
+
+    def test_a_queued_move_sheds_polls_and_is_admitted_when_a_slot_frees(self):
+        controller = self.controller(max_in_flight=2, max_polls=2)
+        for room_id in (1, 2):
+            self.assertTrue(controller.admit("game_stage", admission.POLL, room_id))
+        thread, admitted = self._wait_for_move(controller, 1)
+        self.assertEqual(controller.metrics()["waiting_moves"], 1)
+        controller.release(admission.POLL, 2)
+        self.assertFalse(controller.admit("game_stage", admission.POLL, 3))  # the waiting move goes first
+        thread.join(5)
+        self.assertEqual(admitted, [True])
+        self.assertEqual(controller.metrics()["in_flight"], {admission.POLL: 1, admission.MOVE: 1})
+
+    def test_a_queued_move_times_out(self):
+        controller = self.controller(max_in_flight=1, max_polls=1, move_queue_seconds=0.05)
+        self.assertTrue(controller.admit("game_stage", admission.POLL, 1))
+        thread, admitted = self._wait_for_move(controller, 1)
+        thread.join(5)
+        self.assertEqual(admitted, [False])
+        metrics = controller.metrics()
+        self.assertEqual((metrics["waiting_moves"], metrics["shed"]), (0, {"submit_action": 1}))
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(rate_limit, "time", mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_buckets_refill_at_the_rate_up_to_their_size(self):
+        limiter = rate_limit.TokenBucketLimiter({"poll": (2, 3)})
+        self.assertEqual([limiter.acquire("poll", 1) for _ in range(3)], [0, 0, 0])
+        self.now += 0.5
+        self.assertEqual(limiter.acquire("poll", 1), 0)
+        self.assertGreater(limiter.acquire("poll", 1), 0)
+        self.assertEqual(limiter.acquire("poll", 2), 0)  # every client has its own bucket
+        self.now += 60
+        self.assertEqual([limiter.acquire("poll", 1) for _ in range(4)][-2:], [0, 1.0])
+
+    def test_denied_requests_push_the_retry_back(self):
+        limiter = rate_limit.TokenBucketLimiter({"poll": (1, 2)})
+        limiter.acquire("poll", 1)
+        limiter.acquire("poll", 1)
+        self.assertEqual([limiter.acquire("poll", 1) for _ in range(3)], [2, 3, 3])  # down to -burst tokens
+        self.now += 2
+        self.assertEqual(limiter.acquire("poll", 1), 2)  # still short of a token after the first Retry-After
+
+    def test_least_recently_used_clients_are_evicted_per_shard(self):
+        limiter = rate_limit.TokenBucketLimiter({"poll": (1, 1)}, shards=1, max_keys_per_shard=2)
+        limiter.acquire("poll", "a")
+        limiter.acquire("poll", "b")
+        self.assertGreater(limiter.acquire("poll", "a"), 0)  # "a" is now the most recently used
+        limiter.acquire("poll", "c")
+        self.assertEqual(len(limiter), 2)
+        self.assertGreater(limiter.acquire("poll", "a"), 0)  # kept, still empty
+        self.assertEqual(limiter.acquire("poll", "b"), 0)  # evicted, starts over with a full bucket
+
+    def test_denied_requests_get_retry_after(self):
+        view = rate_limit.rate_limit("poll")(lambda request: JsonResponse({}))
+        request = RequestFactory().get("/")
+        request.user = mock.Mock(is_authenticated=False)
+        with mock.patch.object(rate_limit, "limiter", rate_limit.TokenBucketLimiter({"poll": (0.4, 1)})):
+            self.assertEqual(view(request).status_code, 200)
+            response = view(request)
+        self.assertEqual(response.status_code, RateLimitedException.code)
+        self.assertEqual(response["Retry-After"], "5")  # 2 tokens short at 0.4 a second, rounded up
+
+    def test_anonymous_clients_behind_a_trusted_proxy_are_told_apart(self):
+        def client(forwarded_for=None):
+            meta = {"REMOTE_ADDR": "10.0.0.1"}
+            if forwarded_for is not None:
+                meta["HTTP_X_FORWARDED_FOR"] = forwarded_for
+            return rate_limit._client_address(RequestFactory().get("/", **meta))
+
+        self.assertEqual(client("203.0.113.7"), "10.0.0.1")  # not trusted unless configured
+        with self.settings(RATE_LIMIT_TRUSTED_PROXY_HOPS=1):
+            self.assertEqual(client("203.0.113.7"), "203.0.113.7")
+            self.assertEqual(client("1.2.3.4, 203.0.113.7"), "203.0.113.7")  # the client wrote 1.2.3.4
+            self.assertEqual(client(), "10.0.0.1")
+        with self.settings(RATE_LIMIT_TRUSTED_PROXY_HOPS=2):
+            self.assertEqual(client("1.2.3.4, 203.0.113.7, 192.168.0.2"), "203.0.113.7")
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(idempotency, "store", idempotency.IdempotencyStore(60, 100))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_replay_the_first_response(self):
+        creator, user = User.objects.create_user("creator"), User.objects.create_user("player")
+        room = Room.objects.create(name="retries", creator=creator)
+        self.client.force_login(user)
+
+        def join(room_id, key="join-1"):
+            return self.client.post("/join_room/", {"room_id": room_id}, content_type="application/json",
+                                    HTTP_IDEMPOTENCY_KEY=key)
+
+        first = join(room.id)
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn(idempotency.REPLAYED_HEADER, first)
+        retry = join(room.id)
+        self.assertEqual(retry.status_code, 201)  # not "User already in room"
+        self.assertEqual(retry[idempotency.REPLAYED_HEADER], "true")
+        self.assertEqual(room.players.count(), 1)
+        self.assertEqual(join(room.id + 1).status_code, 422)
+        self.assertEqual(join(room.id, key="join-2").status_code, 400)
+
+
+def _snapshot(room_id=1, **fields):
+    # a snapshot of a four-player game in the given room; fields override the defaults
+    snapshot = snapshots.Snapshot((room_id, 10, 100, GameStage.SEER, 0, time.time(), 0, -1, 11, 12, 13, 14, 0, 0.0, 0,
+                                   *range(11), -1, -1))
+    for name, value in fields.items():
+        setattr(snapshot, name, value)
+    return snapshot
+
+
+class SnapshotCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "snapshots")
+        self.cache = snapshots.SnapshotCache(self.path, 8)
+
+    def test_reads_retry_while_a_writer_is_in_the_slot(self):
+        self.cache.store(_snapshot(), self.cache.version(1))
+        offset = self.cache._offset(1)
+        seq = self.cache.version(1)
+        snapshots._SEQ.pack_into(self.cache._mm, offset, seq + 1)  # a writer is half way through
+        self.assertIsNone(self.cache.get(1))
+        snapshots._SEQ.pack_into(self.cache._mm, offset, seq + 2)
+        self.assertEqual(self.cache.get(1).stage, GameStage.SEER)
+
+    def test_writers_in_threads_of_one_process_do_not_interleave(self):
+        inside, most_inside = [0], [0]
+
+        def slow_update(seq, payload):
+            inside[0] += 1
+            most_inside[0] = max(most_inside[0], inside[0])
+            time.sleep(0.001)
+            inside[0] -= 1
+            return payload
+
+        def write():
+            for _ in range(20):
+                self.cache._write(1, slow_update)
+
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(most_inside[0], 1)
+        self.assertEqual(self.cache.version(1), 2 * 20 * 4)
+
+    def test_refresh_that_raced_with_a_write_is_dropped(self):
+        for stored in (None, _snapshot(), _snapshot(room_id=9)):  # empty slot, this room, a room sharing it
+            if stored is not None:
+                self.cache.store(stored, self.cache.version(stored.room_id))
+            version = self.cache.version(1)  # a refresh starts reading the database
+            self.cache.invalidate(1)  # a move is made meanwhile
+            self.assertFalse(self.cache.store(_snapshot(stage=GameStage.THIEF), version))
+            self.assertNotEqual(getattr(self.cache.get(1), "stage", None), GameStage.THIEF)
+        self.assertTrue(self.cache.store(_snapshot(), self.cache.version(1)))
+
+    def test_is_due(self):
+        now = time.time()
+        all_read = {"reads": 0b1111, "last_read_ts": now - 5}
+        cases = [
+            ({"stage": GameStage.FINISHED}, False),
+            ({"flags": snapshots.ACTION_REQUIRED}, False),  # waiting for the acting player
+            ({"flags": snapshots.ACTION_REQUIRED, "action_timeout": 10, "stage_ts": now - 11}, True),
+            ({"flags": snapshots.ACTION_REQUIRED | snapshots.ACTION_RECORDED}, True),
+            ({"flags": 0}, True),  # the next state can be created
+            ({"flags": snapshots.NEXT_STATE_READY, "reads": 0b0111}, False),
+            ({"flags": snapshots.NEXT_STATE_READY, **all_read}, True),
+            ({"flags": snapshots.NEXT_STATE_READY, "min_move_time": 10, **all_read}, False),
+            ({"stage": GameStage.SHOOTING, "shots": 0b0111}, False),
+            ({"stage": GameStage.SHOOTING, "shots": 0b1111}, True),
+        ]
+        for fields, due in cases:
+            with self.subTest(**fields):
+                self.assertEqual(_snapshot(**fields).is_due(now), due)
+
+    def test_poll(self):
+        with override_settings(SNAPSHOT_CACHE_PATH=self.path), mock.patch.object(snapshots, "_cache", None), \
+                mock.patch.object(snapshots.write_behind, "mark_read") as mark_read:
+            snapshots.get_cache().store(_snapshot(flags=snapshots.NEXT_STATE_READY), 0)
+            self.assertEqual(snapshots.poll(1, 12), GameStage.SEER)
+            mark_read.assert_called_once_with(100, 12)
+            self.assertEqual(snapshots.poll(1, 12), GameStage.SEER)
+            self.assertEqual(mark_read.call_count, 1)  # the read is in the snapshot now
+            self.assertIsNone(snapshots.poll(1, 99))  # not seated, take the database path
+            self.assertIsNone(snapshots.poll(2, 12))  # nothing cached
+            for user_id in (11, 13, 14):
+                snapshots.poll(1, user_id)
+            self.assertIsNone(snapshots.poll(1, 12))  # everybody has read the stage, it can advance
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class WarmupTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "snapshots")
+        patcher = mock.patch.object(snapshots, "_cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_warm_stores_what_a_refresh_would(self):
+        users, game = _start_game()
+        game_logic.mark_read_by(game, users[1])
+        _, finished = _start_game("finished")
+        Game.objects.filter(id=finished.id).update(stage=GameStage.FINISHED)
+        self.assertEqual(snapshots.warm(), 0)  # no cache configured
+
+        with self.settings(SNAPSHOT_CACHE_PATH=self.path):
+            self.assertEqual(snapshots.warm(), 1)
+            snapshot_cache = snapshots.get_cache()
+            warmed = snapshot_cache.get(game.room_id)
+            self.assertIsNone(snapshot_cache.get(finished.room_id))
+            self.assertEqual((warmed.stage, warmed.seat(users[2].id), warmed.reads), (game.stage, 2, 0b10))
+            snapshot_cache.invalidate(game.room_id)
+            snapshots.refresh(game.room_id, [user.id for user in users])
+            self.assertEqual(snapshot_cache.get(game.room_id).pack(), warmed.pack())
+
+    def test_run_fills_the_first_leaderboard_page(self):
+        cache.clear()
+        Rating.objects.create(user=User.objects.create_user("rated"))
+        with mock.patch.object(warmup.connections, "close_all") as close_all:  # would end the test's transaction
+            results = warmup.run()
+        close_all.assert_called_once_with()
+        self.assertEqual((results["snapshots"]["result"], results["leaderboard"]["result"]), (0, 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(ratings.leaderboard_page(0, LEADERBOARD_PAGE_SIZE)), 1)
+
+    def test_boot_warm_up_is_opt_in(self):
+        with mock.patch.object(warmup, "run") as run:
+            with self.settings(WARMUP_ON_BOOT=False):
+                importlib.reload(wsgi)
+            run.assert_not_called()
+            with self.settings(WARMUP_ON_BOOT=True):
+                importlib.reload(wsgi)
+            run.assert_called_once_with()
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class SyncTests(TestCase):
+    def test_last_stage_is_optional(self):
+        users, game = _start_game(action_timeout=None)
+        self.client.force_login(users[1])
+        response = self.client.post("/sync/", {"room_id": game.room_id}, content_type="application/json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn(str(GameStage.BEGINNING.value), response.json()["history"])
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    def test_reads_go_to_the_replica_only_inside_read_replica_views(self):
+        router = replica.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Room))
+        with mock.patch.object(replica._local, "use_replica", True, create=True):
+            self.assertEqual(router.db_for_read(Room), replica.REPLICA_DB_ALIAS)
+        self.assertEqual(router.db_for_write(Room), "default")
+        self.assertFalse(router.allow_migrate(replica.REPLICA_DB_ALIAS, "game"))
+
+
+@override_settings(WRITE_BEHIND_FLUSH_MS=0, SNAPSHOT_CACHE_PATH=None)
+class ReplicaPinningTests(TestCase):
+    def setUp(self):
+        for patcher in (mock.patch.object(replica, "replica_enabled", return_value=True),
+                        mock.patch.dict(replica._pinned_until, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_only_changes_pin_the_user_to_the_primary(self):
+        users, game = _start_game(action_timeout=None)
+        self.client.force_login(users[1])
+        room = {"room_id": game.room_id}
+        used_replica = []
+        request = RequestFactory().get("/")
+        request.user = users[1]
+        read_view = replica.read_replica(
+            lambda request: used_replica.append(getattr(replica._local, "use_replica", False)) or JsonResponse({}))
+
+        for path in ("/game_stage/", "/sync/"):
+            self.client.post(path, room, content_type="application/json")
+        self.assertFalse(replica.is_pinned(users[1].id))  # polls, even though they are POSTs
+        read_view(request)
+        response = self.client.post("/submit_action/", {**room, "selected_cards": [100]},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(replica.is_pinned(users[1].id))  # refused, nothing changed
+        self.client.post("/leave_room/", room, content_type="application/json")
+        self.assertTrue(replica.is_pinned(users[1].id))
+        read_view(request)
+        self.assertEqual(used_replica, [True, False])
+
+
+class HashRingTests(SimpleTestCase):
+    keys = [f"room:{i}" for i in range(2000)]
+
+    def test_removing_a_node_only_moves_its_rooms(self):
+        ring = room_routing.HashRing(["a", "b", "c", "d"])
+        before = {key: ring.get(key) for key in self.keys}
+        ring.remove("c")
+        for key in self.keys:
+            if before[key] != "c":
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.assertIn(ring.get(key), {"a", "b", "d"})
+
+    def test_adding_a_node_only_moves_rooms_to_it(self):
+        ring = room_routing.HashRing(["a", "b", "c", "d"])
+        before = {key: ring.get(key) for key in self.keys}
+        ring.add("e")
+        moved = [key for key in self.keys if ring.get(key) != before[key]]
+        self.assertTrue(all(ring.get(key) == "e" for key in moved))
+        self.assertTrue(0.1 < len(moved) / len(self.keys) < 0.3)
+
+
+class _WorkerHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.server.behaviour != "ok":
+            time.sleep(1 if self.server.behaviour == "slow" else 0)
+            self.close_connection = True  # hangs up without a response
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class RoomRouterTests(SimpleTestCase):
+    def _worker(self, behaviour="ok"):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _WorkerHandler)
+        server.daemon_threads = True
+        server.behaviour = behaviour
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"127.0.0.1:{server.server_port}"
+
+    @staticmethod
+    def _closed_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return f"127.0.0.1:{sock.getsockname()[1]}"
+
+    @staticmethod
+    def _get(router, room_id):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/game_stage/", "QUERY_STRING": f"room_id={room_id}",
+                   "wsgi.input": io.BytesIO()}
+        started = {}
+        body = b"".join(router(environ, lambda status, headers: started.update(status=status, headers=dict(headers))))
+        return started["status"], started["headers"].get(room_routing.WORKER_HEADER), body
+
+    @staticmethod
+    def _room_on(router, worker):
+        return next(room_id for room_id in range(1000) if router.ring.get(f"room:{room_id}") == worker)
+
+    def test_matchmaking_requests_all_reach_one_worker(self):
+        def key(path, cookie):
+            return room_routing._affinity_key({"PATH_INFO": path, "HTTP_COOKIE": cookie}, b"")
+
+        self.assertEqual({key(path, cookie) for path in ("/matchmaking/enqueue/", "/matchmaking/status/")
+                          for cookie in ("sessionid=a", "sessionid=b")}, {"matchmaking"})
+        self.assertNotEqual(key("/rooms/", "sessionid=a"), key("/rooms/", "sessionid=b"))
+
+    def test_the_client_address_is_appended_to_x_forwarded_for(self):
+        headers = room_routing._forward_headers({"REMOTE_ADDR": "203.0.113.7", "HTTP_COOKIE": "sessionid=a"})
+        self.assertEqual(headers, {"Cookie": "sessionid=a", "X-Forwarded-For": "203.0.113.7"})
+        headers = room_routing._forward_headers({"REMOTE_ADDR": "203.0.113.7", "HTTP_X_FORWARDED_FOR": "1.2.3.4"})
+        self.assertEqual(headers["X-Forwarded-For"], "1.2.3.4, 203.0.113.7")
+
+    def test_refused_worker_fails_over(self):
+        alive, dead = self._worker(), self._closed_port()
+        router = room_routing.RoomRouter([alive, dead], timeout=5)
+        room_id = self._room_on(router, dead)
+        self.assertEqual(self._get(router, room_id), ("200 OK", alive, b"ok"))
+        self.assertEqual(router.ring.nodes, [alive])
+        self.assertEqual(self._get(router, self._room_on(router, alive))[1], alive)
+
+    def test_slow_worker_times_out_and_keeps_its_rooms(self):
+        slow, other = self._worker("slow"), self._worker()
+        router = room_routing.RoomRouter([slow, other], timeout=0.2)
+        status, worker, _ = self._get(router, self._room_on(router, slow))
+        self.assertEqual((status, worker), ("504 Gateway Timeout", slow))
+        self.assertEqual(router.ring.nodes, sorted([slow, other]))
+
+    def test_worker_hanging_up_is_a_bad_gateway(self):
+        broken, other = self._worker("hang up"), self._worker()
+        router = room_routing.RoomRouter([broken, other], timeout=5)
+        status, worker, _ = self._get(router, self._room_on(router, broken))
+        self.assertEqual((status, worker), ("502 Bad Gateway", broken))
+        self.assertEqual(router.ring.nodes, sorted([broken, other]))
@@ -0,0 +1,110 @@
+import contextlib
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+_local = threading.local()
+_request_counter = itertools.count(1)
+
+
+class _Trace:
+    def __init__(self):
+        self.events = []
+        self.stack = []  # open spans: [name, start_ns, queries]
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def add(self, name, category, start_ns, end_ns, args):
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start_ns / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": self.pid,
+            "tid": self.tid,
+            "args": args,
+        })
+
+
+@contextlib.contextmanager
+def _span(trace, name):
+    frame = [name, time.perf_counter_ns(), 0]
+    trace.stack.append(frame)
+    try:
+        yield
+    finally:
+        trace.stack.pop()
+        trace.add(name, "span", frame[1], time.perf_counter_ns(), {"queries": frame[2]})
+
+
+def span(name):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return contextlib.nullcontext()
+    return _span(trace, name)
+
+
+def traced(func):
+    name = func.__qualname__.replace(".<locals>", "")
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = getattr(_local, "trace", None)
+        if trace is None:
+            return func(*args, **kwargs)
+        with _span(trace, name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    trace = _local.trace
+    start_ns = time.perf_counter_ns()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        for frame in trace.stack:
+            frame[2] += 1
+        trace.add(sql.split(" ", 1)[0], "sql", start_ns, time.perf_counter_ns(),
+                  {"sql": sql, "db": context["connection"].alias})
+
+
+# Records every TRACE_SAMPLE_EVERY-th request as a Chrome trace-event file in TRACE_DIR
+class TracingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_every = getattr(settings, "TRACE_SAMPLE_EVERY", 0)
+        self.trace_dir = getattr(settings, "TRACE_DIR", settings.BASE_DIR / "traces")
+
+    def __call__(self, request):
+        if not self.sample_every:
+            return self.get_response(request)
+        request_number = next(_request_counter)
+        if request_number % self.sample_every:
+            return self.get_response(request)
+
+        trace = _local.trace = _Trace()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_sql_wrapper))
+                with _span(trace, f"{request.method} {request.path}"):
+                    response = self.get_response(request)
+        finally:
+            _local.trace = None
+        self._write(trace, request_number)
+        return response
+
+    def _write(self, trace, request_number):
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f"trace-{int(time.time())}-{trace.pid}-{request_number}.json")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace.events, "displayTimeUnit": "ms"}, f)
@@ -1,19 +1,35 @@
 from django.urls import path
 
-from game import room_views, auth_views, game_views
+from game import room_views, auth_views, game_views, stats_views, matchmaking_views, ops_views
 
 urlpatterns = [
     path('game_stage/', game_views.get_game_stage, name='game_stage'),
     path('game_history/', game_views.get_history, name='game_history'),
     path('submit_action/', game_views.submit_action, name='submit_action'),
     path('shoot_card/', game_views.shoot_card, name='shoot_card'),
+    path('sync/', game_views.sync, name='sync'),
+
+    path('game_result/', stats_views.get_game_result, name='game_result'),
+    path('role_stats/', stats_views.get_role_stats, name='role_stats'),
+    path('user_stats/', stats_views.get_user_stats, name='user_stats'),
+    path('leaderboard/', stats_views.get_leaderboard, name='leaderboard'),
+    path('user_rating/', stats_views.get_user_rating, name='user_rating'),
 
     path('rooms/', room_views.get_rooms_list, name='rooms_list'),
+    path('rooms/search/', room_views.search_rooms, name='rooms_search'),
     path('create_room/', room_views.create_room, name='create_room'),
     path('delete_room/', room_views.delete_room, name='delete_room'),
     path('join_room/', room_views.join_room, name='join_room'),
     path('leave_room/', room_views.leave_room, name='leave_room'),
     path('start_game/', room_views.start_game, name='start_game'),
+    path('room_events/', room_views.get_room_events, name='room_events'),
+
+    path('matchmaking/enqueue/', matchmaking_views.enqueue, name='matchmaking_enqueue'),
+    path('matchmaking/status/', matchmaking_views.get_status, name='matchmaking_status'),
+    path('matchmaking/leave/', matchmaking_views.leave, name='matchmaking_leave'),
+
+    path('ops/admission/', ops_views.get_admission_metrics, name='admission_metrics'),
+    path('ops/memory/', ops_views.get_memory_report, name='memory_report'),
 
     path("csrf/", auth_views.csrf),
     path("login/", auth_views.login_view),
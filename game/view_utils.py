@@ -1,10 +1,13 @@
 import json
 import threading
+from functools import cached_property
 
 from django.http import JsonResponse
 
-from game.exceptions import GameException, RoomNotFoundException, GameNotStartedException, UserNotInRoomException
-from game.models import Room
+from game.exceptions import GameException, RoomNotFoundException, GameNotStartedException, UserNotInRoomException, \
+    InvalidRequestException, InvalidRoomIdException, StaffOnlyException
+from game.models import Room, Game, Player
+from game.tracing import traced, span
 
 _registry_lock = threading.Lock()
 _room_locks = {}  # {room_id: threading.RLock()}
@@ -19,15 +22,85 @@ def _get_room_lock(room_id):
         return lock
 
 
-def smart_view(view):
-    def new_view(*args, **kwargs):
-        data = json.loads(args[0].body or "{}")
+def room_lock_count() -> int:
+    return len(_room_locks)
+
+
+class RequestContext:
+    def __init__(self, request):
+        self.request = request
+        try:
+            self.data = json.loads(request.body or "{}")
+        except ValueError:
+            raise InvalidRequestException
+        if not isinstance(self.data, dict):
+            raise InvalidRequestException
+        self.room_id = self._parse_room_id(self.data.get("room_id") or request.GET.get("room_id"))
+
+    @staticmethod
+    def _parse_room_id(room_id):
+        if room_id is None or room_id == "":
+            return None
+        if isinstance(room_id, bool) or not isinstance(room_id, (int, str)):
+            raise InvalidRoomIdException
+        if isinstance(room_id, str):
+            if not room_id.isdecimal():
+                raise InvalidRoomIdException
+            room_id = int(room_id)
+        return room_id
+
+    @cached_property
+    def room(self) -> Room | None:
+        if self.room_id is None:
+            return None
+        return Room.objects.select_related("game", "creator").filter(id=self.room_id).first()
+
+    @cached_property
+    def game(self) -> Game | None:
+        return self.room.get_game() if self.room else None
+
+    @cached_property
+    def players(self) -> list[Player]:
+        if not self.room:
+            return []
+        return list(self.room.players.select_related("user").order_by("join_timestamp"))
+
+    @cached_property
+    def player_id(self) -> int | None:
+        # seat of the requesting user, same as Player.position
+        for position, player in enumerate(self.players):
+            if player.user_id == self.request.user.id:
+                return position
+        return None
+
+    @property
+    def player(self) -> Player | None:
+        return self.players[self.player_id] if self.player_id is not None else None
+
+
+def get_context(request) -> RequestContext:
+    context = getattr(request, "game_context", None)
+    if context is None:
+        context = request.game_context = RequestContext(request)
+    return context
+
+
+def smart_view(view=None, *, lock_room=True):
+    # Room management views serialize on a per-room lock; game views rely on
+    # compare-and-swap updates and unique constraints instead (lock_room=False).
+    if view is None:
+        return lambda view: smart_view(view, lock_room=lock_room)
+
+    @traced
+    def new_view(request, *args, **kwargs):
         room_lock = None
-        if "room_id" in data:
-            room_lock = _get_room_lock(data["room_id"])
-            room_lock.acquire()
         try:
-            return view(*args, **kwargs)
+            context = get_context(request)
+            if lock_room and "room_id" in context.data:
+                room_lock = _get_room_lock(context.room_id)
+                with span("room_lock.acquire"):
+                    room_lock.acquire()
+            return view(request, *args, **kwargs)
         except GameException as e:
             return JsonResponse({"detail": e.details}, status=e.code)
         finally:
@@ -38,12 +111,12 @@ def smart_view(view):
 
 
 def require_room_exists(func):
+    @traced
     def wrapper(request, *args, **kwargs):
-        room_id = json.loads(request.body or "{}").get("room_id") or request.GET.get("room_id")
-        if not room_id:
-            print(f"room_id: {room_id}")
+        context = get_context(request)
+        if context.room_id is None:
             return JsonResponse({"detail": "room_id is required"}, status=400)
-        if not Room.objects.filter(id=room_id).exists():
+        if context.room is None:
             raise RoomNotFoundException
         return func(request, *args, **kwargs)
 
@@ -51,10 +124,9 @@ def require_room_exists(func):
 
 
 def require_game_started(func):
+    @traced
     def wrapper(request, *args, **kwargs):
-        room_id = json.loads(request.body or "{}").get("room_id") or request.GET.get("room_id")
-        room = Room.objects.get(id=room_id)
-        if not room.get_game():
+        if not get_context(request).game:
             raise GameNotStartedException
         return func(request, *args, **kwargs)
 
@@ -62,11 +134,19 @@ def require_game_started(func):
 
 
 def require_user_in_room(func):
+    @traced
     def wrapper(request, *args, **kwargs):
-        room_id = json.loads(request.body or "{}").get("room_id") or request.GET.get("room_id")
-        room = Room.objects.get(id=room_id)
-        if request.user not in [player.user for player in room.players.all()]:
+        if get_context(request).player is None:
             raise UserNotInRoomException
         return func(request, *args, **kwargs)
 
     return wrapper
+
+
+def require_staff(func):
+    def wrapper(request, *args, **kwargs):
+        if not (request.user.is_authenticated and request.user.is_staff):
+            raise StaffOnlyException
+        return func(request, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,26 @@
+import time
+
+from django.db import connections
+from django.urls import get_resolver
+
+from game import snapshots
+from game.ratings import leaderboard_page
+from game.stats_views import LEADERBOARD_PAGE_SIZE
+
+
+def run() -> dict:
+    # Pays the cold costs of a fresh process before it takes traffic; returns {step: result} with timings.
+    # Connections are closed again so a server that forks its workers after this never shares one.
+    results = {}
+
+    def step(name, func):
+        start = time.perf_counter()
+        value = func()
+        results[name] = {"result": value, "ms": round((time.perf_counter() - start) * 1000, 1)}
+
+    # importing the URLconf imports every view module and, through them, game_logic and its rule tables
+    step("urls", lambda: len(get_resolver().reverse_dict))
+    step("snapshots", snapshots.warm)
+    step("leaderboard", lambda: len(leaderboard_page(0, LEADERBOARD_PAGE_SIZE)))
+    connections.close_all()
+    return results
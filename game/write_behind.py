@@ -0,0 +1,133 @@
+"""
+Write-behind buffer for stage reads.
+
+Every poll of game_stage marks the current stage as read by the polling user. Instead of writing
+a GameStageRead row per poll, reads are recorded in memory and flushed in one bulk insert every
+WRITE_BEHIND_FLUSH_MS milliseconds, and whenever the game is about to leave a stage. Repeated polls
+of an already-read stage write nothing at all. With WRITE_BEHIND_FLUSH_MS = 0 reads are written
+through as before.
+
+Only reads are buffered. Game state (GameState, Action, CardShot, Game.stage) is written through,
+because every one of those writes is a stage boundary anyway.
+
+Crash recovery: if the process dies, reads that were not flushed are lost. No moves, cards or
+shots are lost and no game is corrupted. The affected players look as if they had not yet seen
+the current stage, their next poll marks it again, and the stage advances at most one poll plus
+min_move_time later than it would have. A read that was flushed is never lost. Reads of a room
+are only visible to the process holding them, which is another reason to route rooms with
+Mafia44.room_routing; without it, the other workers just advance a little later.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from game.models import GameStageRead, GameState
+
+MAX_KNOWN_READS = 100000
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = {}  # {state_id: {user_id: timestamp}}
+_known = set()  # (state_id, user_id) already pending or written
+_flusher = None
+
+
+def _flush_interval() -> float:
+    return getattr(settings, "WRITE_BEHIND_FLUSH_MS", 0) / 1000
+
+
+def mark_read(state_id: int, user_id: int) -> None:
+    if not _flush_interval():
+        GameStageRead.objects.get_or_create(user_id=user_id, state_id=state_id)
+        return
+    key = (state_id, user_id)
+    if key in _known:
+        return
+    with _lock:
+        if key in _known:
+            return
+        if len(_known) >= MAX_KNOWN_READS:
+            _known.clear()  # forgetting only costs a redundant, conflict-ignored insert
+        _known.add(key)
+        _pending.setdefault(state_id, {})[user_id] = timezone.now()
+    _ensure_flusher()
+
+
+def pending_reads(state_id: int) -> dict:
+    with _lock:
+        return dict(_pending.get(state_id, {}))
+
+
+def pending_read_count() -> int:
+    with _lock:
+        return sum(len(reads) for reads in _pending.values())
+
+
+def known_read_count() -> int:
+    return len(_known)
+
+
+def flush(state_id: int | None = None) -> int:
+    with _lock:
+        if state_id is None:
+            batch = _pending.copy()
+            _pending.clear()
+        else:
+            batch = {state_id: _pending.pop(state_id)} if state_id in _pending else {}
+    if not batch:
+        return 0
+
+    try:
+        with transaction.atomic():
+            # states of deleted rooms may be gone by now
+            existing = set(GameState.objects.filter(id__in=batch).values_list('id', flat=True))
+            rows = [
+                GameStageRead(state_id=read_state_id, user_id=user_id, timestamp=timestamp)
+                for read_state_id, reads in batch.items() if read_state_id in existing
+                for user_id, timestamp in reads.items()
+            ]
+            GameStageRead.objects.bulk_create(rows, ignore_conflicts=True)
+    except DatabaseError:
+        with _lock:
+            for read_state_id, reads in batch.items():
+                for user_id, timestamp in reads.items():
+                    _pending.setdefault(read_state_id, {}).setdefault(user_id, timestamp)
+        raise
+    return len(rows)
+
+
+def discard() -> None:
+    # what a crash does to the buffer
+    with _lock:
+        _pending.clear()
+        _known.clear()
+
+
+def _flush_forever():
+    while True:
+        time.sleep(_flush_interval() or 1)
+        try:
+            flush()
+        except DatabaseError:
+            logger.exception("Failed to flush stage reads, will retry")
+            connection.close()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_forever, name="write-behind-flusher", daemon=True)
+            _flusher.start()
+
+
+atexit.register(lambda: _pending and flush())